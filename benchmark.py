@@ -0,0 +1,716 @@
+import argparse
+import importlib.util
+import inspect
+import json
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import ModuleType
+from typing import Annotated, Any, Callable, Dict, Iterator, List, Optional
+from uuid import uuid4
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import ConfigurableField
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langgraph.checkpoint.memory import MemorySaver
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from pydantic import ConfigDict
+
+import lcel
+from client_factory import get_chat_model
+from model_router import ModelRouter, load_router
+from prompt_registry import prompts
+from rate_limiter import DEFAULT_COMPLETION_TOKENS, RequestScheduler, estimate_tokens, set_scheduler
+from response_cache import request_key
+from sample_gpt import AIClient, FunctionCallingService, MockWeatherService, OpenAIClient, ToolRegistry
+from tool_catalog import function_schema
+
+ROOT = Path(__file__).resolve().parent
+CASSETTE_DIR = ROOT / "cassettes"
+
+
+def load_script(relative_path: str) -> ModuleType:
+    """langgraph/ などのスクリプトをファイルパスから読み込む（パッケージ名が衝突するため）"""
+    path = ROOT / relative_path
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Cassette:
+    """リクエストのハッシュをキーに、記録したレスポンスとレイテンシを保存する"""
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.interactions: Dict[str, Dict[str, Any]] = {}
+        if path.exists():
+            self.interactions = json.loads(path.read_text(encoding="utf-8"))["interactions"]
+
+    def get(self, key: str) -> Dict[str, Any]:
+        interaction = self.interactions.get(key)
+        if interaction is None:
+            raise KeyError(f"No recorded interaction for {key[:12]} in {self.path}. Run `python benchmark.py record` first.")
+        return interaction
+
+    def put(self, key: str, interaction: Dict[str, Any]) -> None:
+        with self._lock:
+            self.interactions[key] = interaction
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        payload = {"interactions": self.interactions}
+        self.path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+# --- AIClient ---------------------------------------------------------------
+
+class RecordingAIClient(AIClient):
+    """実際の AIClient を呼び、レスポンスをカセットに記録する"""
+    def __init__(self, ai_client: AIClient, cassette: Cassette):
+        self.ai_client = ai_client
+        self.cassette = cassette
+
+    def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        key = request_key(messages, **kwargs)
+        start = time.perf_counter()
+        response = self.ai_client.chat_completion(messages=messages, **kwargs)
+        if not kwargs.get("stream"):
+            self.cassette.put(key, {"response": response.model_dump(), "latency_s": time.perf_counter() - start})
+            return response
+
+        chunks, offsets = [], []
+        for chunk in response:
+            chunks.append(chunk)
+            offsets.append(time.perf_counter() - start)
+        self.cassette.put(key, {
+            "chunks": [chunk.model_dump() for chunk in chunks],
+            "latency_s": offsets[0] if offsets else 0.0,
+            "chunk_interval_s": (offsets[-1] - offsets[0]) / max(len(offsets) - 1, 1) if offsets else 0.0,
+        })
+        return iter(chunks)
+
+
+class ReplayAIClient(AIClient):
+    """カセットから応答を返すフェイクの AIClient
+
+    latency / chunk_interval を指定すると記録時の値の代わりに使う。model_latency はモデルごとの latency。
+    """
+    def __init__(
+        self,
+        cassette: Cassette,
+        latency: Optional[float] = None,
+        chunk_interval: Optional[float] = None,
+        model_latency: Optional[Dict[str, float]] = None,
+    ):
+        self.cassette = cassette
+        self.latency = latency
+        self.chunk_interval = chunk_interval
+        self.model_latency = model_latency or {}
+        self.model_time = 0.0
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        interaction = self.cassette.get(request_key(messages, **kwargs))
+        self.calls[kwargs.get("model", "")] += 1
+        latency = self.model_latency.get(kwargs.get("model", ""), self.latency)
+        if latency is None:
+            latency = interaction["latency_s"]
+        if "chunks" in interaction:
+            return self._stream(interaction, latency)
+
+        start = time.perf_counter()
+        time.sleep(latency)
+        response = ChatCompletion.model_validate(interaction["response"])
+        self.model_time += time.perf_counter() - start
+        return response
+
+    def _stream(self, interaction: Dict[str, Any], latency: float) -> Iterator[ChatCompletionChunk]:
+        interval = interaction["chunk_interval_s"] if self.chunk_interval is None else self.chunk_interval
+        for i, chunk in enumerate(interaction["chunks"]):
+            start = time.perf_counter()
+            time.sleep(latency if i == 0 else interval)
+            parsed = ChatCompletionChunk.model_validate(chunk)
+            self.model_time += time.perf_counter() - start
+            yield parsed
+
+
+class ScriptedAIClient(AIClient):
+    """API キーなしでカセットを作るための決め打ちの応答"""
+    def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        message: Dict[str, Any] = {"role": "assistant", "content": "東京の天気は10度です。"}
+        if kwargs.get("tools"):
+            tool_name = kwargs["tools"][0]["function"]["name"]
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": "call_0",
+                "type": "function",
+                "function": {"name": tool_name, "arguments": json.dumps({"location": "Tokyo"})},
+            }]}
+        return ChatCompletion.model_validate({
+            "id": "chatcmpl-scripted",
+            "object": "chat.completion",
+            "created": 0,
+            "model": kwargs.get("model", "scripted"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+            "usage": {"prompt_tokens": 20, "completion_tokens": 10, "total_tokens": 30},
+        })
+
+
+# --- ChatModel --------------------------------------------------------------
+
+class _ToolBindingChatModel(BaseChatModel):
+    """with_structured_output が使えるように bind_tools だけ実装した基底クラス"""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def bind_tools(self, tools, *, tool_choice=None, **kwargs):
+        formatted = [convert_to_openai_tool(tool) for tool in tools]
+        return self.bind(tools=formatted, tool_choice=tool_choice, **kwargs)
+
+
+def _request_kwargs(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    # ls_ で始まる引数はトレース用のメタデータなのでキーに含めない
+    return {k: v for k, v in kwargs.items() if not k.startswith("ls_") and v is not None}
+
+
+class CassetteChatModel(_ToolBindingChatModel):
+    """カセットを再生するフェイクのチャットモデル。record_from を渡すと記録モードになる"""
+    cassette: Cassette
+    model_name: str = "cassette"
+    record_from: Optional[BaseChatModel] = None
+    latency: Optional[float] = None
+    chunk_interval: float = 0.0
+    chunk_size: int = 8
+    max_tokens: Optional[int] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette"
+
+    def _key(self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: Dict[str, Any]) -> str:
+        return request_key(
+            [message_to_dict(m) for m in messages],
+            model=self.model_name,
+            max_tokens=self.max_tokens,
+            stop=stop,
+            **_request_kwargs(kwargs),
+        )
+
+    def _fetch(self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: Dict[str, Any]):
+        key = self._key(messages, stop, kwargs)
+        if self.record_from is not None:
+            return self._record(key, messages, stop, kwargs), 0.0
+
+        interaction = self.cassette.get(key)
+        latency = interaction["latency_s"] if self.latency is None else self.latency
+        return messages_from_dict([interaction["message"]])[0], latency
+
+    def _record(self, key: str, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: Dict[str, Any]):
+        kwargs = _request_kwargs(kwargs)
+        model = self.record_from
+        if "tools" in kwargs:
+            model = model.bind_tools(kwargs.pop("tools"), tool_choice=kwargs.pop("tool_choice", None))
+        if self.max_tokens is not None:
+            kwargs["max_tokens"] = self.max_tokens
+
+        start = time.perf_counter()
+        message = model.invoke(messages, stop=stop, **kwargs)
+        self.cassette.put(key, {"message": message_to_dict(message), "latency_s": time.perf_counter() - start})
+        return message
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        message, latency = self._fetch(messages, stop, kwargs)
+        time.sleep(latency)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        message, latency = self._fetch(messages, stop, kwargs)
+        time.sleep(latency)
+        if message.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=message.content,
+                tool_call_chunks=[
+                    {"name": tc["name"], "args": json.dumps(tc["args"]), "id": tc["id"], "index": i}
+                    for i, tc in enumerate(message.tool_calls)
+                ],
+            ))
+            return
+
+        content = message.content if isinstance(message.content, str) else ""
+        for i in range(0, max(len(content), 1), self.chunk_size):
+            if i:
+                time.sleep(self.chunk_interval)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=content[i:i + self.chunk_size]))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+class ScriptedChatModel(_ToolBindingChatModel):
+    """API キーなしでカセットを作るための決め打ちの応答"""
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = messages[-1].content if isinstance(messages[-1].content, str) else ""
+        if kwargs.get("tools"):
+            tool = kwargs["tools"][0]["function"]
+            args = {name: True if spec.get("type") == "boolean" else "問題ありません"
+                    for name, spec in tool["parameters"]["properties"].items()}
+            message = AIMessage(content="", tool_calls=[{"name": tool["name"], "args": args, "id": "call_0"}])
+        elif "ロールを選択" in text:
+            message = AIMessage(content="2")
+        else:
+            message = AIMessage(content=f"回答: {text[:40]}")
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+# --- 計測 --------------------------------------------------------------------
+
+class LayerTimer(BaseCallbackHandler):
+    """コールバックからプロンプト・モデル・パーサ・グラフノードごとの時間を集計する"""
+    run_inline = True
+
+    def __init__(self) -> None:
+        self.totals: Dict[str, float] = defaultdict(float)
+        self._starts: Dict[Any, Any] = {}
+
+    def reset(self) -> None:
+        self.totals.clear()
+        self._starts.clear()
+
+    def _start(self, run_id: Any, layer: str) -> None:
+        self._starts[run_id] = (layer, time.perf_counter())
+
+    def _end(self, run_id: Any) -> None:
+        layer, start = self._starts.pop(run_id, (None, 0.0))
+        if layer is not None:
+            self.totals[layer] += time.perf_counter() - start
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        self._start(run_id, "model")
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._start(run_id, "model")
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs) -> None:
+        name = kwargs.get("name") or ""
+        if metadata and metadata.get("langgraph_node") == name:
+            self._start(run_id, "node")
+        elif name == "LangGraph":
+            self._start(run_id, "graph")
+        elif "Prompt" in name:
+            self._start(run_id, "prompt")
+        elif "Parser" in name:
+            self._start(run_id, "parser")
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+
+@dataclass
+class BenchResult:
+    name: str
+    wall: List[float] = field(default_factory=list)
+    layers: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    alloc_peak_kb: List[float] = field(default_factory=list)
+
+    def summary(self) -> Dict[str, Any]:
+        def ms(values: List[float]) -> float:
+            return round(statistics.mean(values) * 1000, 3) if values else 0.0
+
+        wall = sorted(self.wall)
+        result = {
+            "flow": self.name,
+            "n": len(wall),
+            "wall_p50_ms": round(wall[len(wall) // 2] * 1000, 3),
+            "wall_mean_ms": ms(wall),
+            "model_ms": ms(self.layers["model"]),
+            "overhead_ms": ms([w - m for w, m in zip(self.wall, self.layers["model"])]),
+        }
+        for layer in ("prompt", "parser", "node"):
+            if any(self.layers[layer]):
+                result[f"{layer}_ms"] = ms(self.layers[layer])
+        if any(self.layers["graph"]):
+            # グラフ全体の時間からノード実行時間を引いたものをスケジューリングのオーバーヘッドとみなす
+            result["graph_scheduling_ms"] = ms([g - n for g, n in zip(self.layers["graph"], self.layers["node"])])
+        result["alloc_peak_kb"] = round(statistics.mean(self.alloc_peak_kb), 1) if self.alloc_peak_kb else 0.0
+        return result
+
+
+@dataclass
+class Flow:
+    name: str
+    run: Callable[[], Any]
+    timer: Optional[LayerTimer] = None
+    ai_client: Optional[ReplayAIClient] = None
+
+
+def run_benchmark(flow: Flow, n: int, warmup: int = 1) -> BenchResult:
+    for _ in range(warmup):
+        flow.run()
+
+    result = BenchResult(flow.name)
+    for _ in range(n):
+        if flow.timer:
+            flow.timer.reset()
+        if flow.ai_client:
+            flow.ai_client.model_time = 0.0
+
+        start = time.perf_counter()
+        flow.run()
+        result.wall.append(time.perf_counter() - start)
+
+        totals = dict(flow.timer.totals) if flow.timer else {}
+        if flow.ai_client:
+            totals["model"] = flow.ai_client.model_time
+        for layer in ("model", "prompt", "parser", "node", "graph"):
+            result.layers[layer].append(totals.get(layer, 0.0))
+
+    # tracemalloc は計測を遅くするので、時間とは別に回す
+    tracemalloc.start()
+    try:
+        for _ in range(n):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            flow.run()
+            _, peak = tracemalloc.get_traced_memory()
+            result.alloc_peak_kb.append((peak - before) / 1024)
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+# --- 対象のフロー --------------------------------------------------------------
+
+def function_calling_flow(ai_client: AIClient, router: Optional[ModelRouter] = None) -> Callable[[], Any]:
+    service = FunctionCallingService(ai_client, ToolRegistry(MockWeatherService()), router=router)
+    return lambda: service.process_query("Tokyoの天気はどうですか？")
+
+
+def lcel_flow(model: BaseChatModel, timer: LayerTimer) -> Callable[[], Any]:
+    chain = lcel.build_multi_chain(model).with_config(callbacks=[timer])
+    return lambda: chain.invoke({"question": "10 + 2 * 3"})
+
+
+def qa_graph_flow(model: BaseChatModel, timer: LayerTimer) -> Callable[[], Any]:
+    qa = load_script("langgraph/qa_application.py")
+    qa.llm = model.configurable_fields(max_tokens=ConfigurableField(id="max_tokens"))
+    compiled = qa.build_workflow().compile()
+    return lambda: compiled.invoke(qa.State(query="生成 AI について教えてください"), {"callbacks": [timer]})
+
+
+def checkpoint_graph_flow(model: BaseChatModel, timer: LayerTimer) -> Callable[[], Any]:
+    cs = load_script("langgraph/checkpoint_saver.py")
+    cs.get_chat_model = lambda *args, **kwargs: model
+    graph = cs.setup_graph(MemorySaver())
+
+    def run() -> None:
+        # スレッドごとの状態が積み上がらないよう、毎回新しいスレッドで2ターン会話する
+        config = {"configurable": {"thread_id": str(uuid4())}, "callbacks": [timer]}
+        graph.invoke(cs.State(query="私の好きなものはずんだ餅です。覚えておいてね。"), config)
+        graph.invoke(cs.State(query="私の好物は何か覚えている？"), config)
+
+    return run
+
+
+CHAT_FLOWS = {
+    "lcel_multi_chain": ("gpt-4o-mini", lcel_flow),
+    "qa_graph": ("gpt-4o", qa_graph_flow),
+    "checkpoint_graph": ("gpt-4o-mini", checkpoint_graph_flow),
+}
+
+
+def record(scripted: bool) -> None:
+    """各フローを1回ずつ実行してカセットに記録する"""
+    cassette = Cassette(CASSETTE_DIR / "function_calling.json")
+    inner = ScriptedAIClient() if scripted else OpenAIClient(api_key=os.getenv("OPENAI_API_KEY"))
+    function_calling_flow(RecordingAIClient(inner, cassette))()
+    # ルーターが小さいモデルに振るラウンドも記録しておく（routing サブコマンド用）
+    function_calling_flow(RecordingAIClient(inner, cassette), load_router())()
+    cassette.save()
+
+    for name, (model_name, build) in CHAT_FLOWS.items():
+        cassette = Cassette(CASSETTE_DIR / f"{name}.json")
+        real = ScriptedChatModel() if scripted else get_chat_model(model_name, temperature=0)
+        model = CassetteChatModel(cassette=cassette, model_name=model_name, record_from=real)
+        build(model, LayerTimer())()
+        cassette.save()
+        print(f"recorded {len(cassette.interactions)} interactions -> {cassette.path}")
+
+
+def replay(n: int, latency: Optional[float], chunk_interval: float, as_json: bool) -> List[Dict[str, Any]]:
+    """カセットを再生して、フレームワーク側のオーバーヘッドを計測する"""
+    flows = []
+    ai_client = ReplayAIClient(Cassette(CASSETTE_DIR / "function_calling.json"), latency, chunk_interval)
+    flows.append(Flow("function_calling", function_calling_flow(ai_client), ai_client=ai_client))
+
+    for name, (model_name, build) in CHAT_FLOWS.items():
+        timer = LayerTimer()
+        model = CassetteChatModel(
+            cassette=Cassette(CASSETTE_DIR / f"{name}.json"),
+            model_name=model_name,
+            latency=latency,
+            chunk_interval=chunk_interval,
+        )
+        flows.append(Flow(name, build(model, timer), timer=timer))
+
+    summaries = [run_benchmark(flow, n).summary() for flow in flows]
+    if as_json:
+        print(json.dumps(summaries, ensure_ascii=False, indent=2))
+    else:
+        for summary in summaries:
+            print("  ".join(f"{k}={v}" for k, v in summary.items()))
+    return summaries
+
+
+def routing_comparison(
+    n: int,
+    latency: Optional[float],
+    model_latency: Dict[str, float],
+    routes: Optional[Path],
+    as_json: bool,
+) -> List[Dict[str, Any]]:
+    """function_calling のフローを、常に大きいモデルを使う場合とルーターでモデルを選ぶ場合とで比べる"""
+    cassette = Cassette(CASSETTE_DIR / "function_calling.json")
+    results = []
+    for name, router in (("always_large", None), ("routed", load_router(routes))):
+        ai_client = ReplayAIClient(cassette, latency, model_latency=model_latency)
+        summary = run_benchmark(Flow(name, function_calling_flow(ai_client, router), ai_client=ai_client), n).summary()
+        # run_benchmark はウォームアップとメモリ計測でも呼ぶので、呼び出し数は1回あたりに直す
+        runs = n * 2 + 1
+        summary["calls_per_run"] = {model: round(count / runs, 2) for model, count in ai_client.calls.items()}
+        if router is not None:
+            summary["router"] = router.stats()
+        results.append(summary)
+
+    baseline, routed = results
+    routed["wall_p50_speedup"] = round(baseline["wall_p50_ms"] / routed["wall_p50_ms"], 2) if routed["wall_p50_ms"] else 0.0
+    if as_json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        for summary in results:
+            print("  ".join(f"{k}={v}" for k, v in summary.items() if k != "router"))
+    return results
+
+
+def _model_latency(value: str) -> tuple:
+    model, _, seconds = value.partition("=")
+    return model, float(seconds)
+
+
+# レジストリに登録されたプロンプトごとの入力例
+PROMPT_INPUTS = {
+    "qa.selection": {"query": "生成 AI について教えてください"},
+    "qa.answering": {"role": "生成 AI 製品エキスパート", "query": "生成 AI について教えてください"},
+    "qa.check": {"query": "生成 AI について教えてください", "answer": "生成 AI は文章や画像を生成する AI です。"},
+    "lcel.cot": {"question": "10 + 2 * 3"},
+    "lcel.summarize": {"text": "まず 2 * 3 = 6 を計算し、10 + 6 = 16 になります。"},
+}
+
+
+def prompt_overhead(n: int, as_json: bool) -> List[Dict[str, Any]]:
+    """プロンプトを呼び出しごとに組み立てる場合と、レジストリの構築済みプロンプトを使う場合の描画時間を比べる"""
+    load_script("langgraph/qa_application.py")
+    results = []
+    for name, inputs in PROMPT_INPUTS.items():
+        start = time.perf_counter()
+        for _ in range(n):
+            prompts.rebuild(name).invoke(inputs)
+        before = (time.perf_counter() - start) / n
+
+        prompt = prompts.get(name)
+        start = time.perf_counter()
+        for _ in range(n):
+            prompt.invoke(inputs)
+        after = (time.perf_counter() - start) / n
+
+        results.append({
+            "prompt": name,
+            "rebuild_us": round(before * 1e6, 1),
+            "registry_us": round(after * 1e6, 1),
+            "speedup": round(before / after, 2),
+        })
+
+    if as_json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        for result in results:
+            print("  ".join(f"{k}={v}" for k, v in result.items()))
+    return results
+
+
+# 合成ツールカタログの材料。(英語, 日本語) の組で、ツール名・説明と検索クエリの両方に使う
+TOOL_DOMAINS = [
+    ("calendar", "カレンダー"), ("email", "メール"), ("crm", "顧客管理"), ("billing", "請求"), ("inventory", "在庫"),
+    ("hr", "人事"), ("ticket", "チケット"), ("storage", "ストレージ"), ("chat", "チャット"), ("analytics", "分析"),
+]
+TOOL_OBJECTS = [
+    ("event", "予定"), ("message", "メッセージ"), ("contact", "連絡先"), ("invoice", "請求書"), ("order", "注文"),
+    ("employee", "従業員"), ("report", "レポート"), ("file", "ファイル"), ("task", "タスク"), ("comment", "コメント"),
+]
+TOOL_ACTIONS = [("get", "取得"), ("create", "作成"), ("update", "更新"), ("delete", "削除"), ("search", "検索")]
+
+
+def _synthetic_tool(domain: str, action: str, obj: str) -> Callable:
+    """{action}_{domain}_{obj} という名前の、引数に説明の付いたダミーのツール関数を作る"""
+    def func(**kwargs) -> str:
+        return json.dumps(kwargs)
+
+    params = [
+        inspect.Parameter(f"{obj}_id", inspect.Parameter.KEYWORD_ONLY, annotation=Annotated[str, f"The {domain} {obj} ID"]),
+        inspect.Parameter(
+            "fields", inspect.Parameter.KEYWORD_ONLY, default=None,
+            annotation=Optional[Annotated[List[str], f"Fields of the {obj} to include in the result"]],
+        ),
+        inspect.Parameter(
+            "limit", inspect.Parameter.KEYWORD_ONLY, default=20,
+            annotation=Annotated[int, "Maximum number of results to return"],
+        ),
+    ]
+    func.__name__ = f"{action}_{domain}_{obj}"
+    func.__doc__ = f"{action.capitalize()} a {obj} in the {domain} service.\n\nReturns the {obj} as JSON."
+    func.__signature__ = inspect.Signature(params, return_annotation=str)
+    func.__annotations__ = {param.name: param.annotation for param in params} | {"return": str}
+    return func
+
+
+def _synthetic_catalog() -> List[tuple]:
+    """(関数, 日本語の keywords, 検索クエリの例) を len(TOOL_DOMAINS) * len(TOOL_OBJECTS) * len(TOOL_ACTIONS) 件作る"""
+    catalog = []
+    for domain, domain_ja in TOOL_DOMAINS:
+        for obj, obj_ja in TOOL_OBJECTS:
+            for action, action_ja in TOOL_ACTIONS:
+                keywords = f"{domain_ja}の{obj_ja}を{action_ja}"
+                query = f"{domain_ja}の{obj_ja}を{action_ja}してください"
+                catalog.append((_synthetic_tool(domain, action, obj), keywords, query))
+    return catalog
+
+
+def tool_catalog_comparison(n: int, k: int, as_json: bool) -> List[Dict[str, Any]]:
+    """ツールが多い場合に、毎回全ツールの定義を作って渡すのと、キャッシュした定義から上位 k 件だけ渡すのとを比べる
+
+    prompt_tokens はツール定義を含むプロンプトの見積もり（rate_limiter.estimate_tokens）、prep_us は1リクエストあたりの
+    ツール定義の準備時間、recall は期待するツールが渡したツールに含まれていた割合。
+    """
+    registry = ToolRegistry(MockWeatherService())
+    catalog = _synthetic_catalog()
+    for func, keywords, _ in catalog:
+        registry.register(func.__name__, func, keywords=keywords)
+    specs = {schema["function"]["name"]: registry.get_spec(schema["function"]["name"]) for schema in registry.definitions()}
+    queries = [(query, func.__name__) for func, _, query in catalog[::7]]
+    queries.append(("Tokyoの天気はどうですか？", "get_current_weather"))
+
+    def uncached(query: str) -> List[Dict[str, Any]]:
+        # 変更前の ToolDefinition と同じく、リクエストのたびに定義を作り直す
+        return [
+            function_schema(spec.func, name=name, description=spec.schema["function"]["description"])
+            for name, spec in specs.items()
+        ]
+
+    strategies = [
+        ("all_uncached", uncached),
+        ("all_cached", lambda query: registry.definitions()),
+        (f"top_{k}", lambda query: registry.select(query, k)),
+    ]
+    results = []
+    for name, prepare in strategies:
+        prepare(queries[0][0])
+        tokens, hits, timings = [], 0, []
+        for _ in range(n):
+            for query, expected in queries:
+                start = time.perf_counter()
+                tools = prepare(query)
+                timings.append(time.perf_counter() - start)
+                messages = [{"role": "user", "content": query}]
+                tokens.append(estimate_tokens(messages, tools=tools) - DEFAULT_COMPLETION_TOKENS)
+                hits += any(tool["function"]["name"] == expected for tool in tools)
+        timings.sort()
+        results.append({
+            "strategy": name,
+            "tools": len(specs),
+            "tools_sent": len(prepare(queries[0][0])),
+            "prompt_tokens": round(statistics.mean(tokens)),
+            "prep_p50_us": round(timings[len(timings) // 2] * 1e6, 1),
+            "prep_p99_us": round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+            "recall": round(hits / (n * len(queries)), 3),
+        })
+
+    baseline = results[0]
+    for result in results[1:]:
+        result["token_reduction"] = round(baseline["prompt_tokens"] / result["prompt_tokens"], 1)
+    if as_json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        for result in results:
+            print("  ".join(f"{k}={v}" for k, v in result.items()))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="記録済みレスポンスを使ったオフラインベンチマーク")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="実際の API を呼んでカセットを記録する")
+    record_parser.add_argument("--scripted", action="store_true", help="API を呼ばずに決め打ちの応答で記録する")
+
+    replay_parser = subparsers.add_parser("replay", help="カセットを再生して計測する")
+    replay_parser.add_argument("-n", type=int, default=20)
+    replay_parser.add_argument("--latency", type=float, default=None, help="モデル呼び出し1回の擬似レイテンシ（秒）")
+    replay_parser.add_argument("--chunk-interval", type=float, default=0.0)
+    replay_parser.add_argument("--json", action="store_true")
+
+    routing_parser = subparsers.add_parser("routing", help="常に大きいモデルを使う場合とルーターを使う場合を比べる")
+    routing_parser.add_argument("-n", type=int, default=20)
+    routing_parser.add_argument("--latency", type=float, default=None, help="モデル呼び出し1回の擬似レイテンシ（秒）")
+    routing_parser.add_argument(
+        "--model-latency", type=_model_latency, action="append", default=[], metavar="MODEL=SECONDS",
+        help="モデルごとの擬似レイテンシ（例: gpt-4o=0.8）。指定しなければ記録時の値を使う",
+    )
+    routing_parser.add_argument("--routes", type=Path, default=None, help="ルーティングルールの JSON")
+    routing_parser.add_argument("--json", action="store_true")
+
+    prompts_parser = subparsers.add_parser("prompts", help="プロンプトの描画オーバーヘッドを計測する")
+    prompts_parser.add_argument("-n", type=int, default=2000)
+    prompts_parser.add_argument("--json", action="store_true")
+
+    tools_parser = subparsers.add_parser("tools", help="500個のツールで、全ツールを渡す場合と上位 k 件に絞る場合を比べる")
+    tools_parser.add_argument("-n", type=int, default=5)
+    tools_parser.add_argument("-k", type=int, default=8, help="1リクエストで渡すツールの数")
+    tools_parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    # ベンチマーク中はレート制限で待たないようにする
+    set_scheduler(RequestScheduler(budgets={}))
+
+    if args.command == "record":
+        record(args.scripted)
+    elif args.command == "prompts":
+        prompt_overhead(args.n, args.json)
+    elif args.command == "tools":
+        tool_catalog_comparison(args.n, args.k, args.json)
+    elif args.command == "routing":
+        routing_comparison(args.n, args.latency, dict(args.model_latency), args.routes, args.json)
+    else:
+        replay(args.n, args.latency, args.chunk_interval, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,589 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import struct
+import time
+from contextlib import aclosing
+from dataclasses import asdict, dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, convert_to_messages
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.prompts import MessagesPlaceholder
+
+from prompt_registry import prompts
+from rate_limiter import Priority, RequestScheduler, estimate_tokens, get_scheduler
+
+prompts.register(
+    "chat.history",
+    [
+        ("system", "You are a helpful assistant."),
+        MessagesPlaceholder("chat_history", optional=True),
+        ("human", "{input}"),
+    ],
+    input_variables=["input"],
+)
+
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, reason: str):
+        super().__init__(f"{status} {reason}")
+        self.status = status
+        self.reason = reason
+
+
+@dataclass
+class ServerStats:
+    """サーバー全体の接続数・ストリーム数の集計"""
+    connections: int = 0
+    streams: int = 0
+    active_streams: int = 0
+    completed: int = 0
+    # クライアントの切断・キャンセルで上流のストリームを打ち切った数
+    cancelled: int = 0
+    errors: int = 0
+    # モデルから受け取ったチャンク数と、実際に書き込んだ回数
+    chunks: int = 0
+    writes: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**asdict(self), "chunks_per_write": round(self.chunks / self.writes, 2) if self.writes else 0.0}
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    headers: Dict[str, str]
+    body: bytes
+
+
+async def read_request(reader: asyncio.StreamReader) -> Request:
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.LimitOverrunError:
+        raise HTTPError(431, "Request Header Fields Too Large") from None
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, path, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Bad Request") from None
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, "Payload Too Large")
+    body = await reader.readexactly(length) if length else b""
+    return Request(method, path.split("?", 1)[0], headers, body)
+
+
+def response_head(status: int, reason: str, headers: Dict[str, str]) -> bytes:
+    lines = [f"HTTP/1.1 {status} {reason}", *(f"{k}: {v}" for k, v in headers.items()), "", ""]
+    return "\r\n".join(lines).encode("latin-1")
+
+
+# --- WebSocket (RFC 6455) ---
+
+def websocket_accept(key: str) -> str:
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+
+
+def websocket_frame(opcode: int, payload: bytes) -> bytes:
+    """サーバーから送るフレーム（マスクなし・分割なし）"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def _unmask(data: bytes, mask: bytes) -> bytes:
+    if not data:
+        return data
+    repeated = (mask * (len(data) // 4 + 1))[: len(data)]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(repeated, "big")).to_bytes(len(data), "big")
+
+
+async def read_websocket_message(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    """分割されたフレームを結合して (opcode, payload) を返す。制御フレームはそのまま返す"""
+    opcode, parts, size = None, [], 0
+    while True:
+        b1, b2 = await reader.readexactly(2)
+        frame_opcode, length = b1 & 0x0F, b2 & 0x7F
+        if length == 126:
+            (length,) = struct.unpack("!H", await reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack("!Q", await reader.readexactly(8))
+        size += length
+        if size > MAX_BODY_BYTES:
+            raise HTTPError(413, "Payload Too Large")
+        mask = await reader.readexactly(4) if b2 & 0x80 else b""
+        data = await reader.readexactly(length)
+        if mask:
+            data = _unmask(data, mask)
+        if frame_opcode >= 0x8:
+            return frame_opcode, data
+        if frame_opcode != 0x0:
+            opcode = frame_opcode
+        parts.append(data)
+        if b1 & 0x80:
+            return opcode or 0x1, b"".join(parts)
+
+
+class _Outbox:
+    """1本のストリームの、まだ送っていないチャンク"""
+    def __init__(self, transport: asyncio.WriteTransport, encode: Callable[[str], bytes]):
+        self.transport = transport
+        self.encode = encode
+        self.parts: List[str] = []
+        self.size = 0
+        # 未送信が上限を超えたら clear され、送り出せたら set される
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.blocked_since: Optional[float] = None
+        self.producer: Optional[asyncio.Task] = None
+
+    def take(self) -> bytes:
+        data = self.encode("".join(self.parts))
+        self.parts, self.size = [], 0
+        self.writable.set()
+        return data
+
+
+class ChatServer:
+    """チャットモデルのストリームを SSE と WebSocket で配信する asyncio サーバー
+
+    - モデルの出力はストリームごとの送信待ちに溜め、サーバー全体で1つのタスクが flush_interval ごとにまとめて書き込む。
+      最初のチャンクだけはすぐに送る
+    - 送信バッファが write_buffer_limit を超えているクライアントには書き込まず、送信待ちが max_pending_chars を
+      超えたらモデルからの読み出しも止める（背圧）。send_timeout 秒詰まったままなら切断する
+    - クライアントが切断・キャンセルしたら、モデルのストリームをキャンセルする
+    """
+    def __init__(
+        self,
+        model: BaseChatModel,
+        model_name: Optional[str] = None,
+        flush_interval: float = 0.05,
+        max_pending_chars: int = 16 * 1024,
+        write_buffer_limit: int = 64 * 1024,
+        send_timeout: float = 30.0,
+        scheduler: Optional[RequestScheduler] = None,
+    ):
+        self.model = model
+        self.model_name = model_name or getattr(model, "model_name", None) or "default"
+        self.flush_interval = flush_interval
+        self.max_pending_chars = max_pending_chars
+        self.write_buffer_limit = write_buffer_limit
+        self.send_timeout = send_timeout
+        self.scheduler = scheduler or get_scheduler()
+        self.prompt = prompts.get("chat.history")
+        self.stats = ServerStats()
+        # 送信待ちのあるストリーム（挿入順を保つ集合として dict を使う）
+        self._dirty: Dict[_Outbox, None] = {}
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000, backlog: int = 4096) -> asyncio.Server:
+        self._flusher = asyncio.create_task(self._flush_loop())
+        return await asyncio.start_server(self._handle, host, port, backlog=backlog, limit=MAX_HEADER_BYTES)
+
+    def messages(self, payload: Dict[str, Any]) -> List[BaseMessage]:
+        """{"input": ..., "chat_history": [{"role": ..., "content": ...}]} からモデルに渡すメッセージを作る"""
+        if not isinstance(payload.get("input"), str):
+            raise HTTPError(400, "Bad Request")
+        history = convert_to_messages(payload.get("chat_history", []))
+        # invoke と違ってコールバックや設定の処理を通らないので、接続が集中したときの負荷が小さい
+        return self.prompt.format_messages(input=payload["input"], chat_history=history)
+
+    # --- 送信 ---
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._flush()
+
+    def _flush(self) -> None:
+        now = time.monotonic()
+        dirty, self._dirty = self._dirty, {}
+        for box in dirty:
+            if box.transport.is_closing():
+                box.producer.cancel()
+                continue
+            if box.transport.get_write_buffer_size() > self.write_buffer_limit:
+                # クライアントが読むのが遅い。次の周期まで溜めておく
+                box.blocked_since = box.blocked_since or now
+                if now - box.blocked_since > self.send_timeout:
+                    box.transport.abort()
+                    box.producer.cancel()
+                else:
+                    self._dirty[box] = None
+                continue
+            box.blocked_since = None
+            box.transport.write(box.take())
+            self.stats.writes += 1
+
+    async def _produce(self, messages: List[BaseMessage], box: _Outbox) -> None:
+        await self.scheduler.aacquire(self.model_name, estimate_tokens(messages), Priority.INTERACTIVE)
+        first = True
+        # キャンセルされたらその場でストリームを閉じ、上流の HTTP 接続を解放させる
+        async with aclosing(self.model.astream(messages)) as stream:
+            async for chunk in stream:
+                if not isinstance(chunk.content, str) or not chunk.content:
+                    continue
+                self.stats.chunks += 1
+                box.parts.append(chunk.content)
+                box.size += len(chunk.content)
+                if first:
+                    first = False
+                    box.transport.write(box.take())
+                    self.stats.writes += 1
+                    continue
+                self._dirty[box] = None
+                if box.size >= self.max_pending_chars:
+                    box.writable.clear()
+                    await box.writable.wait()
+
+    async def stream(
+        self,
+        messages: List[BaseMessage],
+        writer: asyncio.StreamWriter,
+        encode: Callable[[str], bytes],
+        disconnected: "asyncio.Future[Any]",
+    ) -> str:
+        """モデルの出力を encode してクライアントに流す。"done" / "cancelled" / "error" のいずれかを返す"""
+        box = _Outbox(writer.transport, encode)
+        producer = box.producer = asyncio.create_task(self._produce(messages, box))
+        self.stats.streams += 1
+        self.stats.active_streams += 1
+        try:
+            await asyncio.wait({producer, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not producer.done() or producer.cancelled():
+                self.stats.cancelled += 1
+                return "cancelled"
+            self._dirty.pop(box, None)
+            if box.parts:
+                await self._write(writer, box.take())
+                self.stats.writes += 1
+            if producer.exception() is not None:
+                self.stats.errors += 1
+                return "error"
+            self.stats.completed += 1
+            return "done"
+        except (ConnectionError, asyncio.TimeoutError):
+            self.stats.cancelled += 1
+            return "cancelled"
+        finally:
+            self._dirty.pop(box, None)
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            self.stats.active_streams -= 1
+
+    async def _write(self, writer: asyncio.StreamWriter, data: bytes) -> None:
+        if writer.transport.is_closing():
+            raise ConnectionResetError("Connection closed by client")
+        writer.write(data)
+        # 送信バッファが空なら drain は待たずに返るので、タイマーを作らずに済ませる
+        if writer.transport.get_write_buffer_size():
+            async with asyncio.timeout(self.send_timeout):
+                await writer.drain()
+
+    # --- 接続の処理 ---
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.stats.connections += 1
+        try:
+            request = await read_request(reader)
+            if request.path == "/chat/sse" and request.method == "POST":
+                await self._serve_sse(request, reader, writer)
+            elif request.path == "/chat/ws" and request.headers.get("upgrade", "").lower() == "websocket":
+                await self._serve_websocket(request, reader, writer)
+            elif request.path == "/stats" and request.method == "GET":
+                body = json.dumps(self.stats.to_dict()).encode()
+                head = response_head(200, "OK", {
+                    "Content-Type": "application/json", "Content-Length": str(len(body)), "Connection": "close",
+                })
+                await self._write(writer, head + body)
+            else:
+                raise HTTPError(404, "Not Found")
+        except HTTPError as e:
+            try:
+                await self._write(writer, response_head(e.status, e.reason, {"Content-Length": "0", "Connection": "close"}))
+            except (ConnectionError, asyncio.TimeoutError):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_sse(self, request: Request, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            messages = self.messages(json.loads(request.body or b"{}"))
+        except (json.JSONDecodeError, ValueError):
+            raise HTTPError(400, "Bad Request") from None
+        await self._write(writer, response_head(200, "OK", {
+            "Content-Type": "text/event-stream; charset=utf-8",
+            "Cache-Control": "no-cache",
+            "Connection": "close",
+        }))
+
+        def encode(text: str) -> bytes:
+            return f"data: {json.dumps({'content': text}, ensure_ascii=False)}\n\n".encode()
+
+        # クライアントはリクエストを送り終えているので、読み込みが終わったら切断とみなす
+        disconnected = asyncio.ensure_future(reader.read())
+        try:
+            status = await self.stream(messages, writer, encode, disconnected)
+            if status != "cancelled":
+                await self._write(writer, f"event: {status}\ndata: {{}}\n\n".encode())
+        finally:
+            disconnected.cancel()
+            if disconnected.done() and not disconnected.cancelled():
+                disconnected.exception()
+
+    async def _serve_websocket(self, request: Request, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """1接続で複数の質問を順に受け付ける。{"type": "cancel"} で生成中の回答を打ち切る"""
+        key = request.headers.get("sec-websocket-key")
+        if not key:
+            raise HTTPError(400, "Bad Request")
+        await self._write(writer, response_head(101, "Switching Protocols", {
+            "Upgrade": "websocket", "Connection": "Upgrade", "Sec-WebSocket-Accept": websocket_accept(key),
+        }))
+
+        async def send_json(payload: Dict[str, Any]) -> None:
+            await self._write(writer, websocket_frame(0x1, json.dumps(payload, ensure_ascii=False).encode()))
+
+        def encode(text: str) -> bytes:
+            return websocket_frame(0x1, json.dumps({"type": "chunk", "content": text}, ensure_ascii=False).encode())
+
+        async def answer(messages: List[BaseMessage], cancelled: "asyncio.Future[Any]") -> None:
+            status = await self.stream(messages, writer, encode, cancelled)
+            await send_json({"type": status})
+
+        current: Optional[Tuple[asyncio.Task, asyncio.Future]] = None
+        try:
+            while True:
+                opcode, data = await read_websocket_message(reader)
+                if opcode == 0x8:
+                    await self._write(writer, websocket_frame(0x8, data[:2]))
+                    return
+                if opcode == 0x9:
+                    await self._write(writer, websocket_frame(0xA, data))
+                    continue
+                if opcode != 0x1:
+                    continue
+                try:
+                    payload = json.loads(data)
+                    messages = None if payload.get("type") == "cancel" else self.messages(payload)
+                except (json.JSONDecodeError, ValueError, AttributeError, HTTPError):
+                    await send_json({"type": "error", "message": "invalid request"})
+                    continue
+                # 新しい質問かキャンセルが来たら、生成中の回答は打ち切る
+                if current is not None and not current[0].done():
+                    current[1].set_result(None)
+                    await current[0]
+                if messages is not None:
+                    cancelled = asyncio.get_running_loop().create_future()
+                    current = (asyncio.create_task(answer(messages, cancelled)), cancelled)
+        finally:
+            if current is not None and not current[0].done():
+                current[1].set_result(None)
+                await asyncio.gather(current[0], return_exceptions=True)
+
+
+# --- 負荷試験 ---
+
+class FakeStreamingChatModel(BaseChatModel):
+    """一定間隔でトークンを返す、負荷試験用のチャットモデル"""
+    tokens: int = 50
+    interval: float = 0.02
+    upstream_cancelled: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = "".join(f"token{i} " for i in range(self.tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        try:
+            for i in range(self.tokens):
+                await asyncio.sleep(self.interval)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=f"token{i} "))
+        except (asyncio.CancelledError, GeneratorExit):
+            self.upstream_cancelled += 1
+            raise
+
+
+async def sse_client(host: str, port: int, text: str, read_events: Optional[int] = None) -> Dict[str, Any]:
+    """1本の SSE ストリームを受信し、最初のイベントまでの秒数・全体の秒数・イベント数・終わり方を返す
+
+    read_events を指定すると、その数だけ受け取ったところで切断する（途中で離脱するクライアントの再現）。
+    """
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps({"input": text}).encode()
+    writer.write(
+        f"POST /chat/sse HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await reader.readuntil(b"\r\n\r\n")
+    first, events, status = None, 0, "closed"
+    try:
+        while True:
+            event = await reader.readuntil(b"\n\n")
+            if event.startswith(b"event: "):
+                status = event[7:event.index(b"\n")].decode()
+                break
+            events += 1
+            first = first or time.perf_counter() - start
+            if read_events is not None and events >= read_events:
+                status = "client_closed"
+                break
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        writer.close()
+    return {"ttfb_s": first or 0.0, "total_s": time.perf_counter() - start, "events": events, "status": status}
+
+
+def _run_clients(port: int, indices: range, cancel_ratio: float, results: "multiprocessing.Queue") -> None:
+    """別プロセスでクライアントを動かし、サーバープロセスの負荷だけを測れるようにする"""
+    raise_fd_limit()
+    cancel_every = round(1 / cancel_ratio) if cancel_ratio else 0
+
+    async def run() -> List[Any]:
+        return await asyncio.gather(*(
+            sse_client("127.0.0.1", port, f"question {i}", 3 if cancel_every and i % cancel_every == 0 else None)
+            for i in indices
+        ), return_exceptions=True)
+
+    results.put([r if isinstance(r, dict) else {"status": f"failed: {r!r}"} for r in asyncio.run(run())])
+
+
+def raise_fd_limit() -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+async def load_test(
+    streams: int,
+    tokens: int,
+    interval: float,
+    cancel_ratio: float,
+    flush_interval: float,
+    client_processes: int = 1,
+) -> Dict[str, Any]:
+    fd_limit = raise_fd_limit()
+    model = FakeStreamingChatModel(tokens=tokens, interval=interval)
+    server = ChatServer(model, flush_interval=flush_interval)
+    listener = await server.start("127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+
+    results: multiprocessing.Queue = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(target=_run_clients, args=(port, range(i, streams, client_processes), cancel_ratio, results))
+        for i in range(client_processes)
+    ]
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    for process in clients:
+        process.start()
+    records: List[Dict[str, Any]] = []
+    peak = 0
+    while len(records) < streams:
+        if results.empty():
+            peak = max(peak, server.stats.active_streams)
+            await asyncio.sleep(0.05)
+            continue
+        records.extend(results.get())
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    for process in clients:
+        process.join()
+    # 切断を検知したサーバー側のキャンセルが終わるのを待つ
+    while server.stats.active_streams:
+        await asyncio.sleep(0.01)
+    listener.close()
+    await listener.wait_closed()
+
+    done = [r for r in records if r["status"] == "done"]
+    ttfb = sorted(r["ttfb_s"] for r in done)
+    total = sorted(r["total_s"] for r in done)
+
+    def pct(values: List[float], p: float) -> float:
+        return round(values[min(int(len(values) * p / 100), len(values) - 1)], 3) if values else 0.0
+
+    return {
+        "streams": streams,
+        "fd_limit": fd_limit,
+        "peak_concurrent_streams": peak,
+        "elapsed_s": round(elapsed, 3),
+        "server_cpu_s": round(cpu, 3),
+        # サーバープロセスが CPU 1秒あたりに中継できたチャンク数（モデル層の処理を含む）
+        "chunks_per_cpu_s": round(server.stats.chunks / cpu) if cpu else 0,
+        "client_done": len(done),
+        "client_closed": sum(r["status"] == "client_closed" for r in records),
+        "client_failures": sum(r["status"].startswith("failed") for r in records),
+        "ideal_stream_s": round(tokens * interval, 3),
+        "ttfb_s": {"p50": pct(ttfb, 50), "p99": pct(ttfb, 99)},
+        "total_s": {"p50": pct(total, 50), "p99": pct(total, 99)},
+        "upstream_cancelled": model.upstream_cancelled,
+        "server": server.stats.to_dict(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="チャットモデルのストリームを SSE / WebSocket で配信する")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--model", default="gpt-4o-mini")
+    load = sub.add_parser("loadtest", help="偽のストリーミングモデルで同時接続数を試す")
+    load.add_argument("--streams", type=int, default=2000)
+    load.add_argument("--tokens", type=int, default=50)
+    load.add_argument("--interval", type=float, default=0.02, help="トークンの間隔（秒）")
+    load.add_argument("--cancel-ratio", type=float, default=0.1, help="途中で切断するクライアントの割合")
+    load.add_argument("--flush-interval", type=float, default=0.05)
+    load.add_argument("--client-processes", type=int, default=max((os.cpu_count() or 2) // 2, 1), help="クライアントを動かすプロセス数")
+    args = parser.parse_args()
+
+    if args.command == "loadtest":
+        report = asyncio.run(load_test(
+            args.streams, args.tokens, args.interval, args.cancel_ratio, args.flush_interval, args.client_processes,
+        ))
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    from client_factory import get_chat_model
+
+    async def serve_forever() -> None:
+        server = ChatServer(get_chat_model(args.model, temperature=0), args.model)
+        listener = await server.start(args.host, args.port)
+        print(f"listening on http://{args.host}:{args.port} (POST /chat/sse, GET /chat/ws, GET /stats)")
+        async with listener:
+            await listener.serve_forever()
+
+    asyncio.run(serve_forever())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,487 @@
+import asyncio
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+# 差分の連鎖がこの長さに達したら、メッセージ一覧をまるごと保存し直す
+SNAPSHOT_INTERVAL = 16
+LIST_PAGE_SIZE = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    hash TEXT PRIMARY KEY, type TEXT NOT NULL, payload BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, checkpoint_id TEXT NOT NULL,
+    parent_id TEXT, type TEXT NOT NULL, checkpoint BLOB NOT NULL, metadata_type TEXT NOT NULL, metadata BLOB NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, channel TEXT NOT NULL, version TEXT NOT NULL,
+    kind TEXT NOT NULL, type TEXT, base_version TEXT, depth INTEGER NOT NULL DEFAULT 0, payload BLOB,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL, idx INTEGER NOT NULL, channel TEXT NOT NULL, type TEXT NOT NULL, payload BLOB NOT NULL,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+"""
+
+
+def _pack(data: bytes) -> bytes:
+    return zlib.compress(data, 6)
+
+
+def _unpack(data: bytes) -> bytes:
+    return zlib.decompress(data)
+
+
+class CompactingSqliteSaver(BaseCheckpointSaver[str]):
+    """SQLite に保存する、メッセージの重複を持たないチェックポインタ
+
+    メッセージはハッシュをキーに一度だけ保存し、メッセージのリストを持つチャネルは
+    直前のバージョンからの追加分（ハッシュの列）だけを保存する。ほかのチャネルの値とチェックポイント本体は zlib で圧縮する。
+    """
+    def __init__(self, path: str = "checkpoints.sqlite3", *, serde: Any = None, head_cache_size: int = 1024):
+        super().__init__(serde=serde)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        # (thread_id, checkpoint_ns, channel) -> (version, hashes, depth, messages)。直前のリストを読み直さずに差分を取るため
+        self._heads: "OrderedDict[Tuple[str, str, str], Tuple[str, List[str], int, List[BaseMessage]]]" = OrderedDict()
+        self._head_cache_size = head_cache_size
+
+    # --- 値の保存と復元 ---
+
+    def _dumps(self, value: Any) -> Tuple[str, bytes]:
+        type_, data = self.serde.dumps_typed(value)
+        return type_, _pack(data)
+
+    def _loads(self, type_: str, payload: bytes) -> Any:
+        return self.serde.loads_typed((type_, _unpack(payload)))
+
+    def _store_messages(self, messages: List[BaseMessage]) -> List[str]:
+        hashes, rows = [], []
+        for message in messages:
+            type_, data = self.serde.dumps_typed(message)
+            digest = hashlib.sha256(type_.encode() + b"\0" + data).hexdigest()
+            hashes.append(digest)
+            rows.append((digest, type_, _pack(data)))
+        self._conn.executemany("INSERT OR IGNORE INTO messages (hash, type, payload) VALUES (?, ?, ?)", rows)
+        return hashes
+
+    def _load_messages(self, hashes: List[str]) -> List[BaseMessage]:
+        found: Dict[str, BaseMessage] = {}
+        unique = list(dict.fromkeys(hashes))
+        for start in range(0, len(unique), 500):
+            part = unique[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            for digest, type_, payload in self._conn.execute(
+                f"SELECT hash, type, payload FROM messages WHERE hash IN ({placeholders})", part
+            ):
+                found[digest] = self._loads(type_, payload)
+        return [found[h] for h in hashes]
+
+    def _load_hashes(self, thread_id: str, checkpoint_ns: str, channel: str, version: str) -> Optional[Tuple[List[str], int]]:
+        """差分を base_version までたどってハッシュ列を組み立てる"""
+        chain: List[List[str]] = []
+        depth = None
+        while version is not None:
+            row = self._conn.execute(
+                "SELECT kind, base_version, depth, payload FROM blobs"
+                " WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, version),
+            ).fetchone()
+            if row is None or row[0] not in ("list", "delta"):
+                return None
+            kind, base_version, row_depth, payload = row
+            depth = row_depth if depth is None else depth
+            chain.append(json.loads(_unpack(payload)))
+            version = base_version if kind == "delta" else None
+        return [h for part in reversed(chain) for h in part], depth
+
+    def _remember_head(self, key: Tuple[str, str, str], version: str, hashes: List[str], depth: int, messages: List[BaseMessage]) -> None:
+        self._heads[key] = (version, hashes, depth, list(messages))
+        self._heads.move_to_end(key)
+        while len(self._heads) > self._head_cache_size:
+            self._heads.popitem(last=False)
+
+    def _previous_head(self, thread_id: str, checkpoint_ns: str, channel: str) -> Optional[Tuple[str, List[str], int, List[BaseMessage]]]:
+        key = (thread_id, checkpoint_ns, channel)
+        if key in self._heads:
+            return self._heads[key]
+        row = self._conn.execute(
+            "SELECT version FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND kind IN ('list', 'delta')"
+            " ORDER BY version DESC LIMIT 1",
+            (thread_id, checkpoint_ns, channel),
+        ).fetchone()
+        if row is None:
+            return None
+        loaded = self._load_hashes(thread_id, checkpoint_ns, channel, row[0])
+        return (row[0], *loaded, []) if loaded else None
+
+    def _put_blob(self, thread_id: str, checkpoint_ns: str, channel: str, version: str, value: Any) -> None:
+        key = (thread_id, checkpoint_ns, channel)
+        insert = (
+            "INSERT OR REPLACE INTO blobs (thread_id, checkpoint_ns, channel, version, kind, type, base_version, depth, payload)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        )
+        if isinstance(value, list) and value and all(isinstance(m, BaseMessage) for m in value):
+            previous = self._previous_head(thread_id, checkpoint_ns, channel)
+            if previous and previous[3] and len(previous[3]) <= len(value) and all(a is b for a, b in zip(previous[3], value)):
+                # 前回と同じオブジェクトが先頭に並んでいれば、追加分だけをシリアライズする
+                hashes = previous[1] + self._store_messages(value[len(previous[3]):])
+            else:
+                hashes = self._store_messages(value)
+            # 追記だけなら差分として保存する（上書き・削除を含む更新は全体を保存する）
+            if previous and previous[2] + 1 < SNAPSHOT_INTERVAL and hashes[: len(previous[1])] == previous[1]:
+                prev_version, prev_hashes, prev_depth, _ = previous
+                payload = _pack(json.dumps(hashes[len(prev_hashes):]).encode())
+                self._conn.execute(insert, (*key, version, "delta", None, prev_version, prev_depth + 1, payload))
+                self._remember_head(key, version, hashes, prev_depth + 1, value)
+            else:
+                payload = _pack(json.dumps(hashes).encode())
+                self._conn.execute(insert, (*key, version, "list", None, None, 0, payload))
+                self._remember_head(key, version, hashes, 0, value)
+        else:
+            type_, payload = self._dumps(value)
+            self._conn.execute(insert, (*key, version, "value", type_, None, 0, payload))
+
+    def _load_channel_values(self, thread_id: str, checkpoint_ns: str, versions: ChannelVersions) -> Dict[str, Any]:
+        values: Dict[str, Any] = {}
+        for channel, version in versions.items():
+            row = self._conn.execute(
+                "SELECT kind, type, payload FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, str(version)),
+            ).fetchone()
+            if row is None or row[0] == "empty":
+                continue
+            if row[0] == "value":
+                values[channel] = self._loads(row[1], row[2])
+            else:
+                hashes, depth = self._load_hashes(thread_id, checkpoint_ns, channel, str(version))
+                values[channel] = self._load_messages(hashes)
+                head = self._heads.get((thread_id, checkpoint_ns, channel))
+                if head is None or head[0] == str(version):
+                    # 次の put で、読み込んだオブジェクトとの同一性から追加分を判定できるようにする
+                    self._remember_head((thread_id, checkpoint_ns, channel), str(version), hashes, depth, values[channel])
+        return values
+
+    def _pending_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> List[Tuple[str, str, Any]]:
+        rows = self._conn.execute(
+            "SELECT task_id, channel, type, payload FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?"
+            " ORDER BY task_path, task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        )
+        return [(task_id, channel, self._loads(type_, payload)) for task_id, channel, type_, payload in rows]
+
+    def _to_tuple(self, thread_id: str, checkpoint_ns: str, row: Tuple) -> CheckpointTuple:
+        checkpoint_id, parent_id, type_, checkpoint_blob, metadata_type, metadata_blob = row
+        checkpoint: Checkpoint = self._loads(type_, checkpoint_blob)
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint={
+                **checkpoint,
+                "channel_values": self._load_channel_values(thread_id, checkpoint_ns, checkpoint["channel_versions"]),
+            },
+            metadata=self._loads(metadata_type, metadata_blob),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}}
+                if parent_id
+                else None
+            ),
+            pending_writes=self._pending_writes(thread_id, checkpoint_ns, checkpoint_id),
+        )
+
+    # --- BaseCheckpointSaver ---
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        columns = "checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata"
+        with self._lock:
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self._conn.execute(
+                    f"SELECT {columns} FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                    (thread_id, checkpoint_ns, checkpoint_id),
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    f"SELECT {columns} FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+                    " ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns),
+                ).fetchone()
+            return self._to_tuple(thread_id, checkpoint_ns, row) if row else None
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        conditions, params = [], []
+        if config:
+            conditions.append("thread_id = ?")
+            params.append(str(config["configurable"]["thread_id"]))
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                conditions.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                conditions.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            conditions.append("checkpoint_id < ?")
+            params.append(before_id)
+
+        # キーセット方式で LIST_PAGE_SIZE 件ずつ読み、全件をメモリに載せない
+        cursor: Optional[Tuple[str, str, str]] = None
+        while limit is None or limit > 0:
+            where = list(conditions)
+            page_params = list(params)
+            if cursor:
+                where.append("(thread_id, checkpoint_ns, checkpoint_id) < (?, ?, ?)")
+                page_params.extend(cursor)
+            sql = (
+                "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata"
+                " FROM checkpoints" + (" WHERE " + " AND ".join(where) if where else "")
+                + " ORDER BY thread_id DESC, checkpoint_ns DESC, checkpoint_id DESC LIMIT ?"
+            )
+            with self._lock:
+                rows = self._conn.execute(sql, (*page_params, LIST_PAGE_SIZE)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                thread_id, checkpoint_ns = row[0], row[1]
+                cursor = (thread_id, checkpoint_ns, row[2])
+                if filter:
+                    metadata = self._loads(row[6], row[7])
+                    if not all(metadata.get(k) == v for k, v in filter.items()):
+                        continue
+                with self._lock:
+                    item = self._to_tuple(thread_id, checkpoint_ns, row[2:])
+                yield item
+                if limit is not None:
+                    limit -= 1
+                    if limit <= 0:
+                        return
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        c = checkpoint.copy()
+        values: Dict[str, Any] = c.pop("channel_values")
+        with self._lock:
+            for channel, version in new_versions.items():
+                if channel in values:
+                    self._put_blob(thread_id, checkpoint_ns, channel, str(version), values[channel])
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO blobs (thread_id, checkpoint_ns, channel, version, kind) VALUES (?, ?, ?, ?, 'empty')",
+                        (thread_id, checkpoint_ns, channel, str(version)),
+                    )
+            type_, checkpoint_blob = self._dumps(c)
+            metadata_type, metadata_blob = self._dumps(get_checkpoint_metadata(config, metadata))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                    type_, checkpoint_blob, metadata_type, metadata_blob,
+                ),
+            )
+            self._conn.commit()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # 通常の書き込みは最初のものを残し、特殊な書き込み（エラーや割り込みなど）は上書きする
+        regular, special = [], []
+        for idx, (channel, value) in enumerate(writes):
+            type_, payload = self._dumps(value)
+            row = (thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx), channel, type_, payload, task_path)
+            (special if channel in WRITES_IDX_MAP else regular).append(row)
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", regular)
+            self._conn.executemany("INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", special)
+            self._conn.commit()
+
+    def delete_thread(self, thread_id: str) -> None:
+        thread_id = str(thread_id)
+        with self._lock:
+            for table in ("checkpoints", "blobs", "writes"):
+                self._conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+            self._conn.commit()
+            for key in [k for k in self._heads if k[0] == thread_id]:
+                del self._heads[key]
+
+    def prune(self, thread_ids: Sequence[str], *, strategy: str = "keep_latest") -> None:
+        if strategy == "delete":
+            for thread_id in thread_ids:
+                self.delete_thread(thread_id)
+        elif strategy == "keep_latest":
+            self.compact(thread_ids, keep_last=1)
+        else:
+            raise ValueError(f"Unknown prune strategy: {strategy}")
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        # 文字列の大小がバージョンの新旧と一致するよう、ゼロ埋めした連番を先頭に置く
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    # --- 圧縮 ---
+
+    def compact(self, thread_ids: Optional[Sequence[str]] = None, keep_last: int = 20) -> Dict[str, int]:
+        """スレッドごとに新しい keep_last 件だけを残し、参照されなくなった値とメッセージを削除する
+
+        スレッドごと消すときは delete_thread を使う。
+        """
+        if keep_last < 1:
+            raise ValueError(f"keep_last must be at least 1, got {keep_last}")
+        with self._lock:
+            if thread_ids is None:
+                thread_ids = [row[0] for row in self._conn.execute("SELECT DISTINCT thread_id FROM checkpoints")]
+            removed = {"checkpoints": 0, "blobs": 0, "writes": 0, "messages": 0}
+
+            for thread_id in map(str, thread_ids):
+                namespaces = [row[0] for row in self._conn.execute(
+                    "SELECT DISTINCT checkpoint_ns FROM checkpoints WHERE thread_id = ?", (thread_id,)
+                )]
+                for checkpoint_ns in namespaces:
+                    removed_here = self._compact_namespace(thread_id, checkpoint_ns, keep_last)
+                    for key, count in removed_here.items():
+                        removed[key] += count
+                for key in [k for k in self._heads if k[0] == thread_id]:
+                    del self._heads[key]
+
+            # どのリストからも参照されないメッセージを消す
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS live_hashes (hash TEXT PRIMARY KEY)")
+            self._conn.execute("DELETE FROM live_hashes")
+            for (payload,) in self._conn.execute("SELECT payload FROM blobs WHERE kind IN ('list', 'delta')").fetchall():
+                self._conn.executemany("INSERT OR IGNORE INTO live_hashes VALUES (?)", [(h,) for h in json.loads(_unpack(payload))])
+            removed["messages"] = self._conn.execute(
+                "DELETE FROM messages WHERE hash NOT IN (SELECT hash FROM live_hashes)"
+            ).rowcount
+            self._conn.commit()
+            return removed
+
+    def _compact_namespace(self, thread_id: str, checkpoint_ns: str, keep_last: int) -> Dict[str, int]:
+        rows = self._conn.execute(
+            "SELECT checkpoint_id, type, checkpoint FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+            " ORDER BY checkpoint_id DESC",
+            (thread_id, checkpoint_ns),
+        ).fetchall()
+        kept, dropped = rows[:keep_last], [row[0] for row in rows[keep_last:]]
+        if not dropped:
+            return {}
+
+        # 残すチェックポイントが参照する値と、その差分がたどる base をすべて残す
+        live: set[Tuple[str, str]] = set()
+        for _, type_, blob in kept:
+            for channel, version in self._loads(type_, blob)["channel_versions"].items():
+                version = str(version)
+                while version is not None and (channel, version) not in live:
+                    live.add((channel, version))
+                    row = self._conn.execute(
+                        "SELECT base_version FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                        (thread_id, checkpoint_ns, channel, version),
+                    ).fetchone()
+                    version = row[0] if row else None
+
+        removed = {"checkpoints": len(dropped), "writes": 0, "blobs": 0}
+        for start in range(0, len(dropped), 500):
+            part = dropped[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            for table in ("checkpoints", "writes"):
+                cursor = self._conn.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id IN ({placeholders})",
+                    (thread_id, checkpoint_ns, *part),
+                )
+                if table == "writes":
+                    removed["writes"] += cursor.rowcount
+
+        oldest = kept[-1][0]
+        self._conn.execute(
+            "UPDATE checkpoints SET parent_id = NULL WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+            (thread_id, checkpoint_ns, oldest),
+        )
+        for channel, version in self._conn.execute(
+            "SELECT channel, version FROM blobs WHERE thread_id = ? AND checkpoint_ns = ?", (thread_id, checkpoint_ns)
+        ).fetchall():
+            if (channel, version) not in live:
+                self._conn.execute(
+                    "DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                    (thread_id, checkpoint_ns, channel, version),
+                )
+                removed["blobs"] += 1
+        return removed
+
+    # --- 非同期版（SQLite の呼び出しは別スレッドで行う） ---
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        items = self.list(config, filter=filter, before=before, limit=limit)
+        while (item := await asyncio.to_thread(next, items, None)) is not None:
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    async def aprune(self, thread_ids: Sequence[str], *, strategy: str = "keep_latest") -> None:
+        await asyncio.to_thread(self.prune, thread_ids, strategy=strategy)
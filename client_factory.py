@@ -0,0 +1,220 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from langchain_openai import ChatOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+from pydantic import SecretStr
+
+# keep-alive を長めに取り、短いリクエストでも TLS ハンドシェイクを使い回す
+POOL_LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=50,
+    keepalive_expiry=120.0,
+)
+DEFAULT_TIMEOUT = 60.0
+
+
+@dataclass
+class PoolStats:
+    """クライアント・コネクションの再利用状況"""
+    client_hits: int = 0
+    clients_created: int = 0
+    requests: int = 0
+    connections_opened: int = 0
+
+    @property
+    def connections_reused(self) -> int:
+        return max(self.requests - self.connections_opened, 0)
+
+    def to_dict(self) -> Dict[str, int]:
+        return {**asdict(self), "connections_reused": self.connections_reused}
+
+
+stats = PoolStats()
+_lock = threading.Lock()
+_cache: Dict[Tuple[Any, ...], Any] = {}
+_http_clients: Dict[str, httpx.Client | httpx.AsyncClient] = {}
+
+
+def _count(field: str) -> None:
+    with _lock:
+        setattr(stats, field, getattr(stats, field) + 1)
+
+
+def _on_connection_event(event_name: str) -> None:
+    if event_name == "connection.connect_tcp.complete":
+        _count("connections_opened")
+
+
+def _on_request(request: httpx.Request) -> None:
+    _count("requests")
+    request.extensions["trace"] = lambda event_name, info: _on_connection_event(event_name)
+
+
+async def _aon_request(request: httpx.Request) -> None:
+    _count("requests")
+
+    async def trace(event_name: str, info: Dict[str, Any]) -> None:
+        _on_connection_event(event_name)
+
+    request.extensions["trace"] = trace
+
+
+def get_http_client() -> httpx.Client:
+    """プロセス共通の同期 HTTP クライアント（コネクションプール）を返す"""
+    with _lock:
+        if "sync" not in _http_clients:
+            _http_clients["sync"] = DefaultHttpxClient(
+                limits=POOL_LIMITS,
+                event_hooks={"request": [_on_request]},
+            )
+        return _http_clients["sync"]
+
+
+class _LoopLocalTransport(httpx.AsyncBaseTransport):
+    """実行中のイベントループごとに別のコネクションプールを使うトランスポート
+
+    非同期のコネクションはループに紐づくため、asyncio.run を何度も呼ぶスクリプトで
+    前のループのコネクションを使い回さないようにする。閉じたループのプールはループと一緒に捨てる。
+    """
+    def __init__(self, limits: httpx.Limits):
+        self.limits = limits
+        self._transports: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+
+    def _transport(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._transports.get(loop)
+            if transport is None:
+                transport = self._transports[loop] = httpx.AsyncHTTPTransport(limits=self.limits)
+            return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._transport().handle_async_request(request)
+
+    async def aclose(self) -> None:
+        with self._lock:
+            transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """プロセス共通の非同期 HTTP クライアントを返す（コネクションプールはイベントループごと）"""
+    with _lock:
+        if "async" not in _http_clients:
+            _http_clients["async"] = DefaultAsyncHttpxClient(
+                transport=_LoopLocalTransport(POOL_LIMITS),
+                event_hooks={"request": [_aon_request]},
+            )
+        return _http_clients["async"]
+
+
+def _get_or_create(key: Tuple[Any, ...], factory) -> Any:
+    with _lock:
+        client = _cache.get(key)
+        if client is not None:
+            stats.client_hits += 1
+            return client
+
+    # コンストラクタは重いのでロックの外で実行し、競合時は先勝ちにする
+    client = factory()
+    with _lock:
+        if key in _cache:
+            stats.client_hits += 1
+            return _cache[key]
+        _cache[key] = client
+        stats.clients_created += 1
+        return client
+
+
+def get_openai_client(
+    api_key: Optional[str] = None,
+    timeout: float = DEFAULT_TIMEOUT,
+    base_url: Optional[str] = None,
+) -> OpenAI:
+    """共有プールを使う OpenAI クライアントを返す"""
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    key = ("openai", api_key, timeout, base_url)
+    return _get_or_create(
+        key,
+        lambda: OpenAI(api_key=api_key, timeout=timeout, base_url=base_url, http_client=get_http_client()),
+    )
+
+
+def get_async_openai_client(
+    api_key: Optional[str] = None,
+    timeout: float = DEFAULT_TIMEOUT,
+    base_url: Optional[str] = None,
+) -> AsyncOpenAI:
+    """共有プールを使う AsyncOpenAI クライアントを返す"""
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    key = ("async_openai", api_key, timeout, base_url)
+    return _get_or_create(
+        key,
+        lambda: AsyncOpenAI(api_key=api_key, timeout=timeout, base_url=base_url, http_client=get_async_http_client()),
+    )
+
+
+def get_chat_model(
+    model: str,
+    temperature: float = 0.0,
+    timeout: Optional[float] = None,
+    base_url: Optional[str] = None,
+    **kwargs: Any,
+) -> ChatOpenAI:
+    """共有プールを使う ChatOpenAI を返す
+
+    同じ設定の呼び出しには同じインスタンスを返すので、ノードやチェーンの中で毎回呼んでよい。
+    """
+    # SecretStr の repr は値を伏せるので、api_key は中身でキーにする（省略時は環境変数の値）
+    api_key = kwargs.get("api_key") or os.getenv("OPENAI_API_KEY")
+    if isinstance(api_key, SecretStr):
+        api_key = api_key.get_secret_value()
+    options = tuple(sorted((k, repr(v)) for k, v in kwargs.items() if k != "api_key"))
+    key = ("chat_openai", model, temperature, timeout, base_url, api_key, options)
+    return _get_or_create(
+        key,
+        lambda: ChatOpenAI(
+            model=model,
+            temperature=temperature,
+            timeout=timeout,
+            base_url=base_url,
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client(),
+            **kwargs,
+        ),
+    )
+
+
+def measure_latency(n: int = 20) -> None:
+    """共有クライアントと毎回生成するクライアントで短いリクエストの p50 を比較する"""
+    def p50(samples: list[float]) -> float:
+        return sorted(samples)[len(samples) // 2] * 1000
+
+    fresh, pooled = [], []
+    for _ in range(n):
+        start = time.perf_counter()
+        OpenAI().models.list()
+        fresh.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        get_openai_client().models.list()
+        pooled.append(time.perf_counter() - start)
+
+    print(f"p50 fresh client : {p50(fresh):.1f} ms")
+    print(f"p50 pooled client: {p50(pooled):.1f} ms")
+    print(stats.to_dict())
+
+
+if __name__ == "__main__":
+    measure_latency()
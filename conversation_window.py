@@ -0,0 +1,112 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+
+from rate_limiter import message_tokens
+
+SUMMARY_PROMPT = """以下はユーザーとアシスタントの会話の要約と、その続きの会話です。
+続きの会話の内容を取り込んで要約を更新してください。ユーザーの好みや約束した事柄など、後の応答に必要な情報は必ず残してください。
+
+これまでの要約:
+{summary}
+
+続きの会話:
+{conversation}
+
+更新した要約:"""
+
+
+def merge_summary(current: Tuple[str, int], update: Tuple[str, int]) -> Tuple[str, int]:
+    """(要約, 要約済みのメッセージ数) のうち、より先まで要約している方を残すリデューサ
+
+    入力の State が既定値で上書きしても、要約が巻き戻らないようにする。
+    """
+    if not current or update[1] >= current[1]:
+        return tuple(update)
+    return tuple(current)
+
+
+def system_prefix_length(messages: Sequence[BaseMessage]) -> int:
+    """先頭に連続する SystemMessage の数を返す"""
+    n = 0
+    while n < len(messages) and isinstance(messages[n], SystemMessage):
+        n += 1
+    return n
+
+
+def window_start(messages: Sequence[BaseMessage], max_tokens: int, start: int = 0) -> int:
+    """末尾から max_tokens に収まる範囲の先頭インデックスを返す
+
+    先頭の SystemMessage と start より前のメッセージは対象外。最後のメッセージは予算を超えても必ず含め、
+    ターンの途中から始まらないよう先頭は HumanMessage に揃える。
+    """
+    start = max(start, system_prefix_length(messages))
+    if start >= len(messages):
+        return len(messages)
+
+    index = len(messages) - 1
+    used = message_tokens(messages[index])
+    while index > start and used + message_tokens(messages[index - 1]) <= max_tokens:
+        index -= 1
+        used += message_tokens(messages[index])
+
+    while index < len(messages) - 1 and not isinstance(messages[index], HumanMessage):
+        index += 1
+    return index
+
+
+def build_prompt(messages: Sequence[BaseMessage], summary: str, start: int) -> List[BaseMessage]:
+    """システムメッセージ・要約・直近のメッセージからモデルに渡すメッセージ列を作る"""
+    prefix = system_prefix_length(messages)
+    prompt = list(messages[:prefix])
+    if summary:
+        prompt.append(SystemMessage(content=f"これまでの会話の要約:\n{summary}"))
+    prompt.extend(messages[max(start, prefix):])
+    return prompt
+
+
+class RollingSummarizer:
+    """スレッドごとの会話要約をバックグラウンドで更新するサービス
+
+    submit した要約はリクエストの処理とは別のスレッドで作られ、次のターンで collect したときに完了していれば反映される。
+    """
+    def __init__(self, model_factory: Callable[[], BaseChatModel], max_workers: int = 2):
+        self.model_factory = model_factory
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        self._jobs: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _summarize(self, summary: str, messages: Sequence[BaseMessage], upto: int) -> Tuple[str, int]:
+        prompt = SUMMARY_PROMPT.format(summary=summary or "（なし）", conversation=get_buffer_string(messages))
+        response = self.model_factory().invoke(prompt)
+        return str(response.content).strip(), upto
+
+    def submit(self, thread_id: str, summary: str, messages: Sequence[BaseMessage], upto: int) -> bool:
+        """要約の更新を予約する。同じスレッドの要約が実行中なら何もしない"""
+        with self._lock:
+            job = self._jobs.get(thread_id)
+            if job is not None and not job.done():
+                return False
+            self._jobs[thread_id] = self._executor.submit(self._summarize, summary, list(messages), upto)
+            return True
+
+    def collect(self, thread_id: str) -> Optional[Tuple[str, int]]:
+        """完了した要約があれば (要約, 要約済みのメッセージ数) を返す。待たずに戻る"""
+        with self._lock:
+            job = self._jobs.get(thread_id)
+            if job is None or not job.done():
+                return None
+            del self._jobs[thread_id]
+        if job.exception() is not None:
+            # 要約に失敗しても会話は続けられるので、次のターンで作り直す
+            return None
+        return job.result()
+
+    def wait(self, thread_id: str, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            job = self._jobs.get(thread_id)
+        if job is not None:
+            job.exception(timeout=timeout)
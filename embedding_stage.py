@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from rate_limiter import text_tokens
+
+
+@dataclass
+class EmbeddingStats:
+    """埋め込みステージの処理状況"""
+    requested: int = 0
+    unique: int = 0
+    hits: int = 0
+    embedded: int = 0
+    batches: int = 0
+    embed_seconds: float = 0.0
+    started_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.unique if self.unique else 0.0
+
+    @property
+    def embeddings_per_s(self) -> float:
+        # キャッシュから返した分も含めた、呼び出し元から見たスループット
+        elapsed = time.perf_counter() - self.started_at
+        return self.requested / elapsed if elapsed else 0.0
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data.pop("started_at")
+        return {
+            **data,
+            "embed_seconds": round(self.embed_seconds, 3),
+            "hit_rate": round(self.hit_rate, 4),
+            "embeddings_per_s": round(self.embeddings_per_s, 2),
+        }
+
+
+class EmbeddingCache:
+    """内容ハッシュをキーに埋め込みベクトルを保存する SQLite キャッシュ
+
+    キーはモデル名とテキストだけから決まるので、ブランチやリポジトリをまたいでも同じ段落は再利用される。
+    （検索クエリのベクトルは CachedBatchEmbedder が別のキーで保存する）
+    """
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            # SQLite のプレースホルダ数の上限に収まるよう分割する
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                for key, blob in self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part):
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()],
+            )
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+class CachedBatchEmbedder(Embeddings):
+    """キャッシュ・重複排除・トークン数でのバッチ化を行う Embeddings のラッパー
+
+    未キャッシュのテキストだけを max_batch_tokens に収まるバッチに詰め、max_concurrency 本まで並行して埋め込む。
+    """
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        cache_path: str,
+        model: Optional[str] = None,
+        max_batch_tokens: int = 8000,
+        max_batch_size: int = 256,
+        max_concurrency: int = 4,
+    ):
+        self.embeddings = embeddings
+        self.cache = EmbeddingCache(cache_path)
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.stats = EmbeddingStats()
+        self._stats_lock = threading.Lock()
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def query_key(self, text: str) -> str:
+        # 非対称なモデルでは同じテキストでも文書とクエリでベクトルが違うので、キーを分ける
+        return hashlib.sha256(f"{self.model}\0query\0{text}".encode("utf-8")).hexdigest()
+
+    def batches(self, texts: List[str]) -> Iterator[List[str]]:
+        """テキストを合計トークン数と件数の上限に収まるバッチに分ける"""
+        batch: List[str] = []
+        tokens = 0
+        for text in texts:
+            n = text_tokens(text)
+            if batch and (tokens + n > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                yield batch
+                batch, tokens = [], 0
+            batch.append(text)
+            tokens += n
+        if batch:
+            yield batch
+
+    def _lookup(self, texts: List[str]) -> tuple[Dict[str, str], Dict[str, List[float]], List[str]]:
+        """(テキスト→キー, キャッシュ済みのベクトル, 埋め込みが必要なテキスト) を返す"""
+        keys = {text: self.key(text) for text in dict.fromkeys(texts)}
+        cached = self.cache.get_many(list(keys.values()))
+        missing = [text for text, key in keys.items() if key not in cached]
+        with self._stats_lock:
+            self.stats.requested += len(texts)
+            self.stats.unique += len(keys)
+            self.stats.hits += len(keys) - len(missing)
+        return keys, cached, missing
+
+    def _store(self, keys: Dict[str, str], batch: List[str], vectors: List[List[float]], elapsed: float) -> Dict[str, List[float]]:
+        # キャッシュから返す値と一致するよう float32 に丸めておく
+        items = {keys[text]: np.asarray(vector, dtype=np.float32).tolist() for text, vector in zip(batch, vectors)}
+        self.cache.put_many(items)
+        with self._stats_lock:
+            self.stats.embedded += len(batch)
+            self.stats.batches += 1
+            self.stats.embed_seconds += elapsed
+        return items
+
+    def _embed_batch(self, keys: Dict[str, str], batch: List[str]) -> Dict[str, List[float]]:
+        start = time.perf_counter()
+        vectors = self.embeddings.embed_documents(batch)
+        return self._store(keys, batch, vectors, time.perf_counter() - start)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, missing = self._lookup(texts)
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                for items in executor.map(lambda batch: self._embed_batch(keys, batch), self.batches(missing)):
+                    vectors.update(items)
+        return [vectors[keys[text]] for text in texts]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, missing = await asyncio.to_thread(self._lookup, texts)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def embed(batch: List[str]) -> Dict[str, List[float]]:
+            async with semaphore:
+                start = time.perf_counter()
+                result = await self.embeddings.aembed_documents(batch)
+                return await asyncio.to_thread(self._store, keys, batch, result, time.perf_counter() - start)
+
+        for items in await asyncio.gather(*(embed(batch) for batch in self.batches(missing))):
+            vectors.update(items)
+        return [vectors[keys[text]] for text in texts]
+
+    def _cached_query(self, key: str) -> Optional[List[float]]:
+        vector = self.cache.get_many([key]).get(key)
+        with self._stats_lock:
+            self.stats.requested += 1
+            self.stats.unique += 1
+            self.stats.hits += vector is not None
+        return vector
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.query_key(text)
+        vector = self._cached_query(key)
+        if vector is None:
+            start = time.perf_counter()
+            result = self.embeddings.embed_query(text)
+            vector = self._store({text: key}, [text], [result], time.perf_counter() - start)[key]
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self.query_key(text)
+        vector = await asyncio.to_thread(self._cached_query, key)
+        if vector is None:
+            start = time.perf_counter()
+            result = await self.embeddings.aembed_query(text)
+            items = await asyncio.to_thread(self._store, {text: key}, [text], [result], time.perf_counter() - start)
+            vector = items[key]
+        return vector
+
+
+if __name__ == "__main__":
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    class SlowFakeEmbedding(DeterministicFakeEmbedding):
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            time.sleep(0.05)
+            return super().embed_documents(texts)
+
+    paragraphs = [f"段落 {i % 300}: " + "LangChain の埋め込みキャッシュの動作確認。" * 10 for i in range(1000)]
+    embedder = CachedBatchEmbedder(SlowFakeEmbedding(size=256), ":memory:", max_batch_tokens=4000)
+    embedder.embed_documents(paragraphs)
+    print("1回目:", embedder.stats.to_dict())
+
+    embedder.stats = EmbeddingStats()
+    embedder.embed_documents(paragraphs)
+    print("2回目:", embedder.stats.to_dict())
@@ -0,0 +1,363 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.tracers.context import register_configure_hook
+
+from sample_gpt import AIClient
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+@dataclass
+class Span:
+    """OpenTelemetry のスパンと同じ形のレコード"""
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str]
+    name: str
+    kind: str
+    start_time_unix_nano: int
+    end_time_unix_nano: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    status: str = "OK"
+
+    @property
+    def duration(self) -> float:
+        return (self.end_time_unix_nano - self.start_time_unix_nano) / 1e9
+
+
+SpanExporter = Callable[[Span], None]
+
+
+class InMemorySpanExporter:
+    def __init__(self) -> None:
+        self.spans: List[Span] = []
+
+    def __call__(self, span: Span) -> None:
+        self.spans.append(span)
+
+
+class JsonlSpanExporter:
+    """スパンを1行1 JSON でファイルに追記する"""
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __call__(self, span: Span) -> None:
+        line = json.dumps(asdict(span), ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+class MetricsRegistry:
+    """Prometheus のテキスト形式で出力できるカウンタとヒストグラム"""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = defaultdict(float)
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+        self._help: Dict[str, Tuple[str, str]] = {}
+
+    def inc(self, name: str, value: float = 1.0, help: str = "", **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ("counter", help))
+            self._counters[key] += value
+
+    def observe(self, name: str, value: float, help: str = "", **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ("histogram", help))
+            # バケットごとの件数 + [合計, 件数]
+            hist = self._histograms.setdefault(key, [0.0] * (len(LATENCY_BUCKETS) + 2))
+            index = bisect.bisect_left(LATENCY_BUCKETS, value)
+            if index < len(LATENCY_BUCKETS):
+                hist[index] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def render(self) -> str:
+        def fmt(labels: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+        lines: List[str] = []
+        with self._lock:
+            for name, (kind, help) in sorted(self._help.items()):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "counter":
+                    for (n, labels), value in sorted(self._counters.items()):
+                        if n == name:
+                            lines.append(f"{name}{fmt(labels)} {value}")
+                    continue
+                for (n, labels), hist in sorted(self._histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0.0
+                    for bound, count in zip(LATENCY_BUCKETS, hist):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{fmt(labels, (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', '+Inf'),))} {hist[-1]}")
+                    lines.append(f"{name}_sum{fmt(labels)} {hist[-2]}")
+                    lines.append(f"{name}_count{fmt(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+@dataclass
+class _Run:
+    span: Span
+    started_at: float
+    model: str = ""
+    first_token_at: Optional[float] = None
+    retries: int = 0
+
+
+class InstrumentationHandler(BaseCallbackHandler):
+    """モデル呼び出し・グラフノード・チェーンの各ステップを計測するコールバック
+
+    待ち時間（metadata の queue_time_s）、TTFT、レイテンシ、トークン数、リトライ回数を記録し、
+    スパンを exporter に渡しつつ Prometheus 用のメトリクスを更新する。
+    """
+    run_inline = True
+
+    def __init__(self, metrics: Optional[MetricsRegistry] = None, exporters: Optional[List[SpanExporter]] = None):
+        self.metrics = metrics or MetricsRegistry()
+        self.exporters = list(exporters or [])
+        self._lock = threading.Lock()
+        self._runs: Dict[UUID, _Run] = {}
+
+    # --- スパン管理 ---
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: str, kind: str, **attributes: Any) -> _Run:
+        with self._lock:
+            parent = self._runs.get(parent_run_id) if parent_run_id else None
+            trace_id = parent.span.trace_id if parent else run_id.hex
+            span = Span(
+                trace_id=trace_id,
+                span_id=run_id.hex[-16:],
+                parent_span_id=parent.span.span_id if parent else None,
+                name=name,
+                kind=kind,
+                start_time_unix_nano=time.time_ns(),
+                attributes={k: v for k, v in attributes.items() if v is not None},
+            )
+            run = self._runs[run_id] = _Run(span=span, started_at=time.perf_counter())
+            return run
+
+    def _finish(self, run_id: UUID, error: Optional[BaseException] = None) -> Optional[_Run]:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return None
+        run.span.end_time_unix_nano = time.time_ns()
+        if error is not None:
+            run.span.status = "ERROR"
+            run.span.attributes["error.type"] = type(error).__name__
+        for exporter in self.exporters:
+            exporter(run.span)
+        return run
+
+    # --- モデル ---
+
+    def _on_model_start(self, serialized: Dict[str, Any], run_id: UUID, parent_run_id: Optional[UUID], metadata: Optional[Dict[str, Any]], invocation_params: Optional[Dict[str, Any]]) -> None:
+        metadata = metadata or {}
+        params = invocation_params or {}
+        model = params.get("model_name") or params.get("model") or metadata.get("ls_model_name") or (serialized or {}).get("name", "unknown")
+        queue_time = metadata.get("queue_time_s")
+        run = self._start(run_id, parent_run_id, f"llm {model}", "llm", **{"llm.model": model, "llm.queue_time_s": queue_time})
+        run.model = model
+        if queue_time is not None:
+            self.metrics.observe("llm_queue_seconds", queue_time, "Time spent waiting for rate-limit budget", model=model)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, invocation_params=None, **kwargs) -> None:
+        self._on_model_start(serialized, run_id, parent_run_id, metadata, invocation_params)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, metadata=None, invocation_params=None, **kwargs) -> None:
+        self._on_model_start(serialized, run_id, parent_run_id, metadata, invocation_params)
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs) -> None:
+        run = self._runs.get(run_id)
+        if run is not None and run.first_token_at is None:
+            run.first_token_at = time.perf_counter()
+
+    def on_retry(self, retry_state, *, run_id, **kwargs) -> None:
+        run = self._runs.get(run_id)
+        if run is not None:
+            run.retries += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs) -> None:
+        run = self._finish(run_id)
+        if run is None:
+            return
+
+        latency = run.span.duration
+        attrs = run.span.attributes
+        attrs["llm.latency_s"] = latency
+        self.metrics.observe("llm_latency_seconds", latency, "Model call latency", model=run.model)
+        if run.first_token_at is not None:
+            ttft = run.first_token_at - run.started_at
+            attrs["llm.ttft_s"] = ttft
+            self.metrics.observe("llm_ttft_seconds", ttft, "Time to first token", model=run.model)
+        if run.retries:
+            attrs["llm.retries"] = run.retries
+            self.metrics.inc("llm_retries_total", run.retries, "Model call retries", model=run.model)
+
+        for kind, count in _token_usage(response).items():
+            attrs[f"llm.usage.{kind}_tokens"] = count
+            self.metrics.inc("llm_tokens_total", count, "Tokens used by model calls", model=run.model, type=kind)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        run = self._finish(run_id, error)
+        if run is not None:
+            self.metrics.inc("llm_errors_total", 1, "Failed model calls", model=run.model)
+
+    # --- ノード・チェーン ---
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs) -> None:
+        name = kwargs.get("name") or (serialized or {}).get("name") or "chain"
+        node = (metadata or {}).get("langgraph_node")
+        kind = "node" if node == name else "chain"
+        self._start(run_id, parent_run_id, name, kind, **{"langgraph.node": node if kind == "node" else None})
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs) -> None:
+        self._record_chain(self._finish(run_id))
+
+    def on_chain_error(self, error, *, run_id, **kwargs) -> None:
+        self._record_chain(self._finish(run_id, error))
+
+    def _record_chain(self, run: Optional[_Run]) -> None:
+        if run is None:
+            return
+        if run.retries:
+            run.span.attributes["retries"] = run.retries
+            self.metrics.inc("retries_total", run.retries, "Retried steps", step=run.span.name)
+        if run.span.kind == "node":
+            self.metrics.observe("graph_node_seconds", run.span.duration, "Graph node latency", node=run.span.name)
+        else:
+            self.metrics.observe("chain_step_seconds", run.span.duration, "Chain step latency", step=run.span.name)
+
+
+def _token_usage(response: LLMResult) -> Dict[str, int]:
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return {
+                    "prompt": usage.get("input_tokens", 0),
+                    "completion": usage.get("output_tokens", 0),
+                    "cached": (usage.get("input_token_details") or {}).get("cache_read", 0),
+                }
+
+    token_usage = (response.llm_output or {}).get("token_usage") or {}
+    if not token_usage:
+        return {}
+    return {
+        "prompt": token_usage.get("prompt_tokens", 0),
+        "completion": token_usage.get("completion_tokens", 0),
+        "cached": (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+    }
+
+
+class InstrumentedAIClient(AIClient):
+    """AIClient の呼び出しを計測するデコレータ（LangChain を使わない sample_gpt.py 用）"""
+    def __init__(self, ai_client: AIClient, handler: "InstrumentationHandler"):
+        self.ai_client = ai_client
+        self.handler = handler
+
+    def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        model = kwargs.get("model", "unknown")
+        start = time.perf_counter()
+        try:
+            response = self.ai_client.chat_completion(messages=messages, **kwargs)
+        except Exception:
+            self.handler.metrics.inc("llm_errors_total", 1, "Failed model calls", model=model)
+            raise
+
+        if kwargs.get("stream"):
+            return self._wrap_stream(response, model, start)
+
+        self.handler.metrics.observe("llm_latency_seconds", time.perf_counter() - start, "Model call latency", model=model)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            for kind, count in (
+                ("prompt", usage.prompt_tokens),
+                ("completion", usage.completion_tokens),
+                ("cached", getattr(details, "cached_tokens", None) or 0),
+            ):
+                self.handler.metrics.inc("llm_tokens_total", count, "Tokens used by model calls", model=model, type=kind)
+        return response
+
+    def _wrap_stream(self, stream: Any, model: str, start: float):
+        first = True
+        for chunk in stream:
+            if first:
+                self.handler.metrics.observe("llm_ttft_seconds", time.perf_counter() - start, "Time to first token", model=model)
+                first = False
+            yield chunk
+        self.handler.metrics.observe("llm_latency_seconds", time.perf_counter() - start, "Model call latency", model=model)
+
+
+_handler_var: ContextVar[Optional[InstrumentationHandler]] = ContextVar("instrumentation_handler", default=None)
+register_configure_hook(_handler_var, inheritable=True)
+
+
+def enable(exporters: Optional[List[SpanExporter]] = None, metrics_port: Optional[int] = None) -> InstrumentationHandler:
+    """計測を有効にする。以降、このコンテキストで実行されるすべてのチェーン・グラフに自動で付く
+
+    無効のままならコールバックは一切登録されないので、オーバーヘッドはない。
+    """
+    handler = InstrumentationHandler(exporters=exporters)
+    _handler_var.set(handler)
+    if metrics_port is not None:
+        serve_metrics(handler.metrics, metrics_port)
+    return handler
+
+
+def disable() -> None:
+    _handler_var.set(None)
+
+
+def serve_metrics(metrics: MetricsRegistry, port: int = 9464, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """GET /metrics で Prometheus のテキスト形式を返すサーバーをバックグラウンドで起動する"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import lcel
+
+    exporter = JsonlSpanExporter(os.getenv("SPANS_PATH", "spans.jsonl"))
+    handler = enable(exporters=[exporter], metrics_port=9464)
+    lcel.multi_chain()
+    print(handler.metrics.render())
@@ -1,11 +1,28 @@
+import sys
+from pathlib import Path
+
 from langchain.tools import tool
-from langchain_openai import ChatOpenAI
 from langchain.agents import create_agent
 from langchain.agents.middleware import wrap_tool_call
 from langchain.agents.structured_output import ToolStrategy
 from langchain_core.messages import ToolMessage
 from pydantic import BaseModel
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from client_factory import get_chat_model  # noqa: E402
+from rate_limiter import Priority, SchedulerRateLimiter  # noqa: E402
+from resilience import ResilienceMiddleware, ResiliencePolicy  # noqa: E402
+from tool_catalog import ToolRetrievalMiddleware  # noqa: E402
+
+# ツール検索用の日本語の言い回し（ツールの説明は英語なので、日本語のクエリでも引けるようにする）
+TOOL_KEYWORDS = {
+    "search": "検索 調べる 情報",
+    "get_weather": "天気 気温 予報",
+    "get_call_phrase": "通話 電話 文字起こし",
+    "get_video_phrase": "会議 ビデオ 動画 文字起こし",
+}
+
 
 @tool
 def search(query: str) -> str:
@@ -50,18 +67,32 @@ class Phrases(BaseModel):
 
 
 def main():
-    model = ChatOpenAI(
-        model="gpt-4o",
+    model = get_chat_model(
+        "gpt-4o",
         temperature=0.0,
+        timeout=30,
         max_tokens=1000,
+        # エージェントは1ターンごとに入力が変わるため、出力上限＋履歴分を固定で見積もる
+        rate_limiter=SchedulerRateLimiter("gpt-4o", tokens_per_request=2000, priority=Priority.INTERACTIVE),
+    )
+    # timeout=30 は上限で、普段は p99 に合わせたタイムアウトとヘッジで打ち切る。gpt-4o が不調なら gpt-4o-mini に切り替える
+    fallback = get_chat_model(
+        "gpt-4o-mini",
+        temperature=0.0,
         timeout=30,
+        max_tokens=1000,
+        rate_limiter=SchedulerRateLimiter("gpt-4o-mini", tokens_per_request=2000, priority=Priority.INTERACTIVE),
     )
+    resilience = ResilienceMiddleware(ResiliencePolicy(max_timeout=30), fallback=fallback)
     tools = [search, get_weather, get_call_phrase, get_video_phrase]
+    # ツールが8個を超えたら、ユーザーの発言に近い8個だけをモデルに渡す（フォールバックやヘッジの前に1回だけ絞る）
+    tool_retrieval = ToolRetrievalMiddleware(k=8, keywords=TOOL_KEYWORDS)
     system_prompt = "You are a helpful assistant. Be concise and accurate."
     agent = create_agent(
         model=model,
         tools=tools,
         response_format=ToolStrategy(Phrases),
+        middleware=[tool_retrieval, resilience],
     )
 
     try:
@@ -74,6 +105,7 @@ def main():
         print("Agent Response:", response)
     except Exception as e:
         print("An error occurred:", str(e))
+    print("Resilience:", resilience.policy.stats.to_dict())
 
 
 if __name__ == "__main__":
@@ -1,8 +1,15 @@
+import sys
+from pathlib import Path
+
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser, PydanticOutputParser
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from structured_stream import PartialModelParser, json_schema_format  # noqa: E402
+
 
 def sample_lcel_chain_with_str_output_parser() -> None:
     prompt = ChatPromptTemplate.from_messages(
@@ -50,6 +57,24 @@ def sample_lcel_chain_with_pydantic_output_parser() -> None:
     print(recipe)
 
 
+def sample_lcel_chain_with_partial_model_parser() -> None:
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", "ユーザーが入力した料理のレシピを教えてください。"),
+            ("human", "{dish}"),
+        ]
+    )
+
+    # pattern 3: 出力をストリーミングし、リストの要素が完成するたびに途中までの Recipe を受け取るパターン
+    model = ChatOpenAI(model="gpt-4o-mini", temperature=0).bind(response_format=json_schema_format(Recipe))
+    chain = prompt | model | PartialModelParser(pydantic_object=Recipe)
+
+    for recipe in chain.stream({"dish": "カレーライス"}):
+        print(f"材料 {len(recipe.ingredients)} 件 / 手順 {len(recipe.steps)} 件")
+    print(recipe)
+
+
 if __name__ == "__main__":
     # sample_lcel_chain_with_str_output_parser()
     sample_lcel_chain_with_pydantic_output_parser()
+    # sample_lcel_chain_with_partial_model_parser()
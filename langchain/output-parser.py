@@ -1,8 +1,15 @@
+import sys
+from pathlib import Path
+
 from pydantic import BaseModel, Field
 from langchain_core.output_parsers import PydanticOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from structured_stream import PartialModelParser  # noqa: E402
+
 
 class Recipe(BaseModel):
     ingredients: list[str] = Field(description="ingredients of the dish")
@@ -47,5 +54,24 @@ def sample_output_parser() -> PydanticOutputParser[Recipe]:
     print(f"Steps: {recipe.steps}")
 
 
+def sample_partial_model_parser() -> None:
+    # PydanticOutputParser と同じフォーマット指示のまま、出力を少しずつ解析する
+    format_instructions = PydanticOutputParser(pydantic_object=Recipe).get_format_instructions()
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", "ユーザーが入力した料理のレシピを教えてください。\n\n{format_instructions}"),
+            ("human", "{dish}"),
+        ],
+    ).partial(format_instructions=format_instructions)
+
+    model = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    output_parser = PartialModelParser(pydantic_object=Recipe)
+
+    for recipe in (prompt | model | output_parser).stream({"dish": "カレーライス"}):
+        print(f"Ingredients: {recipe.ingredients}")
+        print(f"Steps: {recipe.steps}")
+
+
 if __name__ == "__main__":
     sample_output_parser()
+    # sample_partial_model_parser()
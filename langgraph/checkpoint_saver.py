@@ -1,21 +1,37 @@
 import operator
+import sys
+from pathlib import Path
 from pprint import pprint
 from typing import Annotated, Any
 from uuid import uuid4
 
 from langchain_core.messages import SystemMessage, HumanMessage, BaseMessage
 from langchain_core.runnables import RunnableConfig
-from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
 from pydantic import BaseModel, Field
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from checkpoint_store import CompactingSqliteSaver  # noqa: E402
+from client_factory import get_chat_model  # noqa: E402
+from conversation_window import RollingSummarizer, build_prompt, merge_summary, window_start  # noqa: E402
+
+# モデルに渡す直近の会話のトークン数の上限。これを超えた古い発言は要約に畳み込む
+CONTEXT_TOKEN_BUDGET = 2000
+# 予算のこの割合を超えた時点で要約を始め、発言がウィンドウから外れる前に要約を間に合わせる
+SUMMARY_TRIGGER_RATIO = 0.75
+
+summarizer = RollingSummarizer(lambda: get_chat_model("gpt-4o-mini", temperature=0.0))
+
 
 # graph state
 class State(BaseModel):
     query: str
     messages: Annotated[list[BaseMessage], operator.add] = Field(default_factory=list)
+    # (要約, 要約済みのメッセージ数)
+    summary: Annotated[tuple[str, int], merge_summary] = ("", 0)
+    window_start: int = 0
 
 
 def add_message(state: State) -> dict[str, Any]:
@@ -29,9 +45,26 @@ def add_message(state: State) -> dict[str, Any]:
     return {"messages": additional_messages}
 
 
+def manage_context(state: State, config: RunnableConfig) -> dict[str, Any]:
+    thread_id = str(config["configurable"]["thread_id"])
+    summary, summarized_count = state.summary
+    if (result := summarizer.collect(thread_id)) is not None:
+        summary, summarized_count = merge_summary(state.summary, result)
+
+    # 予算より手前で区切った範囲までを、応答とは別スレッドで要約しておく
+    soft_start = window_start(state.messages, int(CONTEXT_TOKEN_BUDGET * SUMMARY_TRIGGER_RATIO), summarized_count)
+    if soft_start > summarized_count:
+        summarizer.submit(thread_id, summary, state.messages[summarized_count:soft_start], soft_start)
+
+    return {
+        "summary": (summary, summarized_count),
+        "window_start": window_start(state.messages, CONTEXT_TOKEN_BUDGET, summarized_count),
+    }
+
+
 def llm_response(state: State) -> dict[str, Any]:
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.0)
-    ai_message = llm.invoke(state.messages)
+    llm = get_chat_model("gpt-4o-mini", temperature=0.0)
+    ai_message = llm.invoke(build_prompt(state.messages, state.summary[0], state.window_start))
     return {"messages": [ai_message]}
 
 
@@ -47,17 +80,19 @@ def print_checkpoint_dump(checkpointer: BaseCheckpointSaver, config: RunnableCon
 def setup_graph(checkpointer: BaseCheckpointSaver) -> StateGraph:
     graph = StateGraph(State)
     graph.add_node("add_message", add_message)
+    graph.add_node("manage_context", manage_context)
     graph.add_node("llm_response", llm_response)
 
     graph.set_entry_point("add_message")
-    graph.add_edge("add_message", "llm_response")
+    graph.add_edge("add_message", "manage_context")
+    graph.add_edge("manage_context", "llm_response")
     graph.add_edge("llm_response", END)
 
     return graph.compile(checkpointer=checkpointer)
 
 
 def main():
-    checkpointer = MemorySaver()
+    checkpointer = CompactingSqliteSaver("checkpoints.sqlite3")
     state_graph = setup_graph(checkpointer)
 
     config = {"configurable": {"thread_id": uuid4()}}
@@ -70,8 +105,11 @@ def main():
     second_response = state_graph.invoke(user_second_query, config)
     # print(second_response)
 
-    for checkpoint in checkpointer.list(config):
-        print(checkpoint["channel_values"])
+    for checkpoint_tuple in checkpointer.list(config, limit=5):
+        print(checkpoint_tuple.checkpoint["channel_values"])
+
+    # 古いチェックポイントを整理する（スレッドごとに最新の数件だけを残す）
+    print(checkpointer.compact(keep_last=3))
 
 
 if __name__ == "__main__":
@@ -1,13 +1,24 @@
+import functools
 import operator
-from typing import Annotated, Any
+import os
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Annotated, Any, Optional
 
-from langchain_openai import ChatOpenAI
-from langchain_core.runnables import ConfigurableField
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import ConfigurableField, Runnable, RunnableLambda
 from langchain_core.output_parsers import StrOutputParser
 from langgraph.graph import StateGraph, END
 from pydantic import BaseModel, Field
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from client_factory import get_chat_model  # noqa: E402
+from model_router import ModelRouter, load_router, routed  # noqa: E402
+from prompt_registry import prompts  # noqa: E402
+from rate_limiter import scheduled  # noqa: E402
+from role_router import FastPathRouter, RoleClassifier, read_log  # noqa: E402
+
 ROLES = {
     "1": {
         "name": "一般知識エキスパート",
@@ -26,9 +37,112 @@ ROLES = {
     },
 }
 
+# ロールの一覧は固定なので、プロンプトに埋め込む表は起動時に一度だけ作る
+ROLE_OPTIONS = "\n".join([f"{k}. {v["name"]}: {v["description"]}" for k, v in ROLES.items()])
+ROLE_DETAILS = "\n".join([f"- {v["name"]}: {v["details"]}" for v in ROLES.values()])
+
+prompts.register(
+    "qa.selection",
+"""質問を分析し、最も適切な回答担当ロールを選択してください。
+
+選択肢:
+{role_options}
+
+回答は選択肢の番号（1、2、または3）のみを返してください。
+
+質問: {query}
+""".strip(),
+    input_variables=["query"],
+    fragments={"role_options": ROLE_OPTIONS},
+)
+
+prompts.register(
+    "qa.answering",
+"""あなたは {role} として回答してください。以下の質問に対して、あなたの役割に基づいた適切な回答を提供してください。
+
+役割の詳細:
+{role_details}
+
+質問: {query}
+
+回答:
+""".strip(),
+    input_variables=["role", "query"],
+    fragments={"role_details": ROLE_DETAILS},
+)
+
+prompts.register(
+    "qa.check",
+"""以下の回答の品質をチェックし、問題がある場合は 'False'、問題がない場合は 'True' を回答してください。また、その判断理由も説明してください。
+
+ユーザーからの質問: {query}
+回答: {answer}
+""".strip(),
+    input_variables=["query", "answer"],
+)
+
+# ロール分類器の初期学習データ。運用中は LLM の判定ログ（role_router_log.jsonl）から再学習する
+ROLE_EXAMPLES = {
+    "1": [
+        "日本の首都はどこですか",
+        "光の速さはどれくらいですか",
+        "第二次世界大戦はいつ終わりましたか",
+        "美味しいカレーの作り方を教えてください",
+        "富士山の高さは何メートルですか",
+        "円周率とは何ですか",
+        "明治維新について説明してください",
+        "地球温暖化の原因は何ですか",
+        "おすすめの観光地を教えてください",
+        "10 + 2 * 3 はいくつですか",
+        "江戸時代の文化について教えてください",
+        "健康的な食事について教えて",
+    ],
+    "2": [
+        "生成 AI について教えてください",
+        "ChatGPT と GPT-4o の違いは何ですか",
+        "LangChain で RAG を実装する方法を教えて",
+        "大規模言語モデルのファインチューニングのやり方は",
+        "プロンプトエンジニアリングのコツを教えてください",
+        "画像生成 AI のおすすめのツールは何ですか",
+        "LLM のハルシネーションを減らすには",
+        "OpenAI の API の料金体系について教えて",
+        "LangGraph のチェックポイントとは何ですか",
+        "埋め込みベクトルとベクトルデータベースの仕組みは",
+    ],
+    "3": [
+        "仕事がつらくて毎日が憂鬱です",
+        "人間関係に悩んでいます",
+        "最近よく眠れなくて不安です",
+        "失恋してしまい立ち直れません",
+        "将来が不安で何も手につきません",
+        "上司との関係がうまくいかず悩んでいます",
+        "自分に自信が持てません",
+        "家族と喧嘩してしまって落ち込んでいます",
+        "ストレスで気持ちが沈んでいます",
+        "誰にも相談できずに孤独を感じています",
+        "つらい気持ちとの向き合い方を教えてください",
+        "悲しいことがあって元気が出ません",
+    ],
+}
+# LLM の判定ログ。既定はカレントディレクトリ（instrumentation の SPANS_PATH と同じ扱い）
+ROLE_ROUTER_LOG = Path(os.getenv("ROLE_ROUTER_LOG", "role_router_log.jsonl"))
+# 起動時の再学習に使うログの件数（新しい方から）
+ROLE_ROUTER_MAX_RECORDS = 5000
+# 分類器の確信度がこれ未満のときだけ LLM にロールを選ばせる
+ROLE_ROUTER_THRESHOLD = 0.6
+# ModelRouter の判定ログ（sample_gpt と同じ環境変数）
+MODEL_ROUTER_LOG = Path(os.getenv("MODEL_ROUTER_LOG", "model_router_log.jsonl"))
+
 # Initialize the LLM with configurable max_tokens
-llm = ChatOpenAI(model="gpt-4o", temperature=0.0)
-llm = llm.configurable_fields(max_tokens=ConfigurableField(id="max_tokens"))
+# （model も差し替えられるようにして、ModelRouter が選んだモデルで呼べるようにする）
+llm = get_chat_model("gpt-4o", temperature=0.0)
+llm = llm.configurable_fields(
+    max_tokens=ConfigurableField(id="max_tokens"),
+    model_name=ConfigurableField(id="model"),
+)
+
+# ロール選択（1トークンの分類）は DEFAULT_RULES の classification で小さいモデルに振る
+model_router = load_router(log_path=MODEL_ROUTER_LOG)
 
 
 class State(BaseModel):
@@ -39,82 +153,117 @@ class State(BaseModel):
     judgement_reason: str = Field(default="", description="品質チェックの判定理由")
 
 
-def selection_node(state: State) -> dict[str, Any]:
-    query = state.query
-    role_options = "\n".join([f"{k}. {v["name"]}: {v["description"]}" for k, v in ROLES.items()])
-    prompt = ChatPromptTemplate.from_template(
-"""質問を分析し、最も適切な回答担当ロールを選択してください。
+class Judgement(BaseModel):
+    reason: str = Field(default="", description="判定理由")
+    judge: bool = Field(default=False, description="判定結果")
 
-選択肢:
-{role_options}
 
-回答は選択肢の番号（1、2、または3）のみを返してください。
+@dataclass
+class QAChains:
+    """各ノードのチェーン。llm ごとに一度だけ組み立てて使い回す"""
+    llm: Runnable
+    selection: Runnable
+    answering: Runnable
+    check: Runnable
 
-質問: {query}
-""".strip()
-    )
+    @classmethod
+    def build(cls, llm: Runnable, router: ModelRouter) -> "QAChains":
+        @functools.cache
+        def selector(model: str) -> Runnable:
+            return scheduled(llm.with_config(configurable=dict(model=model, max_tokens=1)), model=model, max_tokens=1)
 
-    chain = prompt | llm.with_config(configurable=dict(max_tokens=1)) | StrOutputParser()
-    role_number = chain.invoke({"role_options": role_options, "query": query})
+        return cls(
+            llm=llm,
+            selection=prompts.get("qa.selection") | routed(router, "classification", selector) | StrOutputParser(),
+            answering=prompts.get("qa.answering") | scheduled(llm, model="gpt-4o") | StrOutputParser(),
+            check=prompts.get("qa.check") | scheduled(llm.with_structured_output(Judgement), model="gpt-4o"),
+        )
 
-    selected_role = ROLES[role_number.strip()]["name"]
-    return {"current_role": selected_role}
 
+_chains: Optional[QAChains] = None
 
-def answering_node(state: State) -> dict[str, Any]:
-    query = state.query
-    role = state.current_role
-    role_details = "\n".join([f"- {v["name"]}: {v["details"]}" for v in ROLES.values()])
-    prompt = ChatPromptTemplate.from_template(
-"""あなたは {role} として回答してください。以下の質問に対して、あなたの役割に基づいた適切な回答を提供してください。
 
-役割の詳細:
-{role_details}
+def get_chains() -> QAChains:
+    global _chains
+    # llm が差し替えられた（ベンチマークなど）ときだけ組み立て直す
+    if _chains is None or _chains.llm is not llm:
+        _chains = QAChains.build(llm, model_router)
+    return _chains
 
-質問: {query}
 
-回答:
-""".strip()
+def llm_select_role(query: str) -> str:
+    return get_chains().selection.invoke({"query": query}).strip()
+
+
+async def allm_select_role(query: str) -> str:
+    return (await get_chains().selection.ainvoke({"query": query})).strip()
+
+
+def build_role_router() -> FastPathRouter:
+    texts = [text for examples in ROLE_EXAMPLES.values() for text in examples]
+    labels = [role for role, examples in ROLE_EXAMPLES.items() for _ in examples]
+    # 過去に LLM が判定したロールも学習データに加える
+    for record in read_log(ROLE_ROUTER_LOG, ROLE_ROUTER_MAX_RECORDS):
+        if record.get("role") in ROLES:
+            texts.append(record["query"])
+            labels.append(record["role"])
+    return FastPathRouter(
+        RoleClassifier.fit(texts, labels),
+        llm_select_role,
+        threshold=ROLE_ROUTER_THRESHOLD,
+        log_path=ROLE_ROUTER_LOG,
+        allm_select=allm_select_role,
     )
 
-    chain = prompt | llm | StrOutputParser()
 
-    answer = chain.invoke({"role": role, "role_details": role_details, "query": query})
+role_router = build_role_router()
+
+
+def selection_node(state: State) -> dict[str, Any]:
+    role_number = role_router.route(state.query)
+    selected_role = ROLES[role_number]["name"]
+    return {"current_role": selected_role}
+
+
+async def aselection_node(state: State) -> dict[str, Any]:
+    role_number = await role_router.aroute(state.query)
+    return {"current_role": ROLES[role_number]["name"]}
+
 
+def answering_node(state: State) -> dict[str, Any]:
+    answer = get_chains().answering.invoke({"role": state.current_role, "query": state.query})
     return {"messages": [answer]}
 
 
-class Judgement(BaseModel):
-    reason: str = Field(default="", description="判定理由")
-    judge: bool = Field(default=False, description="判定結果")
+async def aanswering_node(state: State) -> dict[str, Any]:
+    answer = await get_chains().answering.ainvoke({"role": state.current_role, "query": state.query})
+    return {"messages": [answer]}
 
 
 def check_node(state: State) -> dict[str, Any]:
-    query = state.query
-    answer = state.messages[-1]
-    prompt = ChatPromptTemplate.from_template(
-"""以下の回答の品質をチェックし、問題がある場合は 'False'、問題がない場合は 'True' を回答してください。また、その判断理由も説明してください。
-
-ユーザーからの質問: {query}
-回答: {answer}
-""".strip()
-    )
+    result: Judgement = get_chains().check.invoke({"query": state.query, "answer": state.messages[-1]})
+    return {
+        "current_judge": result.judge,
+        "judgement_reason": result.reason,
+    }
 
-    chain = prompt | llm.with_structured_output(Judgement)
-    result: Judgement = chain.invoke({"query": query, "answer": answer})
 
+async def acheck_node(state: State) -> dict[str, Any]:
+    result: Judgement = await get_chains().check.ainvoke({"query": state.query, "answer": state.messages[-1]})
     return {
         "current_judge": result.judge,
         "judgement_reason": result.reason,
     }
 
 
-if __name__ == "__main__":
+def build_workflow() -> StateGraph:
     # Define the workflow
+    # ノードは同期・非同期の両方を持たせ、ainvoke ではスレッドを使わずにチェーンを await する
+    # （タイムアウトでキャンセルしたときにモデルの呼び出しまで止まる）
     workflow = StateGraph(State)
-    workflow.add_node("selection", selection_node)
-    workflow.add_node("answering", answering_node)
-    workflow.add_node("check", check_node)
+    workflow.add_node("selection", RunnableLambda(selection_node, afunc=aselection_node))
+    workflow.add_node("answering", RunnableLambda(answering_node, afunc=aanswering_node))
+    workflow.add_node("check", RunnableLambda(check_node, afunc=acheck_node))
 
     # Define transitions
     workflow.set_entry_point("selection")
@@ -125,7 +274,11 @@ if __name__ == "__main__":
         lambda state: state.current_judge,
         {True: END, False: "selection"}
     )
+    return workflow
+
 
+if __name__ == "__main__":
+    workflow = build_workflow()
     compiled = workflow.compile()
 
     initial_state = State(query="生成 AI について教えてください")
@@ -133,3 +286,6 @@ if __name__ == "__main__":
     for step in compiled.stream(initial_state):
         print(workflow)
         print(step)
+
+    print(role_router.stats.to_dict())
+    print(model_router.stats())
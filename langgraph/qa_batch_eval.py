@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+sys.path.append(str(Path(__file__).resolve().parent))
+
+import qa_application as qa  # noqa: E402
+from rate_limiter import Priority  # noqa: E402
+
+
+@dataclass
+class EvalRecord:
+    id: str
+    query: str
+    status: str  # ok / timeout / error
+    latency_s: float
+    role: str = ""
+    judge: Optional[bool] = None
+    judgement_reason: str = ""
+    retries: int = 0
+    answer: str = ""
+    error: str = ""
+
+
+def read_queries(path: Path) -> Iterator[Dict[str, str]]:
+    """{"id": ..., "query": ...} 形式の JSONL を1行ずつ読む（id は省略可）"""
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if line.strip():
+                record = json.loads(line)
+                yield {"id": str(record.get("id", line_no)), "query": record["query"]}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(p / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def evaluate_one(compiled: Any, item: Dict[str, str], timeout: float, config: Dict[str, Any]) -> EvalRecord:
+    start = time.perf_counter()
+    try:
+        state = await asyncio.wait_for(compiled.ainvoke(qa.State(query=item["query"]), config), timeout)
+    except asyncio.TimeoutError:
+        return EvalRecord(item["id"], item["query"], "timeout", time.perf_counter() - start)
+    except Exception as e:
+        return EvalRecord(item["id"], item["query"], "error", time.perf_counter() - start, error=f"{type(e).__name__}: {e}")
+
+    return EvalRecord(
+        item["id"],
+        item["query"],
+        "ok",
+        time.perf_counter() - start,
+        role=state["current_role"],
+        judge=state["current_judge"],
+        judgement_reason=state["judgement_reason"],
+        # 品質チェックで差し戻されるたびに回答が1件ずつ増える
+        retries=len(state["messages"]) - 1,
+        answer=state["messages"][-1] if state["messages"] else "",
+    )
+
+
+async def run_batch(
+    compiled: Any,
+    items: Iterable[Dict[str, str]],
+    output: TextIO,
+    concurrency: int = 16,
+    timeout: float = 120.0,
+    recursion_limit: int = 20,
+) -> Dict[str, Any]:
+    """質問を最大 concurrency 件ずつ並行してグラフに流し、終わったものから output に1行ずつ書き出す
+
+    入力は必要な分だけ読み進めるので、件数が多くてもメモリに載るのは実行中の質問だけになる。
+    グラフのノードは非同期で実行されるので、タイムアウトした質問はモデルの呼び出しごとキャンセルされる。
+    """
+    config = {"recursion_limit": recursion_limit, "configurable": {"priority": Priority.BULK}}
+
+    items = iter(items)
+    pending: set[asyncio.Task] = set()
+    latencies: List[float] = []
+    counts = {"ok": 0, "timeout": 0, "error": 0}
+    judged_ok = retries = 0
+    started = time.perf_counter()
+
+    while True:
+        while len(pending) < concurrency and (item := next(items, None)) is not None:
+            pending.add(asyncio.create_task(evaluate_one(compiled, item, timeout, config)))
+        if not pending:
+            break
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            record = task.result()
+            output.write(json.dumps(asdict(record), ensure_ascii=False) + "\n")
+            counts[record.status] += 1
+            latencies.append(record.latency_s)
+            judged_ok += bool(record.judge)
+            retries += record.retries
+        output.flush()
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    total = sum(counts.values())
+    return {
+        "queries": total,
+        **counts,
+        "judge_pass_rate": round(judged_ok / counts["ok"], 4) if counts["ok"] else 0.0,
+        "retries": retries,
+        "elapsed_s": round(elapsed, 3),
+        "queries_per_s": round(total / elapsed, 2) if elapsed else 0.0,
+        "latency_s": {f"p{p}": round(percentile(latencies, p), 3) for p in (50, 90, 95, 99)},
+        "role_router": qa.role_router.stats.to_dict(),
+        "model_router": qa.model_router.stats(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="QA グラフに JSONL の質問をまとめて流して評価する")
+    parser.add_argument("input", type=Path, help='1行に {"id": ..., "query": ...} を持つ JSONL')
+    parser.add_argument("-o", "--output", type=Path, default=Path("qa_results.jsonl"))
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=120.0, help="1問あたりのタイムアウト（秒）")
+    parser.add_argument("--recursion-limit", type=int, default=20, help="差し戻しのループを打ち切るステップ数")
+    args = parser.parse_args()
+
+    compiled = qa.build_workflow().compile()
+    with open(args.output, "w", encoding="utf-8") as output:
+        summary = asyncio.run(run_batch(
+            compiled, read_queries(args.input), output, args.concurrency, args.timeout, args.recursion_limit,
+        ))
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,71 @@
+from functools import lru_cache
+
+from langchain_core.language_models import BaseChatModel
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from langchain_core.runnables import Runnable
+from langchain_openai import OpenAIEmbeddings
+
+from client_factory import get_chat_model
+from embedding_stage import CachedBatchEmbedder
+from prompt_registry import prompts
+from rate_limiter import scheduled
+from semantic_cache import SemanticCache
 
+prompts.register(
+    "lcel.cot",
+    [
+        ("system", "ユーザーの質問にステップアップして答えてください。"),
+        ("human", "{question}"),
+    ],
+    input_variables=["question"],
+)
+prompts.register(
+    "lcel.summarize",
+    [
+        ("system", "ステップバイステップで考えた回答から結論だけ抽出してください"),
+        ("human", "{text}"),
+    ],
+    input_variables=["text"],
+)
+prompts.register(
+    "lcel.assistant",
+    [
+        ("system", "You are a helpful assistant."),
+        ("human", "{input}"),
+    ],
+    input_variables=["input"],
+)
 
-def multi_chain() -> None:
-    model = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+
+def build_multi_chain(model: BaseChatModel) -> Runnable:
     output_parser = StrOutputParser()
+    cot_chain = prompts.get("lcel.cot") | scheduled(model) | output_parser
+    summarize_chain = prompts.get("lcel.summarize") | scheduled(model) | output_parser
+    return cot_chain | summarize_chain
+
+
+@lru_cache(maxsize=None)
+def get_multi_chain(model_name: str = "gpt-4o-mini") -> Runnable:
+    """モデルごとに一度だけ組み立てたチェーンを返す"""
+    return build_multi_chain(get_chat_model(model_name, temperature=0))
+
+
+@lru_cache(maxsize=None)
+def get_semantic_cache(path: str = "lcel_semantic_cache") -> SemanticCache:
+    embedder = CachedBatchEmbedder(OpenAIEmbeddings(model="text-embedding-3-small"), f"{path}_embeddings.sqlite3")
+    # 言い回しが少し違うだけの質問を拾うしきい値。計算問題のように数値だけが違う質問は exact_numbers で外す
+    return SemanticCache(path, embedder, threshold=0.95, exact_numbers=True)
 
-    cot_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", "ユーザーの質問にステップアップして答えてください。"),
-            ("human", "{question}"),
-        ]
-    )
-    cot_chain = cot_prompt | model | output_parser
 
-    summarize_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", "ステップバイステップで考えた回答から結論だけ抽出してください"),
-            ("human", "{text}"),
-        ]
-    )
-    summarize_prompt = summarize_prompt | model | output_parser
+@lru_cache(maxsize=None)
+def get_cached_multi_chain(model_name: str = "gpt-4o-mini") -> Runnable:
+    """似た質問に答えたことがあれば、2回のモデル呼び出しを省いてその回答を返す"""
+    return get_semantic_cache().wrap(get_multi_chain(model_name), f"lcel.multi_chain.{model_name}")
 
-    cot_summarize_chain = cot_chain | summarize_prompt
+
+def multi_chain(use_cache: bool = False) -> None:
+    # 意味の近さで回答を使い回すと別の質問に古い回答を返しうるので、キャッシュは明示したときだけ使う
+    cot_summarize_chain = get_cached_multi_chain() if use_cache else get_multi_chain()
 
     output = cot_summarize_chain.invoke({"question": "10 + 2 * 3"})
 
@@ -34,17 +76,17 @@ def upper(text: str) -> str:
     return text.upper()
 
 
-def custom_runnable() -> None:
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", "You are a helpful assistant."),
-            ("human", "{input}"),
-        ]
-    )
-    model = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-    output_parser = StrOutputParser()
+def build_custom_chain(model: BaseChatModel) -> Runnable:
+    return prompts.get("lcel.assistant") | scheduled(model) | StrOutputParser() | upper
+
 
-    chain = prompt | model | output_parser | upper
+@lru_cache(maxsize=None)
+def get_custom_chain(model_name: str = "gpt-4o-mini") -> Runnable:
+    return build_custom_chain(get_chat_model(model_name, temperature=0))
+
+
+def custom_runnable() -> None:
+    chain = get_custom_chain()
     output = chain.invoke({"input": "Hello!"})
 
     print(output)
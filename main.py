@@ -1,8 +1,9 @@
 from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
 
+from client_factory import get_chat_model
 
-model = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+
+model = get_chat_model("gpt-4o-mini", temperature=0)
 
 
 def main():
@@ -0,0 +1,300 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple, Union
+
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from rate_limiter import message_tokens
+
+DEFAULT_MODEL = "gpt-4o"
+RECENT_WINDOW = 100
+# 判定ログがこれを超えたら <log_path>.1 にローテートする
+MAX_LOG_BYTES = 16 * 1024 * 1024
+
+# 上から順に見て最初に一致したルールのモデルを使う。どれにも一致しなければ default
+DEFAULT_RULES: List[Dict[str, Any]] = [
+    # ツールの結果を文章にまとめるだけの2回目の呼び出し
+    {"name": "post_tool_summary", "task": "tool_summary", "max_prompt_tokens": 4000, "model": "gpt-4o-mini"},
+    {"name": "classification", "task": "classification", "model": "gpt-4o-mini"},
+    {"name": "image_description", "task": "vision", "model": "gpt-4o-mini"},
+    {"name": "short_chat", "task": "chat", "max_prompt_tokens": 500, "tools": False, "images": False, "model": "gpt-4o-mini"},
+]
+
+
+@dataclass(frozen=True)
+class RouteFeatures:
+    """ルーティングに使う、リクエストからすぐに計算できる特徴"""
+    task: str
+    prompt_tokens: int
+    has_tools: bool
+    has_images: bool
+    # 入力に含まれるツール結果のメッセージ数
+    tool_results: int
+
+
+def _role(message: Any) -> str:
+    if isinstance(message, dict):
+        return message.get("role", "")
+    return getattr(message, "type", "")
+
+
+def _content(message: Any) -> Any:
+    return message.get("content") if isinstance(message, dict) else getattr(message, "content", message)
+
+
+def extract_features(task: str, messages: Any, tools: Optional[Sequence[Any]] = None) -> RouteFeatures:
+    if isinstance(messages, PromptValue):
+        messages = messages.to_messages()
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    has_images = any(
+        isinstance(part, dict) and part.get("type") in ("image_url", "image")
+        for message in messages if isinstance(content := _content(message), list)
+        for part in content
+    )
+    return RouteFeatures(
+        task=task,
+        prompt_tokens=sum(message_tokens(message) for message in messages),
+        has_tools=bool(tools),
+        has_images=has_images,
+        tool_results=sum(_role(message) == "tool" for message in messages),
+    )
+
+
+@dataclass(frozen=True)
+class RoutingRule:
+    """条件（None は問わない）がすべて一致したら model を使う"""
+    name: str
+    model: str
+    task: Optional[str] = None
+    max_prompt_tokens: Optional[int] = None
+    tools: Optional[bool] = None
+    images: Optional[bool] = None
+
+    def matches(self, features: RouteFeatures) -> bool:
+        return (
+            (self.task is None or self.task == features.task)
+            and (self.max_prompt_tokens is None or features.prompt_tokens <= self.max_prompt_tokens)
+            and (self.tools is None or self.tools == features.has_tools)
+            and (self.images is None or self.images == features.has_images)
+        )
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    model: str
+    # 一致したルール名（なければ "default"）
+    rule: str
+    # ルール通りなら "rule"、実績が悪くて default に戻したなら "quality" / "latency"、
+    # 戻している間に実績を取り直すためルール通りにしたなら "probe"
+    reason: str
+    features: RouteFeatures
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"model": self.model, "rule": self.rule, "reason": self.reason, **asdict(self.features)}
+
+
+@dataclass
+class ModelTaskStats:
+    """タスク × モデルごとの実績。ルーティングの判断には直近 RECENT_WINDOW 件だけを使う"""
+    calls: int = 0
+    failures: int = 0
+    latency_seconds: float = 0.0
+    # (成否, レイテンシ)
+    recent: Deque[Tuple[bool, float]] = field(default_factory=lambda: deque(maxlen=RECENT_WINDOW))
+
+    def add(self, ok: bool, latency: float) -> None:
+        self.calls += 1
+        self.failures += not ok
+        self.latency_seconds += latency
+        self.recent.append((ok, latency))
+
+    @property
+    def success_rate(self) -> float:
+        return sum(ok for ok, _ in self.recent) / len(self.recent) if self.recent else 1.0
+
+    @property
+    def mean_latency(self) -> float:
+        return sum(latency for _, latency in self.recent) / len(self.recent) if self.recent else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "recent_success_rate": round(self.success_rate, 4),
+            "recent_mean_latency_ms": round(self.mean_latency * 1000, 1),
+        }
+
+
+class ModelRouter:
+    """リクエストごとに、ルールと実績からモデルを選ぶルーター
+
+    ルールで小さいモデルが選ばれても、そのタスクでの成功率が min_success_rate を下回っているか、
+    平均レイテンシが default より遅ければ default を使う（どちらも min_samples 件たまってから判断する）。
+    default に戻している間も probe_every 回に1回はルール通りに振り、回復したかどうかを確かめる。
+    判定はすべて log_path に1行1 JSON で追記する。max_log_bytes を超えたら <log_path>.1 にローテートする（古い .1 は上書き）。
+    """
+    def __init__(
+        self,
+        rules: Sequence[RoutingRule],
+        default: str = DEFAULT_MODEL,
+        min_success_rate: float = 0.9,
+        min_samples: int = 20,
+        probe_every: int = 20,
+        log_path: Optional[Union[str, Path]] = None,
+        max_log_bytes: Optional[int] = MAX_LOG_BYTES,
+    ):
+        self.rules = list(rules)
+        self.default = default
+        self.min_success_rate = min_success_rate
+        self.min_samples = min_samples
+        self.probe_every = probe_every
+        self.log_path = log_path
+        self.max_log_bytes = max_log_bytes
+        self.decisions: Dict[str, int] = {}
+        self._stats: Dict[Tuple[str, str], ModelTaskStats] = {}
+        self._overridden: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], **kwargs) -> "ModelRouter":
+        """{"default": ..., "rules": [{"name": ..., "model": ..., ...}]} 形式の設定から作る"""
+        rules = [RoutingRule(**rule) for rule in config.get("rules", DEFAULT_RULES)]
+        options = {k: config[k] for k in ("default", "min_success_rate", "min_samples", "probe_every") if k in config}
+        return cls(rules, **{**options, **kwargs})
+
+    @classmethod
+    def from_file(cls, path: Path, **kwargs) -> "ModelRouter":
+        return cls.from_config(json.loads(Path(path).read_text(encoding="utf-8")), **kwargs)
+
+    def _task_stats(self, task: str, model: str) -> Optional[ModelTaskStats]:
+        stats = self._stats.get((task, model))
+        return stats if stats is not None and len(stats.recent) >= self.min_samples else None
+
+    def _decide(self, features: RouteFeatures) -> RouteDecision:
+        rule = next((rule for rule in self.rules if rule.matches(features)), None)
+        if rule is None or rule.model == self.default:
+            return RouteDecision(self.default, rule.name if rule else "default", "rule", features)
+
+        with self._lock:
+            routed = self._task_stats(features.task, rule.model)
+            baseline = self._task_stats(features.task, self.default)
+            reason = "rule"
+            if routed is not None and routed.success_rate < self.min_success_rate:
+                reason = "quality"
+            elif routed is not None and baseline is not None and routed.mean_latency > baseline.mean_latency:
+                reason = "latency"
+            if reason != "rule":
+                count = self._overridden[rule.name] = self._overridden.get(rule.name, 0) + 1
+                if count % self.probe_every == 0:
+                    return RouteDecision(rule.model, rule.name, "probe", features)
+                return RouteDecision(self.default, rule.name, reason, features)
+        return RouteDecision(rule.model, rule.name, reason, features)
+
+    def route(self, task: str, messages: Any, tools: Optional[Sequence[Any]] = None) -> RouteDecision:
+        decision = self._decide(extract_features(task, messages, tools))
+        with self._lock:
+            self.decisions[decision.model] = self.decisions.get(decision.model, 0) + 1
+            if self.log_path is not None:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"ts": time.time(), **decision.to_dict()}, ensure_ascii=False) + "\n")
+                    size = f.tell()
+                if self.max_log_bytes is not None and size > self.max_log_bytes:
+                    os.replace(self.log_path, f"{self.log_path}.1")
+        return decision
+
+    def observe(self, decision: RouteDecision, latency: float, ok: bool) -> None:
+        """呼び出しの結果を記録する。ok=False（例外や check の不合格）が続くとそのモデルには振らなくなる"""
+        with self._lock:
+            self._stats.setdefault((decision.features.task, decision.model), ModelTaskStats()).add(ok, latency)
+
+    def call(
+        self,
+        task: str,
+        messages: Any,
+        fn: Callable[[str], Any],
+        tools: Optional[Sequence[Any]] = None,
+        check: Optional[Callable[[Any], bool]] = None,
+    ) -> Any:
+        """モデルを選んで fn(model) を呼び、レイテンシと成否を記録する"""
+        decision = self.route(task, messages, tools)
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = fn(decision.model)
+            ok = check(result) if check is not None else True
+            return result
+        finally:
+            self.observe(decision, time.perf_counter() - start, ok)
+
+    async def acall(
+        self,
+        task: str,
+        messages: Any,
+        fn: Callable[[str], Awaitable[Any]],
+        tools: Optional[Sequence[Any]] = None,
+        check: Optional[Callable[[Any], bool]] = None,
+    ) -> Any:
+        decision = self.route(task, messages, tools)
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = await fn(decision.model)
+            ok = check(result) if check is not None else True
+            return result
+        finally:
+            self.observe(decision, time.perf_counter() - start, ok)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "decisions": dict(self.decisions),
+                "tasks": {f"{task}/{model}": stats.to_dict() for (task, model), stats in sorted(self._stats.items())},
+            }
+
+
+def load_router(path: Optional[Path] = None, log_path: Optional[Union[str, Path]] = None) -> ModelRouter:
+    """path の設定ファイルがあればそのルールで、なければ DEFAULT_RULES でルーターを作る"""
+    if path is not None and Path(path).exists():
+        return ModelRouter.from_file(path, log_path=log_path)
+    return ModelRouter.from_config({"rules": DEFAULT_RULES}, log_path=log_path)
+
+
+def routed(router: ModelRouter, task: str, models: Callable[[str], Runnable]) -> Runnable:
+    """チェーンの中でモデルを選ぶ Runnable。models はモデル名からチャットモデルを返す関数（get_chat_model など）"""
+    def invoke(input: Any, config: RunnableConfig) -> Any:
+        return router.call(task, input, lambda model: models(model).invoke(input, config))
+
+    async def ainvoke(input: Any, config: RunnableConfig) -> Any:
+        return await router.acall(task, input, lambda model: models(model).ainvoke(input, config))
+
+    return RunnableLambda(invoke, afunc=ainvoke, name=f"routed_{task}")
+
+
+if __name__ == "__main__":
+    router = load_router()
+    tools = [{"type": "function", "function": {"name": "get_current_weather"}}]
+    samples = [
+        ("tool_selection", [{"role": "user", "content": "Tokyoの天気はどうですか？"}], tools),
+        ("tool_summary", [
+            {"role": "user", "content": "Tokyoの天気はどうですか？"},
+            {"role": "tool", "content": '{"location": "Tokyo", "temperature": "10"}'},
+        ], None),
+        ("chat", [{"role": "user", "content": "こんにちは"}], None),
+        ("chat", [{"role": "user", "content": "長い文書の要約をお願いします。" * 200}], None),
+        ("vision", [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": "https://example.com/a.jpg"}}]}], None),
+    ]
+    for task, messages, sample_tools in samples:
+        print(router.route(task, messages, sample_tools).to_dict())
+
+    # 小さいモデルが失敗し続けると default に戻る
+    for _ in range(router.min_samples):
+        router.call("classification", "分類して", lambda model: "", check=bool)
+    print(router.route("classification", "分類して").to_dict())
+    print(json.dumps(router.stats(), ensure_ascii=False, indent=2))
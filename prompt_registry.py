@@ -0,0 +1,90 @@
+from string import Formatter
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
+
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+# 文字列ならヒューマンメッセージ1件、(role, template) の列ならメッセージごとのテンプレート（MessagesPlaceholder も置ける）
+TemplateSource = Union[str, Sequence[Union[Tuple[str, str], MessagesPlaceholder]]]
+
+
+def _escape(text: str) -> str:
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def bake(template: str, fragments: Mapping[str, str]) -> str:
+    """f-string 形式のテンプレートに静的な値を埋め込み、残りの変数だけを持つテンプレートを返す"""
+    parts: List[str] = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        parts.append(_escape(literal))
+        if field is None:
+            continue
+        if field in fragments and not spec and not conversion:
+            parts.append(_escape(fragments[field]))
+        else:
+            parts.append("{" + field + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "") + "}")
+    return "".join(parts)
+
+
+class PromptRegistry:
+    """プロンプトテンプレートを起動時に一度だけ解析・検証して保持するレジストリ
+
+    静的な断片（ロール一覧など）は登録時にテンプレートへ埋め込むので、呼び出しごとに組み立て直すことはない。
+    """
+    def __init__(self) -> None:
+        self._prompts: Dict[str, ChatPromptTemplate] = {}
+        self._sources: Dict[str, Tuple[TemplateSource, Dict[str, str]]] = {}
+
+    @staticmethod
+    def _parse(source: TemplateSource) -> ChatPromptTemplate:
+        if isinstance(source, str):
+            return ChatPromptTemplate.from_template(source)
+        return ChatPromptTemplate.from_messages(list(source))
+
+    def register(
+        self,
+        name: str,
+        source: TemplateSource,
+        *,
+        input_variables: Iterable[str],
+        fragments: Optional[Mapping[str, str]] = None,
+    ) -> ChatPromptTemplate:
+        """テンプレートを登録する。input_variables と fragments がテンプレートの変数と一致しなければ ValueError"""
+        fragments = dict(fragments or {})
+        declared = set(self._parse(source).input_variables)
+        expected = set(input_variables) | set(fragments)
+        if declared != expected:
+            raise ValueError(
+                f"Prompt {name!r} uses variables {sorted(declared)}, but {sorted(expected)} were declared"
+            )
+
+        if isinstance(source, str):
+            baked: TemplateSource = bake(source, fragments)
+        else:
+            baked = [
+                (message[0], bake(message[1], fragments)) if isinstance(message, tuple) else message
+                for message in source
+            ]
+        prompt = self._parse(baked)
+        self._prompts[name] = prompt
+        self._sources[name] = (source, fragments)
+        return prompt
+
+    def get(self, name: str) -> ChatPromptTemplate:
+        try:
+            return self._prompts[name]
+        except KeyError:
+            raise KeyError(f"Prompt {name!r} is not registered") from None
+
+    def rebuild(self, name: str) -> ChatPromptTemplate:
+        """登録前と同じく、テンプレートを解析し直して静的な値を partial で渡したプロンプトを返す（比較計測用）"""
+        source, fragments = self._sources[name]
+        return self._parse(source).partial(**fragments)
+
+    def names(self) -> List[str]:
+        return list(self._prompts)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._prompts
+
+
+prompts = PromptRegistry()
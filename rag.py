@@ -1,20 +1,371 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from git import Blob, Repo
 from langchain_community.document_loaders import GitLoader
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+# 下流ステージ（埋め込み・インデックス登録など）はチャンクのバッチを受け取る
+ChunkSink = Callable[[List[Document]], None]
+
+_DONE = object()
 
 
 def file_filter(file_path: str) -> bool:
     return file_path.endswith(".mdx")
 
 
+def chunk_id(source: str, index: int) -> str:
+    return f"{source}#{index}"
+
+
+class ParallelGitLoader(GitLoader):
+    """ファイルの読み込みを複数スレッドで行う GitLoader
+
+    lazy_load は読み終わったものから順に Document を返し、先読みは max_pending 件までに抑える。
+    """
+    def __init__(self, *args, read_workers: int = 8, max_pending: int = 32, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_workers = read_workers
+        self.max_pending = max_pending
+
+    def open_repo(self) -> Repo:
+        if not os.path.exists(self.repo_path) and self.clone_url is None:
+            raise ValueError(f"Path {self.repo_path} does not exist")
+        if self.clone_url and not os.path.isdir(os.path.join(self.repo_path, ".git")):
+            repo = Repo.clone_from(self.clone_url, self.repo_path)
+        else:
+            repo = Repo(self.repo_path)
+            if self.clone_url and repo.remotes.origin.url != self.clone_url:
+                raise ValueError("A different repository is already cloned at this path.")
+        repo.git.checkout(self.branch)
+        return repo
+
+    def iter_paths(self, repo: Repo) -> Iterator[str]:
+        """対象ファイルのリポジトリ内パスを遅延で列挙する"""
+        for item in repo.tree().traverse():
+            if not isinstance(item, Blob):
+                continue
+            file_path = os.path.join(self.repo_path, item.path)
+            if self.file_filter and not self.file_filter(file_path):
+                continue
+            if repo.ignored([file_path]):
+                continue
+            yield item.path
+
+    def read_document(self, rel_path: str) -> Optional[Document]:
+        try:
+            with open(os.path.join(self.repo_path, rel_path), "rb") as f:
+                text_content = f.read().decode("utf-8")
+        except (OSError, UnicodeDecodeError):
+            # GitLoader と同様にテキストとして読めないファイルは飛ばす
+            return None
+
+        name = os.path.basename(rel_path)
+        return Document(
+            page_content=text_content,
+            metadata={
+                "source": rel_path,
+                "file_path": rel_path,
+                "file_name": name,
+                "file_type": os.path.splitext(name)[1],
+            },
+        )
+
+    def load_paths(self, paths: Iterable[str]) -> Iterator[Document]:
+        """指定したパスを並列に読み込む"""
+        paths = iter(paths)
+        with ThreadPoolExecutor(max_workers=self.read_workers) as executor:
+            pending: set[Future] = set()
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < self.max_pending:
+                    path = next(paths, None)
+                    if path is None:
+                        exhausted = True
+                        break
+                    pending.add(executor.submit(self.read_document, path))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if (doc := future.result()) is not None:
+                        yield doc
+
+    def lazy_load(self) -> Iterator[Document]:
+        repo = self.open_repo()
+        yield from self.load_paths(self.iter_paths(repo))
+
+
+@dataclass
+class IngestStats:
+    docs: int = 0
+    chunks: int = 0
+    started_at: float = field(default_factory=time.perf_counter)
+    finished_at: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def summary(self) -> dict:
+        elapsed = self.elapsed
+        return {
+            "docs": self.docs,
+            "chunks": self.chunks,
+            "elapsed_s": round(elapsed, 3),
+            "docs_per_s": round(self.docs / elapsed, 2) if elapsed else 0.0,
+            "chunks_per_s": round(self.chunks / elapsed, 2) if elapsed else 0.0,
+        }
+
+
+class IngestionPipeline:
+    """読み込み → 分割 → 下流ステージをキューでつなぐストリーミングパイプライン
+
+    各ステージ間のキューは上限付きなので、下流が遅いと上流が待たされ、メモリ使用量はリポジトリの大きさに依存しない。
+    """
+    def __init__(
+        self,
+        sink: ChunkSink,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 100,
+        batch_size: int = 64,
+        queue_size: int = 8,
+    ):
+        self.sink = sink
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+    def run(self, documents: Iterable[Document]) -> IngestStats:
+        stats = IngestStats()
+        batches: "queue.Queue[object]" = queue.Queue(maxsize=self.queue_size)
+        errors: List[BaseException] = []
+
+        def consume() -> None:
+            while (batch := batches.get()) is not _DONE:
+                if errors:
+                    continue
+                try:
+                    self.sink(batch)
+                except BaseException as e:
+                    errors.append(e)
+
+        consumer = threading.Thread(target=consume, name="ingest-sink", daemon=True)
+        consumer.start()
+        try:
+            batch: List[Document] = []
+            for doc in documents:
+                if errors:
+                    break
+                stats.docs += 1
+                for i, chunk in enumerate(self.splitter.split_documents([doc])):
+                    # ファイル単位で削除・差し替えできるよう、パスと連番で ID を振る
+                    chunk.id = chunk_id(doc.metadata["source"], i)
+                    batch.append(chunk)
+                    if len(batch) >= self.batch_size:
+                        batches.put(batch)
+                        stats.chunks += len(batch)
+                        batch = []
+            if batch and not errors:
+                batches.put(batch)
+                stats.chunks += len(batch)
+        finally:
+            batches.put(_DONE)
+            consumer.join()
+            stats.finished_at = time.perf_counter()
+
+        if errors:
+            raise errors[0]
+        return stats
+
+
+class ChunkIndex(ABC):
+    """チャンクを登録・削除できるインデックスのインターフェース"""
+    @abstractmethod
+    def upsert(self, chunks: List[Document]) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, ids: List[str]) -> None:
+        pass
+
+
+class InMemoryChunkIndex(ChunkIndex):
+    """動作確認用のインデックス"""
+    def __init__(self) -> None:
+        self.chunks: Dict[str, Document] = {}
+
+    def upsert(self, chunks: List[Document]) -> None:
+        self.chunks.update({chunk.id: chunk for chunk in chunks})
+
+    def delete(self, ids: List[str]) -> None:
+        for id_ in ids:
+            self.chunks.pop(id_, None)
+
+
+@dataclass
+class FileEntry:
+    sha256: str
+    chunks: int
+
+
+@dataclass
+class Manifest:
+    """インデックス済みのコミットと、ファイルごとの内容ハッシュ・チャンク数"""
+    commit: Optional[str] = None
+    files: Dict[str, FileEntry] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: Path) -> "Manifest":
+        if not path.exists():
+            return cls()
+        data = json.loads(path.read_text(encoding="utf-8"))
+        return cls(commit=data["commit"], files={k: FileEntry(**v) for k, v in data["files"].items()})
+
+    def save(self, path: Path) -> None:
+        # 途中で落ちても壊れたマニフェストが残らないよう、書き込み後に置き換える
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(json.dumps(asdict(self), ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+
+
+class IncrementalIndexer:
+    """前回インデックスしたコミットとの git diff から、変更されたファイルだけを再インデックスする"""
+    def __init__(self, loader: ParallelGitLoader, index: ChunkIndex, manifest_path: Path, pipeline: Optional[IngestionPipeline] = None):
+        self.loader = loader
+        self.index = index
+        self.manifest_path = manifest_path
+        self.pipeline = pipeline or IngestionPipeline(sink=index.upsert)
+
+    def _is_target(self, repo: Repo, rel_path: str) -> bool:
+        file_path = os.path.join(self.loader.repo_path, rel_path)
+        if self.loader.file_filter and not self.loader.file_filter(file_path):
+            return False
+        return not repo.ignored([file_path])
+
+    def _changed_paths(self, repo: Repo, manifest: Manifest) -> tuple[set[str], set[str]]:
+        """(追加・変更されたパス, 削除されたパス) を返す"""
+        head = repo.head.commit
+        try:
+            base = repo.commit(manifest.commit) if manifest.commit else None
+        except ValueError:
+            # 履歴の書き換えなどで前回のコミットが無い場合は全件を対象にする
+            base = None
+
+        if base is None:
+            current = set(self.loader.iter_paths(repo))
+            return current, set(manifest.files) - current
+
+        changed, removed = set(), set()
+        for diff in base.diff(head):
+            if diff.change_type in ("D", "R"):
+                removed.add(diff.a_path)
+            if diff.change_type != "D":
+                changed.add(diff.b_path)
+        changed = {p for p in changed if self._is_target(repo, p)}
+        removed = {p for p in removed - changed if p in manifest.files}
+        return changed, removed
+
+    def refresh(self, pull: bool = True) -> dict:
+        repo = self.loader.open_repo()
+        if pull and self.loader.clone_url:
+            repo.remotes.origin.pull(self.loader.branch)
+
+        manifest = Manifest.load(self.manifest_path)
+        head = repo.head.commit.hexsha
+        changed, removed = self._changed_paths(repo, manifest)
+
+        # 削除されたファイルのチャンクを消す
+        for path in removed:
+            self.index.delete([chunk_id(path, i) for i in range(manifest.files.pop(path).chunks)])
+
+        new_hashes: Dict[str, str] = {}
+        loaded: set[str] = set()
+
+        def modified_documents() -> Iterator[Document]:
+            for doc in self.loader.load_paths(sorted(changed)):
+                path = doc.metadata["source"]
+                loaded.add(path)
+                digest = hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()
+                old = manifest.files.get(path)
+                if old is not None and old.sha256 == digest:
+                    continue
+                new_hashes[path] = digest
+                yield doc
+
+        chunk_counts: Counter = Counter()
+        sink = self.pipeline.sink
+
+        def counting_sink(chunks: List[Document]) -> None:
+            sink(chunks)
+            chunk_counts.update(chunk.metadata["source"] for chunk in chunks)
+
+        self.pipeline.sink = counting_sink
+        try:
+            stats = self.pipeline.run(modified_documents())
+        finally:
+            self.pipeline.sink = sink
+
+        # チャンク ID はパスと連番なので、書き直したファイルは upsert で上書きされている。
+        # 上書きされずに残った古いチャンク（チャンク数が減った分や 0 件になったファイル、
+        # 読めなくなったファイルの全チャンク）をここで消す
+        for path in changed:
+            old = manifest.files.get(path)
+            if old is None:
+                continue
+            if path in new_hashes:
+                stale = range(chunk_counts[path], old.chunks)
+            elif path not in loaded:
+                stale = range(old.chunks)
+                del manifest.files[path]
+                removed.add(path)
+            else:
+                continue
+            if stale:
+                self.index.delete([chunk_id(path, i) for i in stale])
+
+        for path, digest in new_hashes.items():
+            manifest.files[path] = FileEntry(sha256=digest, chunks=chunk_counts[path])
+        manifest.commit = head
+        manifest.save(self.manifest_path)
+
+        return {"commit": head, "reindexed": len(new_hashes), "removed": len(removed), **stats.summary()}
+
+
 def sample_rag():
-    loader = GitLoader(
+    from langchain_openai import OpenAIEmbeddings
+
+    from embedding_stage import CachedBatchEmbedder
+    from vector_store import MmapVectorStore
+
+    loader = ParallelGitLoader(
         clone_url="https:/github.com/langhcain-ai/langchain",
         repo_path="./langchain",
         branch="master",
         file_filter=file_filter,
     )
 
-    row_docs = loader.load()
-    print(row_docs)
+    embedder = CachedBatchEmbedder(OpenAIEmbeddings(model="text-embedding-3-small"), "rag_embeddings.sqlite3")
+    store = MmapVectorStore("rag_index", embedder)
+    indexer = IncrementalIndexer(loader, store, Path("rag_index/manifest.json"))
+    print(indexer.refresh())
+    print(embedder.stats.to_dict())
+
+    retriever = store.as_retriever(search_kwargs={"k": 4})
+    for doc in retriever.invoke("How do I stream tokens from a chat model?"):
+        print(doc.id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,392 @@
+import asyncio
+import heapq
+import itertools
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Deque, Dict, List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.prompt_values import PromptValue
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from sample_gpt import AIClient
+
+# 1メッセージあたりのロール・区切りのオーバーヘッド
+TOKENS_PER_MESSAGE = 4
+# max_tokens 未指定時に出力分として予約するトークン数
+DEFAULT_COMPLETION_TOKENS = 256
+
+
+class Priority(IntEnum):
+    """値が小さいほど優先される"""
+    INTERACTIVE = 0
+    DEFAULT = 1
+    BULK = 2
+
+
+@dataclass(frozen=True)
+class ModelBudget:
+    """モデルごとの1分あたりのリクエスト数・トークン数の上限"""
+    rpm: int
+    tpm: int
+
+
+# OpenAI の Tier 1 相当。実際のクォータに合わせて上書きする
+DEFAULT_BUDGETS = {
+    "gpt-4o": ModelBudget(rpm=500, tpm=30_000),
+    "gpt-4o-mini": ModelBudget(rpm=500, tpm=200_000),
+}
+
+
+def text_tokens(text: str) -> int:
+    """テキストのトークン数を文字数から見積もる"""
+    # ASCII はおよそ4文字で1トークン、日本語などはおよそ1文字1トークン
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def _content_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return "" if content is None else str(content)
+
+
+def message_tokens(message: Any) -> int:
+    """1メッセージ分の入力トークン数を見積もる"""
+    if isinstance(message, BaseMessage):
+        content = message.content
+    elif isinstance(message, dict):
+        content = message.get("content")
+    else:
+        content = message
+    return TOKENS_PER_MESSAGE + text_tokens(_content_text(content))
+
+
+def estimate_tokens(messages: Any, max_tokens: Optional[int] = None, tools: Optional[List[Any]] = None) -> int:
+    """送信前にリクエストの消費トークン数（入力＋出力の予約分）を見積もる"""
+    if isinstance(messages, PromptValue):
+        messages = messages.to_messages()
+    if isinstance(messages, (str, BaseMessage, dict)):
+        messages = [messages]
+
+    total = sum(message_tokens(message) for message in messages or [])
+
+    if tools:
+        total += text_tokens(json.dumps(tools, ensure_ascii=False, default=str))
+    return total + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+class TokenBucket:
+    """連続的に補充されるトークンバケット（スレッドセーフではない。呼び出し側でロックする）"""
+    def __init__(self, per_minute: float, burst_seconds: float = 10.0):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_until(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # バケット容量を超える要求は容量まで満たされれば通す
+        needed = min(amount, self.capacity) - self.tokens
+        return max(needed / self.rate, 0.0)
+
+    def consume(self, amount: float) -> None:
+        # 容量超過分は負の残高として後続に按分する
+        self.tokens -= amount
+
+
+class _Waiter:
+    def __init__(self, priority: int, seq: int, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+        self.cancelled = False
+        self.loop = loop
+        self.future: Optional[asyncio.Future] = loop.create_future() if loop else None
+        self.event = None if loop else threading.Event()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def grant(self) -> None:
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._set_future)
+
+    def _set_future(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class _Lane:
+    """1モデル分のバケットと待ち行列"""
+    def __init__(self, budget: ModelBudget):
+        self.requests = TokenBucket(budget.rpm)
+        self.tokens = TokenBucket(budget.tpm)
+        self.queue: List[_Waiter] = []
+
+    def time_until(self, tokens: int, now: float) -> float:
+        return max(self.requests.time_until(1, now), self.tokens.time_until(tokens, now))
+
+
+@dataclass
+class SchedulerMetrics:
+    """待ち行列の長さと待ち時間"""
+    granted: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    wait_total: Dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    wait_max: Dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    recent_waits: Dict[str, Deque[float]] = field(default_factory=lambda: defaultdict(lambda: deque(maxlen=1000)))
+
+    def record(self, priority: int, wait: float) -> None:
+        name = Priority(priority).name
+        self.granted[name] += 1
+        self.wait_total[name] += wait
+        self.wait_max[name] = max(self.wait_max[name], wait)
+        self.recent_waits[name].append(wait)
+
+    def summary(self) -> Dict[str, Any]:
+        result = {}
+        for name, count in self.granted.items():
+            waits = sorted(self.recent_waits[name])
+            result[name] = {
+                "granted": count,
+                "wait_avg_s": round(self.wait_total[name] / count, 4),
+                "wait_p95_s": round(waits[int(len(waits) * 0.95) - 1 if len(waits) > 1 else 0], 4),
+                "wait_max_s": round(self.wait_max[name], 4),
+            }
+        return result
+
+
+class RequestScheduler:
+    """モデルごとの RPM/TPM 予算を守りつつ、優先度順にリクエストを通すスケジューラ
+
+    予算の空きを待つ間はタイマーで再スケジュールするので、リクエストは上限付近で一定のペースで流れる。
+    """
+    def __init__(self, budgets: Optional[Dict[str, ModelBudget]] = None, default_budget: Optional[ModelBudget] = None):
+        self.budgets = dict(DEFAULT_BUDGETS if budgets is None else budgets)
+        self.default_budget = default_budget
+        self.metrics = SchedulerMetrics()
+        self._lock = threading.Lock()
+        self._lanes: Dict[str, _Lane] = {}
+        self._seq = itertools.count()
+        self._timer: Optional[threading.Timer] = None
+        self._timer_due = float("inf")
+
+    def _lane(self, model: str) -> Optional[_Lane]:
+        lane = self._lanes.get(model)
+        if lane is None:
+            budget = self.budgets.get(model, self.default_budget)
+            if budget is None:
+                return None
+            lane = self._lanes[model] = _Lane(budget)
+        return lane
+
+    def acquire(self, model: str, tokens: int, priority: int = Priority.DEFAULT, timeout: Optional[float] = None) -> float:
+        """予算が空くまでブロックし、待ち時間（秒）を返す"""
+        with self._lock:
+            lane = self._lane(model)
+            if lane is None:
+                return 0.0
+            waiter = _Waiter(priority, next(self._seq), tokens)
+            heapq.heappush(lane.queue, waiter)
+            self._dispatch()
+
+        if not waiter.event.wait(timeout):
+            with self._lock:
+                if not waiter.event.is_set():
+                    waiter.cancelled = True
+                    raise TimeoutError(f"Rate limit wait for {model} exceeded {timeout}s")
+        return time.monotonic() - waiter.enqueued_at
+
+    async def aacquire(self, model: str, tokens: int, priority: int = Priority.DEFAULT) -> float:
+        """acquire の非同期版。待っている間スレッドを占有しない"""
+        with self._lock:
+            lane = self._lane(model)
+            if lane is None:
+                return 0.0
+            waiter = _Waiter(priority, next(self._seq), tokens, loop=asyncio.get_running_loop())
+            heapq.heappush(lane.queue, waiter)
+            self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                waiter.cancelled = True
+            raise
+        return time.monotonic() - waiter.enqueued_at
+
+    def reconcile(self, model: str, estimated: int, actual: int) -> None:
+        """実際の使用量で見積もりとの差分を補正する"""
+        with self._lock:
+            lane = self._lanes.get(model)
+            if lane is not None:
+                lane.tokens.consume(actual - estimated)
+                self._dispatch()
+
+    def queue_depth(self) -> Dict[str, int]:
+        with self._lock:
+            return {model: sum(not w.cancelled for w in lane.queue) for model, lane in self._lanes.items()}
+
+    def _dispatch(self) -> None:
+        # self._lock を取得した状態で呼ぶこと
+        now = time.monotonic()
+        next_wakeup = float("inf")
+        for lane in self._lanes.values():
+            while lane.queue:
+                head = lane.queue[0]
+                if head.cancelled:
+                    heapq.heappop(lane.queue)
+                    continue
+                delay = lane.time_until(head.tokens, now)
+                if delay > 0:
+                    next_wakeup = min(next_wakeup, now + delay)
+                    break
+                heapq.heappop(lane.queue)
+                lane.requests.consume(1)
+                lane.tokens.consume(head.tokens)
+                self.metrics.record(head.priority, now - head.enqueued_at)
+                head.grant()
+
+        if next_wakeup < self._timer_due:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer_due = next_wakeup
+            self._timer = threading.Timer(next_wakeup - now, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._timer_due = float("inf")
+            self._dispatch()
+
+
+_scheduler: Optional[RequestScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    """プロセス共通のスケジューラを返す"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def set_scheduler(scheduler: RequestScheduler) -> None:
+    """プロセス共通のスケジューラを差し替える（ベンチマークやテスト用）"""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
+
+
+class RateLimitedAIClient(AIClient):
+    """AIClient の呼び出しをスケジューラ経由にするデコレータ"""
+    def __init__(self, ai_client: AIClient, priority: int = Priority.DEFAULT, scheduler: Optional[RequestScheduler] = None):
+        self.ai_client = ai_client
+        self.priority = priority
+        self.scheduler = scheduler or get_scheduler()
+
+    def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        model = kwargs.get("model", "")
+        estimated = estimate_tokens(messages, kwargs.get("max_tokens"), kwargs.get("tools"))
+        self.scheduler.acquire(model, estimated, self.priority)
+
+        response = self.ai_client.chat_completion(messages=messages, **kwargs)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.scheduler.reconcile(model, estimated, usage.total_tokens)
+        return response
+
+
+def _usage_tokens(output: Any) -> Optional[int]:
+    if isinstance(output, AIMessage) and output.usage_metadata:
+        return output.usage_metadata["total_tokens"]
+    return None
+
+
+def scheduled(
+    runnable: Runnable,
+    model: Optional[str] = None,
+    priority: int = Priority.DEFAULT,
+    max_tokens: Optional[int] = None,
+    scheduler: Optional[RequestScheduler] = None,
+) -> Runnable:
+    """チャットモデル（を含む Runnable）の前にスケジューラを挟む
+
+    入力（PromptValue やメッセージ列）からトークン数を見積もり、待ち時間は metadata の queue_time_s に載せる。
+    優先度は config の configurable["priority"] で呼び出しごとに上書きできる（バッチ処理を BULK にするなど）。
+    """
+    model = model or getattr(runnable, "model_name", None) or "default"
+    scheduler = scheduler or get_scheduler()
+
+    def _with_queue_time(config: RunnableConfig, wait: float) -> RunnableConfig:
+        return {**config, "metadata": {**config.get("metadata", {}), "queue_time_s": wait}}
+
+    def _priority(config: RunnableConfig) -> int:
+        return config.get("configurable", {}).get("priority", priority)
+
+    def invoke(input: Any, config: RunnableConfig) -> Any:
+        estimated = estimate_tokens(input, max_tokens)
+        wait = scheduler.acquire(model, estimated, _priority(config))
+        output = runnable.invoke(input, _with_queue_time(config, wait))
+        if (actual := _usage_tokens(output)) is not None:
+            scheduler.reconcile(model, estimated, actual)
+        return output
+
+    async def ainvoke(input: Any, config: RunnableConfig) -> Any:
+        estimated = estimate_tokens(input, max_tokens)
+        wait = await scheduler.aacquire(model, estimated, _priority(config))
+        output = await runnable.ainvoke(input, _with_queue_time(config, wait))
+        if (actual := _usage_tokens(output)) is not None:
+            scheduler.reconcile(model, estimated, actual)
+        return output
+
+    return RunnableLambda(invoke, afunc=ainvoke, name=f"scheduled_{model}")
+
+
+class SchedulerRateLimiter(BaseRateLimiter):
+    """ChatModel の rate_limiter 引数に渡すためのアダプタ
+
+    rate_limiter からは入力が見えないため、1リクエストあたりのトークン数は固定の見積もりを使う。
+    """
+    def __init__(
+        self,
+        model: str,
+        tokens_per_request: int,
+        priority: int = Priority.DEFAULT,
+        scheduler: Optional[RequestScheduler] = None,
+    ):
+        self.model = model
+        self.tokens_per_request = tokens_per_request
+        self.priority = priority
+        self.scheduler = scheduler or get_scheduler()
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        try:
+            self.scheduler.acquire(self.model, self.tokens_per_request, self.priority, timeout=None if blocking else 0)
+        except TimeoutError:
+            return False
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        if not blocking:
+            return self.acquire(blocking=False)
+        await self.scheduler.aacquire(self.model, self.tokens_per_request, self.priority)
+        return True
@@ -0,0 +1,486 @@
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from langchain.agents.middleware import AgentMiddleware, ModelRequest, ModelResponse
+from langchain_core.language_models import BaseChatModel
+
+from sample_gpt import AIClient, AsyncAIClient
+
+
+class CircuitOpenError(RuntimeError):
+    """サーキットブレーカーが開いていて、上流を呼ばずに失敗させたとき"""
+    def __init__(self, model: str):
+        super().__init__(f"Circuit for {model!r} is open")
+        self.model = model
+
+
+def is_failure(error: BaseException) -> bool:
+    """ブレーカーの失敗として数えるか。リクエスト自体が不正な 4xx は上流の不調ではないので数えない"""
+    status = getattr(error, "status_code", None)
+    return status is None or status >= 500 or status in (408, 409, 429)
+
+
+class LatencyTracker:
+    """モデルごとに直近 window 件のレイテンシを保持し、分位点を返す"""
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._recent: Dict[str, Deque[float]] = defaultdict(deque)
+        # 分位点を毎回ソートせずに求めるため、同じ値をソート済みで持つ
+        self._sorted: Dict[str, List[float]] = defaultdict(list)
+
+    def record(self, model: str, seconds: float) -> None:
+        with self._lock:
+            recent, ordered = self._recent[model], self._sorted[model]
+            if len(recent) >= self.window:
+                del ordered[bisect.bisect_left(ordered, recent.popleft())]
+            recent.append(seconds)
+            bisect.insort(ordered, seconds)
+
+    def quantile(self, model: str, q: float) -> Optional[float]:
+        """サンプルが min_samples 件に満たなければ None"""
+        with self._lock:
+            ordered = self._sorted.get(model)
+            if not ordered or len(ordered) < self.min_samples:
+                return None
+            return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class CircuitBreaker:
+    """直近 window 件のエラー率が error_rate 以上になったら開き、reset_timeout 秒後に1件だけ試す
+
+    試しの1件の結果が reset_timeout 秒たっても記録されなければ、もう1件試す（結果が失われても閉じたままにしない）。
+    """
+    def __init__(self, window: int = 20, min_calls: int = 10, error_rate: float = 0.5, reset_timeout: float = 30.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.reset_timeout = reset_timeout
+        self.state = "closed"  # closed / open / half_open
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_timeout:
+                # 試しに1件だけ通し、結果が出るまで（最長 reset_timeout 秒）他は通さない
+                self.state, self.opened_at = "half_open", now
+                return True
+            return False
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            if self.state == "half_open":
+                self._outcomes.clear()
+                if success:
+                    self.state = "closed"
+                else:
+                    self.state, self.opened_at = "open", time.monotonic()
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+                self.state, self.opened_at = "open", time.monotonic()
+
+    def abandon(self) -> None:
+        """キャンセルなどで結果が分からなかったとき。試しの1件なら失敗として開き直し、それ以外は数えない"""
+        with self._lock:
+            if self.state == "half_open":
+                self.state, self.opened_at = "open", time.monotonic()
+
+
+@dataclass
+class ResilienceStats:
+    """ヘッジ・タイムアウト・ブレーカーの動作状況"""
+    requests: int = 0
+    # p95 を過ぎても返ってこず、2本目を送った数
+    hedged: int = 0
+    # 2本目のほうが先に返ってきた数
+    hedge_wins: int = 0
+    timeouts: int = 0
+    errors: int = 0
+    # ブレーカーが開いていて上流を呼ばなかった数
+    short_circuited: int = 0
+    fallbacks: int = 0
+    _latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=10_000), repr=False)
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedged / self.requests if self.requests else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            return round(latencies[min(int(p / 100 * len(latencies)), len(latencies) - 1)], 4) if latencies else 0.0
+
+        data = {k: v for k, v in asdict(self).items() if not k.startswith("_")}
+        return {**data, "hedge_rate": round(self.hedge_rate, 4), "p50_s": percentile(50), "p99_s": percentile(99)}
+
+
+# 呼び出すモデル名を受け取って、そのモデルでリクエストを実行する関数
+Attempt = Callable[[str], Any]
+AsyncAttempt = Callable[[str], Awaitable[Any]]
+
+
+class ResiliencePolicy:
+    """モデルごとのレイテンシ分布に合わせてヘッジとタイムアウトを決め、エラー率でブレーカーを開く
+
+    - 直近の hedge_quantile（p95）を過ぎても返ってこなければ同じリクエストをもう1本送り、先に返ったほうを使う。
+      送りすぎないよう、ヘッジはリクエスト数の hedge_budget 割までにする。
+    - タイムアウトは p99 の timeout_multiplier 倍（min_timeout〜max_timeout の範囲）にする。
+    - ブレーカーが開いているか呼び出しに失敗したときは、fallbacks に代わりのモデルがあればそちらで1回だけやり直す。
+      代わりがなければ CircuitOpenError ですぐに失敗させる。
+
+    同期版の呼び出しは1本ごとに専用のスレッドで実行する。固定サイズのプールだと呼び出し元が多いときにキューで待ち、
+    その待ち時間でタイムアウトしてブレーカーまで開いてしまうため。打ち切った呼び出しはキャンセルできないので、
+    上流から返ってくるまでスレッドが残る。
+    """
+    def __init__(
+        self,
+        fallbacks: Optional[Dict[str, str]] = None,
+        hedge_quantile: float = 0.95,
+        hedge_budget: float = 0.1,
+        timeout_multiplier: float = 3.0,
+        min_timeout: float = 1.0,
+        max_timeout: float = 30.0,
+        tracker: Optional[LatencyTracker] = None,
+        breaker_factory: Callable[[], CircuitBreaker] = CircuitBreaker,
+    ):
+        self.fallbacks = dict(fallbacks or {})
+        self.hedge_quantile = hedge_quantile
+        self.hedge_budget = hedge_budget
+        self.timeout_multiplier = timeout_multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.tracker = tracker or LatencyTracker()
+        self.stats = ResilienceStats()
+        self._breaker_factory = breaker_factory
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(model)
+            if breaker is None:
+                breaker = self._breakers[model] = self._breaker_factory()
+            return breaker
+
+    def timeout(self, model: str) -> float:
+        p99 = self.tracker.quantile(model, 0.99)
+        if p99 is None:
+            return self.max_timeout
+        return min(max(p99 * self.timeout_multiplier, self.min_timeout), self.max_timeout)
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        return self.tracker.quantile(model, self.hedge_quantile)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self.stats, name, getattr(self.stats, name) + 1)
+
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self.stats.hedged >= self.hedge_budget * self.stats.requests:
+                return False
+            self.stats.hedged += 1
+            return True
+
+    def _start(self, model: str, attempt: Attempt) -> Future:
+        """attempt(model) を専用のスレッドですぐに実行し始める"""
+        future: Future = Future()
+        context = contextvars.copy_context()
+
+        def run() -> None:
+            start = time.perf_counter()
+            try:
+                result = context.run(attempt, model)
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            # 打ち切った呼び出しも、返ってきた時点のレイテンシを分布に入れる（入れないと p99 が低く見積もられる）
+            self.tracker.record(model, time.perf_counter() - start)
+            future.set_result(result)
+
+        threading.Thread(target=run, name=f"resilience-{model}", daemon=True).start()
+        return future
+
+    def _hedged(self, model: str, attempt: Attempt) -> Any:
+        deadline_after, hedge_at = self.timeout(model), self.hedge_delay(model)
+        primary = self._start(model, attempt)
+        # キューで待たずに実行が始まるので、タイムアウトとヘッジの時間はここから数える
+        start = time.monotonic()
+        deadline = start + deadline_after
+        pending = {primary}
+        hedge: Optional[Future] = None
+        error: Optional[BaseException] = None
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wake = deadline
+            if hedge is None and hedge_at is not None:
+                wake = min(wake, start + hedge_at)
+            done, pending = wait(pending, timeout=max(wake - now, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+            if error is not None and not pending:
+                raise error
+            if hedge is None and hedge_at is not None and time.monotonic() >= start + hedge_at and pending:
+                if self._take_hedge():
+                    hedge = self._start(model, attempt)
+                    pending.add(hedge)
+                hedge_at = None
+        self._count("timeouts")
+        raise TimeoutError(f"{model} did not respond within {deadline - start:.2f}s")
+
+    async def _ahedged(self, model: str, attempt: AsyncAttempt) -> Any:
+        async def run() -> Any:
+            start = time.perf_counter()
+            result = await attempt(model)
+            self.tracker.record(model, time.perf_counter() - start)
+            return result
+
+        start = time.monotonic()
+        deadline = start + self.timeout(model)
+        hedge_at = self.hedge_delay(model)
+        primary = asyncio.ensure_future(run())
+        pending = {primary}
+        hedge: Optional[asyncio.Future] = None
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                wake = deadline
+                if hedge is None and hedge_at is not None:
+                    wake = min(wake, start + hedge_at)
+                done, pending = await asyncio.wait(pending, timeout=max(wake - now, 0), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+                if error is not None and not pending:
+                    raise error
+                if hedge is None and hedge_at is not None and time.monotonic() >= start + hedge_at and pending:
+                    if self._take_hedge():
+                        hedge = asyncio.ensure_future(run())
+                        pending.add(hedge)
+                    hedge_at = None
+            self._count("timeouts")
+            raise TimeoutError(f"{model} did not respond within {deadline - start:.2f}s")
+        finally:
+            # 負けたほう・打ち切ったほうは同期版と違ってキャンセルできる
+            for task in pending:
+                task.cancel()
+
+    def _guard(self, model: str) -> CircuitBreaker:
+        breaker = self.breaker(model)
+        if not breaker.allow():
+            self._count("short_circuited")
+            raise CircuitOpenError(model)
+        return breaker
+
+    def _record(self, breaker: CircuitBreaker, error: Optional[BaseException]) -> None:
+        if error is None:
+            breaker.record(True)
+            return
+        breaker.record(not is_failure(error))
+        if not isinstance(error, TimeoutError):
+            self._count("errors")
+
+    def _call_model(self, model: str, attempt: Attempt, hedge: bool) -> Any:
+        breaker = self._guard(model)
+        try:
+            result = self._hedged(model, attempt) if hedge else attempt(model)
+        except Exception as e:
+            self._record(breaker, e)
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        self._record(breaker, None)
+        return result
+
+    async def _acall_model(self, model: str, attempt: AsyncAttempt, hedge: bool) -> Any:
+        breaker = self._guard(model)
+        try:
+            result = await (self._ahedged(model, attempt) if hedge else attempt(model))
+        except Exception as e:
+            self._record(breaker, e)
+            raise
+        except BaseException:
+            # 呼び出し元のキャンセル（wait_for のタイムアウトなど）でも試しの1件を返さないままにしない
+            breaker.abandon()
+            raise
+        self._record(breaker, None)
+        return result
+
+    def _fallback_for(self, model: str, error: Exception, fallback: Optional[str]) -> str:
+        fallback = fallback or self.fallbacks.get(model)
+        if fallback is None or not is_failure(error):
+            raise error
+        self._count("fallbacks")
+        return fallback
+
+    def call(self, model: str, attempt: Attempt, fallback: Optional[str] = None, hedge: bool = True) -> Any:
+        """attempt(model) をヘッジ・タイムアウト・ブレーカー付きで実行する（hedge=False ならそのまま呼ぶ）"""
+        self._count("requests")
+        start = time.perf_counter()
+        try:
+            try:
+                return self._call_model(model, attempt, hedge)
+            except Exception as e:
+                return self._call_model(self._fallback_for(model, e, fallback), attempt, hedge)
+        finally:
+            self.stats._latencies.append(time.perf_counter() - start)
+
+    async def acall(self, model: str, attempt: AsyncAttempt, fallback: Optional[str] = None, hedge: bool = True) -> Any:
+        self._count("requests")
+        start = time.perf_counter()
+        try:
+            try:
+                return await self._acall_model(model, attempt, hedge)
+            except Exception as e:
+                return await self._acall_model(self._fallback_for(model, e, fallback), attempt, hedge)
+        finally:
+            self.stats._latencies.append(time.perf_counter() - start)
+
+    def breaker_states(self) -> Dict[str, str]:
+        with self._lock:
+            return {model: breaker.state for model, breaker in self._breakers.items()}
+
+
+class ResilientAIClient(AIClient):
+    """AIClient の呼び出しを ResiliencePolicy 経由にするデコレータ
+
+    ストリーミングは重複させると2本分のトークンを読むことになるので、ヘッジせずブレーカーとフォールバックだけを使う。
+    """
+    def __init__(self, ai_client: AIClient, policy: Optional[ResiliencePolicy] = None):
+        self.ai_client = ai_client
+        self.policy = policy or ResiliencePolicy()
+
+    def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        return self.policy.call(
+            kwargs.get("model", ""),
+            lambda model: self.ai_client.chat_completion(messages=messages, **{**kwargs, "model": model}),
+            hedge=not kwargs.get("stream"),
+        )
+
+
+class AsyncResilientAIClient(AsyncAIClient):
+    """ResilientAIClient の非同期版。ヘッジで負けたほうのリクエストはキャンセルする"""
+    def __init__(self, ai_client: AsyncAIClient, policy: Optional[ResiliencePolicy] = None):
+        self.ai_client = ai_client
+        self.policy = policy or ResiliencePolicy()
+
+    async def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        return await self.policy.acall(
+            kwargs.get("model", ""),
+            lambda model: self.ai_client.chat_completion(messages=messages, **{**kwargs, "model": model}),
+            hedge=not kwargs.get("stream"),
+        )
+
+
+class ResilienceMiddleware(AgentMiddleware):
+    """create_agent のモデル呼び出しを ResiliencePolicy 経由にするミドルウェア
+
+    fallback を渡すと、ブレーカーが開いたときや呼び出しに失敗したときにそのモデルで1回だけやり直す。
+    """
+    def __init__(self, policy: Optional[ResiliencePolicy] = None, fallback: Optional[BaseChatModel] = None):
+        super().__init__()
+        self.policy = policy or ResiliencePolicy()
+        self.fallback = fallback
+
+    @staticmethod
+    def _name(model: BaseChatModel) -> str:
+        return getattr(model, "model_name", None) or model._llm_type
+
+    def _request_for(self, request: ModelRequest, model: str) -> ModelRequest:
+        if self.fallback is not None and model != self._name(request.model):
+            return request.override(model=self.fallback)
+        return request
+
+    def wrap_model_call(self, request: ModelRequest, handler: Callable[[ModelRequest], ModelResponse]) -> ModelResponse:
+        return self.policy.call(
+            self._name(request.model),
+            lambda model: handler(self._request_for(request, model)),
+            fallback=self._name(self.fallback) if self.fallback is not None else None,
+        )
+
+    async def awrap_model_call(
+        self, request: ModelRequest, handler: Callable[[ModelRequest], Awaitable[ModelResponse]]
+    ) -> ModelResponse:
+        return await self.policy.acall(
+            self._name(request.model),
+            lambda model: handler(self._request_for(request, model)),
+            fallback=self._name(self.fallback) if self.fallback is not None else None,
+        )
+
+
+if __name__ == "__main__":
+    import random
+
+    class SlowTailAIClient(AIClient):
+        """動作確認用に、2% の確率で 1 秒かかる（それ以外は 50ms 前後の）AIClient"""
+        def __init__(self, seed: int = 0, failing: Optional[set] = None):
+            self.random = random.Random(seed)
+            self.failing = failing if failing is not None else set()
+            self.calls: Dict[str, int] = defaultdict(int)
+            self._lock = threading.Lock()
+
+        def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+            with self._lock:
+                self.calls[kwargs["model"]] += 1
+                slow = self.random.random() < 0.02
+                jitter = self.random.uniform(0.04, 0.06)
+            if kwargs["model"] in self.failing:
+                time.sleep(0.01)
+                raise ConnectionError("upstream unavailable")
+            time.sleep(1.0 if slow else jitter)
+            return {"model": kwargs["model"], "content": "ok"}
+
+    def run(client: AIClient, n: int = 1000, model: str = "gpt-4o") -> List[float]:
+        def one(_: int) -> float:
+            start = time.perf_counter()
+            client.chat_completion([{"role": "user", "content": "hi"}], model=model)
+            return time.perf_counter() - start
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            return sorted(executor.map(one, range(n)))
+
+    def p(latencies: List[float], q: float) -> float:
+        return latencies[min(int(q / 100 * len(latencies)), len(latencies) - 1)]
+
+    baseline = run(SlowTailAIClient())
+    print(f"baseline: p50={p(baseline, 50):.3f}s p99={p(baseline, 99):.3f}s")
+
+    policy = ResiliencePolicy(fallbacks={"gpt-4o": "gpt-4o-mini"})
+    hedged = run(ResilientAIClient(SlowTailAIClient(), policy))
+    print(f"hedged:   p50={p(hedged, 50):.3f}s p99={p(hedged, 99):.3f}s")
+    print(policy.stats.to_dict())
+
+    # gpt-4o が落ちている間はブレーカーが開き、gpt-4o-mini に切り替わる
+    upstream = SlowTailAIClient(failing={"gpt-4o"})
+    policy = ResiliencePolicy(fallbacks={"gpt-4o": "gpt-4o-mini"})
+    run(ResilientAIClient(upstream, policy), n=100)
+    print(f"outage: upstream calls={dict(upstream.calls)} breakers={policy.breaker_states()}")
+    print(policy.stats.to_dict())
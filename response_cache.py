@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from openai.types.chat import ChatCompletion
+
+from sample_gpt import AIClient
+
+
+def canonicalize(obj: Any) -> Any:
+    """キャッシュキー用に、dict の順序やモデルオブジェクトの違いを吸収した値に変換する"""
+    if hasattr(obj, "model_dump"):
+        obj = obj.model_dump(exclude_none=True)
+    if isinstance(obj, dict):
+        return {str(k): canonicalize(v) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0])) if v is not None}
+    if isinstance(obj, (list, tuple)):
+        return [canonicalize(v) for v in obj]
+    return obj
+
+
+def request_key(messages: List[Dict[str, Any]], **kwargs) -> str:
+    """リクエスト内容から決まるハッシュキーを返す"""
+    payload = canonicalize({"messages": messages, **kwargs})
+    raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    """キャッシュのヒット状況"""
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    bypassed: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**asdict(self), "hits": self.hits, "hit_rate": round(self.hit_rate, 4)}
+
+
+class DiskCache:
+    """SQLite を使った上限付きの2次キャッシュ"""
+    def __init__(self, path: str, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key: str, ttl: float) -> Tuple[Optional[str], float, bool]:
+        """(payload, created_at, expired) を返す"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT payload, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, 0.0, False
+            if now - row[1] > ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None, 0.0, True
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0], row[1], False
+
+    def put(self, key: str, payload: str, created_at: float) -> int:
+        """保存して、上限超過で削除した件数を返す"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, payload, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, payload, created_at, time.time()),
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            evicted = max(count - self.max_entries, 0)
+            if evicted:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                    (evicted,),
+                )
+            self._conn.commit()
+            return evicted
+
+
+class CachingAIClient(AIClient):
+    """レスポンスをリクエスト内容のハッシュでキャッシュする AIClient のデコレータ
+
+    1次キャッシュはメモリ上の LRU（TTL付き）、2次キャッシュは SQLite ファイル。
+    temperature が 0 でないリクエストは結果が毎回変わりうるため、force=True でない限りキャッシュしない。
+    """
+    def __init__(
+        self,
+        ai_client: AIClient,
+        max_entries: int = 1024,
+        ttl: float = 300.0,
+        db_path: Optional[str] = None,
+        max_db_entries: int = 10_000,
+        force: bool = False,
+    ):
+        self.ai_client = ai_client
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.force = force
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._disk = DiskCache(db_path, max_db_entries) if db_path else None
+
+    def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        if not self._is_cacheable(kwargs):
+            with self._lock:
+                self.stats.bypassed += 1
+            return self.ai_client.chat_completion(messages=messages, **kwargs)
+
+        key = request_key(messages, **kwargs)
+        payload = self._lookup(key)
+        if payload is not None:
+            return ChatCompletion.model_validate_json(payload)
+
+        response = self.ai_client.chat_completion(messages=messages, **kwargs)
+        self._store(key, response.model_dump_json())
+        return response
+
+    def _is_cacheable(self, kwargs: Dict[str, Any]) -> bool:
+        if kwargs.get("stream") or kwargs.get("n", 1) != 1:
+            return False
+        # temperature 未指定時の API のデフォルトは 1
+        return self.force or kwargs.get("temperature", 1) == 0
+
+    def _lookup(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, payload = entry
+                if now - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats.memory_hits += 1
+                    return payload
+                del self._memory[key]
+                self.stats.expirations += 1
+
+        if self._disk is not None:
+            payload, created_at, expired = self._disk.get(key, self.ttl)
+            with self._lock:
+                if expired:
+                    self.stats.expirations += 1
+                if payload is not None:
+                    self.stats.disk_hits += 1
+                    # TTL はディスクに保存した時刻から数える（メモリに載せ直しても延びない）
+                    self._put_memory(key, created_at, payload)
+                    return payload
+
+        with self._lock:
+            self.stats.misses += 1
+        return None
+
+    def _store(self, key: str, payload: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, now, payload)
+        if self._disk is not None:
+            evicted = self._disk.put(key, payload, now)
+            with self._lock:
+                self.stats.evictions += evicted
+
+    def _put_memory(self, key: str, created_at: float, payload: str) -> None:
+        # self._lock を取得した状態で呼ぶこと
+        self._memory[key] = (created_at, payload)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats.evictions += 1
+
+
+if __name__ == "__main__":
+    from sample_gpt import FunctionCallingService, MockWeatherService, OpenAIClient, ToolRegistry
+
+    ai_client = CachingAIClient(
+        OpenAIClient(api_key=os.getenv("OPENAI_API_KEY")),
+        db_path="response_cache.sqlite3",
+        force=True,
+    )
+    service = FunctionCallingService(ai_client, ToolRegistry(MockWeatherService()))
+
+    for _ in range(3):
+        service.process_query("Tokyoの天気はどうですか？")
+    print(ai_client.stats.to_dict())
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from text_index import CharNgramVectorizer
+
+# 再学習で読むログの既定の上限件数と、ログをローテートするサイズ
+MAX_LOG_RECORDS = 10_000
+MAX_LOG_BYTES = 16 * 1024 * 1024
+_LOG_BLOCK_SIZE = 64 * 1024
+
+
+def read_log(path: Path, max_records: int = MAX_LOG_RECORDS) -> List[dict]:
+    """JSONL ログの新しい方から最大 max_records 件を読む（ファイルの末尾から読むので、ログ全体は読まない）"""
+    path = Path(path)
+    if not path.exists():
+        return []
+    lines: List[bytes] = []
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        head = b""
+        # 末尾の空行と書き込み途中の行の分だけ余分に読む
+        while position > 0 and len(lines) < max_records + 2:
+            size = min(_LOG_BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            parts = (f.read(size) + head).split(b"\n")
+            # ブロックの先頭は行の途中かもしれないので、次のブロックとつなげてから使う
+            head = parts[0]
+            lines = parts[1:] + lines
+        if position == 0:
+            lines.insert(0, head)
+
+    records = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # 書き込み途中で落ちた行は捨てる
+            continue
+    return records[-max_records:]
+
+
+class RoleClassifier:
+    """ラベル付きの例文から作る、文字 n-gram TF-IDF の最近傍重心分類器"""
+    def __init__(self, vectorizer: CharNgramVectorizer, labels: List[str], centroids: np.ndarray, temperature: float = 20.0):
+        self.vectorizer = vectorizer
+        self.labels = labels
+        self.centroids = centroids
+        self.temperature = temperature
+
+    @classmethod
+    def fit(cls, texts: Sequence[str], labels: Sequence[str], **kwargs) -> "RoleClassifier":
+        vectorizer = CharNgramVectorizer(**kwargs).fit(texts)
+        names = sorted(set(labels))
+        rows = {name: i for i, name in enumerate(names)}
+        # (件数, n_features) の行列は作らず、ラベルごとの重心に直接足し込む
+        centroids = np.zeros((len(names), vectorizer.n_features), dtype=np.float32)
+        for text, label in zip(texts, labels):
+            buckets, weights = vectorizer.transform_sparse(text)
+            centroids[rows[label], buckets] += weights
+        # 平均してから正規化するのと同じなので、件数で割らずに正規化だけする
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        return cls(vectorizer, names, centroids)
+
+    @classmethod
+    def from_jsonl(cls, path: Path, max_records: int = MAX_LOG_RECORDS, **kwargs) -> "RoleClassifier":
+        """{"query": ..., "role": ...} 形式のログの新しい max_records 件から学習する"""
+        records = read_log(path, max_records)
+        return cls.fit([record["query"] for record in records], [record["role"] for record in records], **kwargs)
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """(ラベル, 確信度) を返す。確信度は類似度の softmax"""
+        buckets, weights = self.vectorizer.transform_sparse(text)
+        similarities = self.centroids[:, buckets] @ weights
+        exp = np.exp((similarities - similarities.max()) * self.temperature)
+        probabilities = exp / exp.sum()
+        best = int(np.argmax(probabilities))
+        return self.labels[best], float(probabilities[best])
+
+    def save(self, path: Path) -> None:
+        state = self.vectorizer.state()
+        np.savez_compressed(
+            path,
+            idf=state["idf"],
+            centroids=self.centroids,
+            meta=json.dumps({
+                "n_features": state["n_features"],
+                "ngram_range": state["ngram_range"],
+                "labels": self.labels,
+                "temperature": self.temperature,
+            }),
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "RoleClassifier":
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            vectorizer = CharNgramVectorizer.from_state({**meta, "idf": data["idf"]})
+            return cls(vectorizer, meta["labels"], data["centroids"], meta["temperature"])
+
+
+@dataclass
+class RouterStats:
+    fast_path: int = 0
+    fallback: int = 0
+    # 確信度が低くて LLM に回したときに、分類器の予測と LLM の結果が食い違った数
+    fallback_disagreements: int = 0
+    # 高速パスの結果を LLM でも確かめた（シャドー実行した）数と、そのうち食い違った数
+    shadowed: int = 0
+    shadow_disagreements: int = 0
+    classify_seconds: float = 0.0
+
+    @property
+    def fast_path_rate(self) -> float:
+        total = self.fast_path + self.fallback
+        return self.fast_path / total if total else 0.0
+
+    @property
+    def disagreement_rate(self) -> float:
+        compared = self.fallback + self.shadowed
+        disagreements = self.fallback_disagreements + self.shadow_disagreements
+        return disagreements / compared if compared else 0.0
+
+    def to_dict(self) -> dict:
+        total = self.fast_path + self.fallback
+        return {
+            **asdict(self),
+            "classify_us": round(self.classify_seconds / total * 1e6, 1) if total else 0.0,
+            "fast_path_rate": round(self.fast_path_rate, 4),
+            "disagreement_rate": round(self.disagreement_rate, 4),
+        }
+
+
+class FastPathRouter:
+    """ローカルの分類器で即答し、確信度が threshold 未満のときだけ LLM に判定させるルーター
+
+    LLM の判定結果は log_path に追記され、RoleClassifier.from_jsonl で再学習に使える。
+    ログが max_log_bytes を超えたら <log_path>.1 にローテートする（古い .1 は上書き）。
+    shadow_rate の割合で高速パスの結果も裏で LLM に確かめ、食い違いの頻度を計測する。
+    aroute は allm_select があればそれを await する（なければ llm_select をスレッドで実行する）。
+    """
+    def __init__(
+        self,
+        classifier: RoleClassifier,
+        llm_select: Callable[[str], str],
+        threshold: float = 0.6,
+        shadow_rate: float = 0.0,
+        log_path: Optional[Path] = None,
+        max_log_bytes: Optional[int] = MAX_LOG_BYTES,
+        allm_select: Optional[Callable[[str], Awaitable[str]]] = None,
+    ):
+        self.classifier = classifier
+        self.llm_select = llm_select
+        self.allm_select = allm_select
+        self.threshold = threshold
+        self.shadow_rate = shadow_rate
+        self.log_path = log_path
+        self.max_log_bytes = max_log_bytes
+        self.stats = RouterStats()
+        self._lock = threading.Lock()
+        self._shadow_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="router-shadow")
+
+    def _log(self, query: str, role: str) -> None:
+        if self.log_path is None:
+            return
+        with self._lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"query": query, "role": role}, ensure_ascii=False) + "\n")
+                size = f.tell()
+            if self.max_log_bytes is not None and size > self.max_log_bytes:
+                os.replace(self.log_path, f"{self.log_path}.1")
+
+    def _shadow(self, query: str, predicted: str) -> None:
+        role = self.llm_select(query)
+        self._log(query, role)
+        with self._lock:
+            self.stats.shadowed += 1
+            self.stats.shadow_disagreements += role != predicted
+
+    def _predict(self, query: str) -> Tuple[str, bool, float]:
+        """(予測したロール, 高速パスで返してよいか, 分類にかかった秒数) を返す"""
+        start = time.perf_counter()
+        predicted, confidence = self.classifier.predict(query)
+        elapsed = time.perf_counter() - start
+
+        if confidence < self.threshold:
+            return predicted, False, elapsed
+        with self._lock:
+            self.stats.fast_path += 1
+            self.stats.classify_seconds += elapsed
+        if self.shadow_rate and random.random() < self.shadow_rate:
+            self._shadow_executor.submit(self._shadow, query, predicted)
+        return predicted, True, elapsed
+
+    def _record_fallback(self, query: str, predicted: str, role: str, elapsed: float) -> None:
+        self._log(query, role)
+        with self._lock:
+            self.stats.fallback += 1
+            self.stats.classify_seconds += elapsed
+            self.stats.fallback_disagreements += role != predicted
+
+    def route(self, query: str) -> str:
+        predicted, fast, elapsed = self._predict(query)
+        if fast:
+            return predicted
+        role = self.llm_select(query)
+        self._record_fallback(query, predicted, role, elapsed)
+        return role
+
+    async def aroute(self, query: str) -> str:
+        predicted, fast, elapsed = self._predict(query)
+        if fast:
+            return predicted
+        if self.allm_select is not None:
+            role = await self.allm_select(query)
+        else:
+            role = await asyncio.to_thread(self.llm_select, query)
+        self._record_fallback(query, predicted, role, elapsed)
+        return role
+
+
+def evaluate(classifier: RoleClassifier, examples: Iterable[Tuple[str, str]], thresholds: Sequence[float]) -> List[Dict[str, float]]:
+    """しきい値ごとに、高速パスを通る割合とその正解率を返す（しきい値の調整用）"""
+    predictions = [(classifier.predict(text), label) for text, label in examples]
+    report = []
+    for threshold in thresholds:
+        taken = [(predicted, label) for (predicted, confidence), label in predictions if confidence >= threshold]
+        report.append({
+            "threshold": threshold,
+            "fast_path_rate": round(len(taken) / len(predictions), 4) if predictions else 0.0,
+            "fast_path_accuracy": round(sum(p == l for p, l in taken) / len(taken), 4) if taken else 0.0,
+        })
+    return report
@@ -1,9 +1,27 @@
+import asyncio
+import copy
+import functools
+import inspect
 import json
 import os
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, List, Optional, Any
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING, Annotated, Callable, Dict, Iterator, List, Literal, Optional, Tuple, Any
 
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+
+from client_factory import get_async_openai_client, get_openai_client
+from tool_catalog import ToolIndex, function_schema
+
+if TYPE_CHECKING:
+    # model_router は rate_limiter 経由でこのモジュールを import するため、型注釈にだけ使う
+    from model_router import ModelRouter
 
 
 # インターフェース（抽象クラス）
@@ -21,6 +39,13 @@ class AIClient(ABC):
         pass
 
 
+class AsyncAIClient(ABC):
+    """非同期AIクライアントのインターフェース"""
+    @abstractmethod
+    async def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        pass
+
+
 # 具象クラス
 class MockWeatherService(WeatherService):
     """モックの天気サービス実装"""
@@ -36,57 +61,173 @@ class MockWeatherService(WeatherService):
         if loc_info is None:
             return {"location": location, "temperature": "unknown"}
 
-        loc_info["unit"] = unit
-        return loc_info
+        # 共有データは書き換えずにコピーを返す
+        return {**loc_info, "unit": unit}
 
 
 class OpenAIClient(AIClient):
     """OpenAIのAPI実装"""
-    def __init__(self, api_key: Optional[str] = None):
-        if api_key is None:
-            raise ValueError("API key is required.")
+    def __init__(self, api_key: Optional[str] = None, client: Optional[OpenAI] = None):
+        if client is None:
+            if api_key is None:
+                raise ValueError("API key is required.")
+            client = get_openai_client(api_key=api_key)
 
-        self.client = OpenAI(api_key=api_key)
+        self.client = client
 
     def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
         return self.client.chat.completions.create(messages=messages, **kwargs)
 
 
+class AsyncOpenAIClient(AsyncAIClient):
+    """OpenAIのAPI実装（非同期版）"""
+    def __init__(self, api_key: Optional[str] = None, client: Optional[AsyncOpenAI] = None):
+        if client is None:
+            if api_key is None:
+                raise ValueError("API key is required.")
+            client = get_async_openai_client(api_key=api_key)
+
+        self.client = client
+
+    async def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        return await self.client.chat.completions.create(messages=messages, **kwargs)
+
+
 # ツール関連のクラス
+WEATHER_TOOL_DESCRIPTION = "Get the current weather in a given location"
+
+
 class ToolDefinition:
     """ツール定義を管理するクラス"""
     @staticmethod
+    @functools.cache
     def get_weather_tool_definition() -> Dict[str, Any]:
-        return {
-            "type": "function",
-            "function": {
-                "name": "get_current_weather",
-                "description": "Get the current weather in a given location",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "location": {
-                            "type": "string",
-                            "description": "The city and state, e.g. San Francisco, CA",
-                        },
-                        "unit": {
-                            "type": "string",
-                            "enum": ["celsius", "fahrenheit"],
-                        },
-                    },
-                    "required": ["location"],
-                },
-            }
-        }
+        """ToolRegistry._get_current_weather のシグネチャから作った定義（一度だけ作って使い回すので書き換えないこと）"""
+        return function_schema(
+            ToolRegistry._get_current_weather, name="get_current_weather", description=WEATHER_TOOL_DESCRIPTION,
+        )
+
+
+@dataclass(frozen=True)
+class ToolSpec:
+    """ツール関数と、その結果をキャッシュしてよいかどうかのメタデータ"""
+    func: Callable
+    cacheable: bool = False
+    ttl: float = 60.0
+    # キャッシュキー用に引数を正規化する関数（大文字小文字やデフォルト値の違いを吸収する）
+    normalize: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None
+    # モデルに渡すツール定義（登録時に関数のシグネチャから一度だけ作る）
+    schema: Dict[str, Any] = field(default_factory=dict)
+    # ツール検索用の別名やクエリに出てきそうな言い回し
+    keywords: str = ""
+
+
+@dataclass
+class ToolCacheStats:
+    hits: int = 0
+    misses: int = 0
+    expirations: int = 0
+    evictions: int = 0
+
+
+@dataclass
+class ToolResultCache:
+    """1ツール分の TTL 付き結果キャッシュ（スレッドセーフ）
+
+    引数ごとに entry が増えるので、max_entries 件を超えたら最後に使われたのが古いものから消す。
+    """
+    ttl: float
+    max_entries: int = 1024
+    stats: ToolCacheStats = field(default_factory=ToolCacheStats)
+    _entries: "OrderedDict[str, Tuple[float, Any]]" = field(default_factory=OrderedDict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    _MISSING = object()
+
+    def get(self, key: str) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return self._MISSING
+            expires_at, value = entry
+            if expires_at < now:
+                del self._entries[key]
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return self._MISSING
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+        # 呼び出し側が結果を書き換えても共有キャッシュに影響しないようにする
+        return value if isinstance(value, (str, bytes, int, float, bool)) else copy.deepcopy(value)
+
+    def put(self, key: str, value: Any) -> None:
+        if not isinstance(value, (str, bytes, int, float, bool)):
+            value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
 
 
 class ToolRegistry:
     """利用可能なツール関数を管理するレジストリ"""
     def __init__(self, weather_service: WeatherService):
         self.weather_service = weather_service
-        self._registry = {
-            "get_current_weather": self._get_current_weather,
-        }
+        self._lock = threading.Lock()
+        self._specs: Dict[str, ToolSpec] = {}
+        self._registry: Dict[str, Callable] = {}
+        self._caches: Dict[str, ToolResultCache] = {}
+        self._definitions: Optional[List[Dict[str, Any]]] = None
+        self._index: Optional[ToolIndex] = None
+        self.register(
+            "get_current_weather",
+            self._get_current_weather,
+            cacheable=True,
+            ttl=600.0,
+            normalize=lambda args: {
+                "location": str(args.get("location", "")).strip().lower(),
+                "unit": args.get("unit") or "fahrenheit",
+            },
+            schema=ToolDefinition.get_weather_tool_definition(),
+            keywords="天気 気温 湿度 予報 weather temperature forecast",
+        )
+
+    def register(
+        self,
+        func_name: str,
+        func: Callable,
+        cacheable: bool = False,
+        ttl: float = 60.0,
+        normalize: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        description: Optional[str] = None,
+        keywords: str = "",
+        schema: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """ツール関数を登録する（同期関数・async関数のどちらも可）
+
+        schema を省略すると func のシグネチャと docstring からツール定義を作る（tool_catalog.function_schema）。
+        """
+        if schema is None:
+            schema = function_schema(func, name=func_name, description=description)
+        spec = ToolSpec(func=func, cacheable=cacheable, ttl=ttl, normalize=normalize, schema=schema, keywords=keywords)
+        with self._lock:
+            self._specs[func_name] = spec
+            self._definitions = None
+            self._index = None
+            if cacheable:
+                cache = self._caches[func_name] = ToolResultCache(ttl=ttl)
+                self._registry[func_name] = self._memoize(spec, cache)
+            else:
+                self._caches.pop(func_name, None)
+                self._registry[func_name] = func
+
+    def is_async(self, func_name: str) -> bool:
+        """ツール関数がasync関数かどうかを返す"""
+        return inspect.iscoroutinefunction(self.get_function(func_name))
 
     def get_function(self, func_name: str) -> Callable:
         """関数名から対応する関数を取得"""
@@ -95,22 +236,108 @@ class ToolRegistry:
             raise ValueError(f"Function {func_name} not found.")
         return func
 
-    def _get_current_weather(self, location: str, unit: str = "fahrenheit") -> str:
+    def get_spec(self, func_name: str) -> ToolSpec:
+        """関数名から登録時のメタデータを取得"""
+        spec = self._specs.get(func_name)
+        if spec is None:
+            raise ValueError(f"Function {func_name} not found.")
+        return spec
+
+    def definitions(self) -> List[Dict[str, Any]]:
+        """登録済みの全ツールの定義（登録が変わるまで同じリストを返すので書き換えないこと）"""
+        with self._lock:
+            if self._definitions is None:
+                self._definitions = [spec.schema for spec in self._specs.values()]
+            return self._definitions
+
+    def select(self, query: str, k: int) -> List[Dict[str, Any]]:
+        """query に近いツールの定義を k 件返す。ツールが k 件以下なら全件"""
+        if len(self._specs) <= k:
+            return self.definitions()
+        with self._lock:
+            if self._index is None:
+                specs = list(self._specs.values())
+                self._index = ToolIndex([spec.schema for spec in specs], [spec.keywords for spec in specs])
+            index = self._index
+        return [schema for schema, _ in index.search(query, k)]
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """キャッシュ対象ツールごとのヒット状況"""
+        return {name: asdict(cache.stats) for name, cache in self._caches.items()}
+
+    @staticmethod
+    def _memoize(spec: ToolSpec, cache: ToolResultCache) -> Callable:
+        def cache_key(kwargs: Dict[str, Any]) -> str:
+            args = spec.normalize(kwargs) if spec.normalize else kwargs
+            return json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)
+
+        if inspect.iscoroutinefunction(spec.func):
+            async def async_wrapper(**kwargs):
+                key = cache_key(kwargs)
+                result = cache.get(key)
+                if result is ToolResultCache._MISSING:
+                    result = await spec.func(**kwargs)
+                    cache.put(key, result)
+                return result
+            return async_wrapper
+
+        def wrapper(**kwargs):
+            key = cache_key(kwargs)
+            result = cache.get(key)
+            if result is ToolResultCache._MISSING:
+                result = spec.func(**kwargs)
+                cache.put(key, result)
+            return result
+        return wrapper
+
+    def _get_current_weather(
+        self,
+        location: Annotated[str, "The city and state, e.g. San Francisco, CA"],
+        unit: Optional[Literal["celsius", "fahrenheit"]] = "fahrenheit",
+    ) -> str:
         """天気情報を取得してJSON文字列で返す"""
-        weather_info = self.weather_service.get_weather(location, unit)
+        weather_info = self.weather_service.get_weather(location, unit or "fahrenheit")
         return json.dumps(weather_info)
 
 
+def _has_content(response: Any) -> bool:
+    return bool(response.choices and response.choices[0].message.content)
+
+
+def routed_completion(
+    ai_client: AIClient,
+    router: Optional["ModelRouter"],
+    task: str,
+    default_model: str,
+    messages: List[Dict[str, Any]],
+    **kwargs,
+) -> Any:
+    """router があればタスクと入力からモデルを選んで呼び出し、なければ default_model で呼び出す"""
+    if router is None:
+        return ai_client.chat_completion(model=default_model, messages=messages, **kwargs)
+    return router.call(
+        task,
+        messages,
+        lambda model: ai_client.chat_completion(model=model, messages=messages, **kwargs),
+        tools=kwargs.get("tools"),
+        check=None if kwargs.get("tools") or kwargs.get("stream") else _has_content,
+    )
+
+
 # サービスクラス
 class ChatService:
     """チャット機能を提供するサービス"""
-    def __init__(self, ai_client: AIClient):
+    def __init__(self, ai_client: AIClient, router: Optional["ModelRouter"] = None):
         self.ai_client = ai_client
+        self.router = router
 
     def image_description(self, image_url: str) -> str:
         """画像説明機能"""
-        response = self.ai_client.chat_completion(
-            model="gpt-4o-mini",
+        response = routed_completion(
+            self.ai_client,
+            self.router,
+            "vision",
+            "gpt-4o-mini",
             messages=[
                 {"role": "user", "content": [
                     {"type": "text", "text": "画像を説明してください。"},
@@ -123,21 +350,31 @@ class ChatService:
 
 class FunctionCallingService:
     """関数呼び出し機能を提供するサービス"""
-    def __init__(self, ai_client: AIClient, tool_registry: ToolRegistry):
+    def __init__(
+        self,
+        ai_client: AIClient,
+        tool_registry: ToolRegistry,
+        async_ai_client: Optional[AsyncAIClient] = None,
+        tool_timeout: float = 10.0,
+        router: Optional["ModelRouter"] = None,
+        max_tools: Optional[int] = None,
+    ):
         self.ai_client = ai_client
         self.tool_registry = tool_registry
+        self.async_ai_client = async_ai_client
+        self.tool_timeout = tool_timeout
+        # ツールを選ぶ1回目は tool_selection、ツールの結果をまとめる2回目は tool_summary としてモデルを選ぶ
+        self.router = router
+        # 指定するとクエリに近いツールだけをモデルに渡す（ツールが多いときのプロンプトを小さくする）
+        self.max_tools = max_tools
 
     def process_query(self, user_query: str) -> str:
         """ユーザーのクエリを処理して結果を返す"""
         messages = [{"role": "user", "content": user_query}]
-        tools = [ToolDefinition.get_weather_tool_definition()]
+        tools = self._tools(user_query)
 
         # 最初のAPIコール
-        response = self.ai_client.chat_completion(
-            model="gpt-4o",
-            messages=messages,
-            tools=tools,
-        )
+        response = self._complete("tool_selection", messages, tools=tools)
 
         res_msg = response.choices[0].message
         messages.append(res_msg.to_dict())
@@ -148,26 +385,168 @@ class FunctionCallingService:
             func = self.tool_registry.get_function(func_name)
             func_args = json.loads(tool_call.function.arguments)
 
-            result = func(
-                location=func_args.get("location"),
-                unit=func_args.get("unit"),
-            )
-
-            messages.append({
-                "tool_call_id": tool_call.id,
-                "role": "tool",
-                "name": func_name,
-                "content": result,
-            })
+            # async関数で登録されたツールは、コルーチンのまま渡さずにこのスレッドで実行する
+            if self.tool_registry.is_async(func_name):
+                result = asyncio.run(func(**func_args))
+            else:
+                result = func(**func_args)
+            messages.append(self._tool_message(tool_call, result))
 
         # 最終回答の取得
-        second_res = self.ai_client.chat_completion(
-            model="gpt-4o",
-            messages=messages,
+        second_res = self._complete("tool_summary", messages)
+
+        return second_res.to_json(indent=2)
+
+    async def aprocess_query(self, user_query: str) -> str:
+        """ユーザーのクエリを非同期で処理して結果を返す
+
+        1つのアシスタントメッセージに含まれるツール呼び出しは並行に実行する。
+        """
+        if self.async_ai_client is None:
+            raise ValueError("Async AI client is required.")
+
+        messages = [{"role": "user", "content": user_query}]
+        tools = self._tools(user_query)
+
+        # 最初のAPIコール
+        response = await self._acomplete("tool_selection", messages, tools=tools)
+
+        res_msg = response.choices[0].message
+        messages.append(res_msg.to_dict())
+
+        # ツール呼び出しを並行に処理（結果の順序はtool_callsの順序を保つ）
+        tool_messages = await asyncio.gather(
+            *(self._acall_tool(tool_call) for tool_call in res_msg.tool_calls or [])
         )
+        messages.extend(tool_messages)
+
+        # 最終回答の取得
+        second_res = await self._acomplete("tool_summary", messages)
 
         return second_res.to_json(indent=2)
 
+    def stream_query(self, user_query: str) -> Iterator[str]:
+        """ユーザーのクエリを処理し、回答のトークンを生成され次第 yield する
+
+        1回目のレスポンスもストリーミングで受け取り、引数が揃ったツールから順に実行を開始する。
+        """
+        messages = [{"role": "user", "content": user_query}]
+        tools = self._tools(user_query)
+
+        content_parts: List[str] = []
+        tool_calls: List[ChatCompletionMessageToolCall] = []
+        pending: List[Future] = []
+
+        # with 文だと抜けるときにツールの終了を待ってしまい tool_timeout が効かないので、待たずに shutdown する
+        executor = ThreadPoolExecutor(max_workers=8)
+        try:
+            # 最初のAPIコール（ツールを使わない場合はこの回答がそのまま最終回答になる）
+            stream = self._complete("tool_selection", messages, tools=tools, stream=True)
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                    yield delta.content
+
+                for tc_delta in delta.tool_calls or []:
+                    # ツール呼び出しは index 順に届くので、次の index が来たら前のものは引数が確定している
+                    while len(tool_calls) <= tc_delta.index:
+                        if tool_calls:
+                            pending.append(self._submit_tool(executor, tool_calls[-1]))
+                        tool_calls.append(ChatCompletionMessageToolCall(
+                            id="", type="function", function={"name": "", "arguments": ""},
+                        ))
+                    tool_call = tool_calls[tc_delta.index]
+                    if tc_delta.id:
+                        tool_call.id = tc_delta.id
+                    if tc_delta.function and tc_delta.function.name:
+                        tool_call.function.name += tc_delta.function.name
+                    if tc_delta.function and tc_delta.function.arguments:
+                        tool_call.function.arguments += tc_delta.function.arguments
+
+            if not tool_calls:
+                return
+            pending.append(self._submit_tool(executor, tool_calls[-1]))
+
+            res_msg = ChatCompletionMessage(
+                role="assistant",
+                content="".join(content_parts) or None,
+                tool_calls=tool_calls,
+            )
+            messages.append(res_msg.to_dict())
+
+            # tool_timeout はツールごとではなく、全ツールの待ち時間の合計に対する期限にする
+            deadline = time.monotonic() + self.tool_timeout
+            for tool_call, future in zip(tool_calls, pending):
+                try:
+                    result = future.result(timeout=max(deadline - time.monotonic(), 0.0))
+                except FutureTimeoutError:
+                    result = json.dumps({"error": f"{tool_call.function.name} timed out after {self.tool_timeout}s"})
+                messages.append(self._tool_message(tool_call, result))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # 最終回答をストリーミングで取得
+        second_stream = self._complete("tool_summary", messages, stream=True)
+        for chunk in second_stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def _tools(self, user_query: str) -> List[Dict[str, Any]]:
+        if self.max_tools is None:
+            return self.tool_registry.definitions()
+        return self.tool_registry.select(user_query, self.max_tools)
+
+    def _complete(self, task: str, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        return routed_completion(self.ai_client, self.router, task, "gpt-4o", messages, **kwargs)
+
+    async def _acomplete(self, task: str, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        def call(model: str) -> Any:
+            return self.async_ai_client.chat_completion(model=model, messages=messages, **kwargs)
+
+        if self.router is None:
+            return await call("gpt-4o")
+        return await self.router.acall(
+            task, messages, call, tools=kwargs.get("tools"), check=None if kwargs.get("tools") else _has_content,
+        )
+
+    def _submit_tool(self, executor: ThreadPoolExecutor, tool_call: ChatCompletionMessageToolCall) -> Future:
+        """引数が確定したツール呼び出しをバックグラウンドで実行する"""
+        func = self.tool_registry.get_function(tool_call.function.name)
+        func_args = json.loads(tool_call.function.arguments or "{}")
+        if self.tool_registry.is_async(tool_call.function.name):
+            return executor.submit(asyncio.run, func(**func_args))
+        return executor.submit(func, **func_args)
+
+    async def _acall_tool(self, tool_call: Any) -> Dict[str, Any]:
+        """ツールを1つ実行する。async関数はそのまま、同期関数はスレッドで実行する"""
+        func_name = tool_call.function.name
+        func = self.tool_registry.get_function(func_name)
+        func_args = json.loads(tool_call.function.arguments)
+
+        if self.tool_registry.is_async(func_name):
+            call = func(**func_args)
+        else:
+            call = asyncio.to_thread(func, **func_args)
+
+        try:
+            result = await asyncio.wait_for(call, timeout=self.tool_timeout)
+        except asyncio.TimeoutError:
+            result = json.dumps({"error": f"{func_name} timed out after {self.tool_timeout}s"})
+
+        return self._tool_message(tool_call, result)
+
+    @staticmethod
+    def _tool_message(tool_call: Any, result: str) -> Dict[str, Any]:
+        return {
+            "tool_call_id": tool_call.id,
+            "role": "tool",
+            "name": tool_call.function.name,
+            "content": result,
+        }
+
 
 # メイン実行
 def sample_chatgpt():
@@ -176,8 +555,11 @@ def sample_chatgpt():
     ai_client = OpenAIClient(api_key=os.getenv("OPENAI_API_KEY"))
     tool_registry = ToolRegistry(weather_service)
 
-    # サービスの作成
-    function_calling_service = FunctionCallingService(ai_client, tool_registry)
+    # サービスの作成（ツール結果をまとめる2回目の呼び出しは小さいモデルに振る）
+    from model_router import load_router
+
+    router = load_router(log_path=os.getenv("MODEL_ROUTER_LOG", "model_router_log.jsonl"))
+    function_calling_service = FunctionCallingService(ai_client, tool_registry, router=router)
 
     # サンプル実行
     # image_url = "https://raw.githubusercontent.com/yoshidashingo/langchain-book/main/assets/cover.jpg"
@@ -186,7 +568,30 @@ def sample_chatgpt():
 
     result = function_calling_service.process_query("Tokyoの天気はどうですか？")
     print(result)
+    print(router.stats())
+
+    # for token in function_calling_service.stream_query("Tokyoの天気はどうですか？"):
+    #     print(token, end="", flush=True)
+
+
+async def asample_chatgpt():
+    weather_service = MockWeatherService()
+    tool_registry = ToolRegistry(weather_service)
+    api_key = os.getenv("OPENAI_API_KEY")
+
+    function_calling_service = FunctionCallingService(
+        OpenAIClient(api_key=api_key),
+        tool_registry,
+        async_ai_client=AsyncOpenAIClient(api_key=api_key),
+    )
+
+    # 1つのイベントループで複数のクエリを同時に処理する
+    queries = ["Tokyoの天気はどうですか？", "ParisとSan Franciscoの天気を教えて"]
+    results = await asyncio.gather(*(function_calling_service.aprocess_query(q) for q in queries))
+    for result in results:
+        print(result)
 
 
 if __name__ == "__main__":
     sample_chatgpt()
+    # asyncio.run(asample_chatgpt())
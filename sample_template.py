@@ -1,7 +1,9 @@
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from pydantic import BaseModel, Field
 
+from client_factory import get_chat_model
+from structured_stream import PartialModelParser, json_schema_format
+
 
 class Recipe(BaseModel):
     ingredients: list[str] = Field(description="ingredients of the dish")
@@ -22,7 +24,7 @@ def sample_prompt():
     # output_parser = PydanticOutputParser(pydantic_object=Recipe)
     # prompt_with_format_instructions = prompt.partial(format_instructions=output_parser.get_format_instructions())
 
-    model = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    model = get_chat_model("gpt-4o-mini", temperature=0)
     chain = prompt | model.with_structured_output(Recipe)
 
     recipe = chain.invoke({"dish": "curry"})
@@ -30,5 +32,30 @@ def sample_prompt():
     print(recipe)
 
 
+def sample_prompt_stream():
+    """材料が揃った時点で表示し、手順は生成されたものから順に表示する"""
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                "Please tell me the recipe from user input."
+            ),
+            ("human", "{dish}")
+        ]
+    )
+
+    model = get_chat_model("gpt-4o-mini", temperature=0).bind(response_format=json_schema_format(Recipe))
+    chain = prompt | model | PartialModelParser(pydantic_object=Recipe)
+
+    shown_ingredients = shown_steps = 0
+    for recipe in chain.stream({"dish": "curry"}):
+        for ingredient in recipe.ingredients[shown_ingredients:]:
+            print(f"ingredient: {ingredient}")
+        for step in recipe.steps[shown_steps:]:
+            print(f"step: {step}")
+        shown_ingredients, shown_steps = len(recipe.ingredients), len(recipe.steps)
+
+
 if __name__ == "__main__":
     sample_prompt()
+    # sample_prompt_stream()
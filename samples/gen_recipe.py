@@ -1,4 +1,12 @@
-from openai import OpenAI
+import sys
+from pathlib import Path
+from typing import Any
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from client_factory import get_openai_client  # noqa: E402
+from response_cache import request_key  # noqa: E402
+from single_flight import SingleFlight  # noqa: E402
 
 
 prompt = """
@@ -13,15 +21,24 @@ Dish name: {dish}
 """
 
 
-def gen_recipe(dish: str) -> str:
-    client = OpenAI()
-
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
+def recipe_request(dish: str) -> dict[str, Any]:
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
             {"role": "user", "content": prompt.format(dish=dish)},
         ],
-    )
+    }
+
+
+# 同じ料理のリクエストが同時に来たら、API は1回だけ呼ぶ
+recipe_flight = SingleFlight()
+
+
+def gen_recipe(dish: str) -> str:
+    client = get_openai_client()
+
+    body = recipe_request(dish)
+    response = recipe_flight.do(request_key(**body), lambda: client.chat.completions.create(**body))
 
     return response.choices[0].message.content
 
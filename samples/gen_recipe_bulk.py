@@ -0,0 +1,311 @@
+import argparse
+import json
+import sys
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from client_factory import get_openai_client  # noqa: E402
+from gen_recipe import recipe_request  # noqa: E402
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+
+# リクエストボディ（chat.completions.create の引数）を受け取り、レスポンスの dict を返す関数
+CompleteFn = Callable[[dict[str, Any]], dict[str, Any]]
+
+
+def openai_complete(body: dict[str, Any]) -> dict[str, Any]:
+    return get_openai_client().chat.completions.create(**body).to_dict()
+
+
+def fake_complete(body: dict[str, Any]) -> dict[str, Any]:
+    """テスト用のローカル実装。API を呼ばずにそれらしいレスポンスを返す"""
+    content = f"Recipe for: {body['messages'][-1]['content'].strip().splitlines()[-1]}"
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": 40, "completion_tokens": completion_tokens, "total_tokens": 40 + completion_tokens},
+    }
+
+
+@dataclass
+class Dish:
+    custom_id: str
+    name: str
+
+
+def read_dishes(path: Path) -> Iterator[Dish]:
+    """JSONL から料理名を読む。各行は {"dish": "...", "id": "..."}（id は省略可）"""
+    with path.open(encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            yield Dish(custom_id=str(row.get("id", f"dish-{line_no}")), name=row["dish"])
+
+
+def completed_ids(output_path: Path) -> set[str]:
+    """出力済みの custom_id を返す（再開用のチェックポイント）"""
+    if not output_path.exists():
+        return set()
+
+    done = set()
+    with output_path.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中で落ちた最終行は捨てて再実行する
+                continue
+            if row.get("error") is None:
+                done.add(row["custom_id"])
+    return done
+
+
+class ThroughputReport:
+    """レシピ数とトークン数からスループットを集計する"""
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.recipes = 0
+        self.errors = 0
+        self.completion_tokens = 0
+
+    def add(self, row: dict[str, Any]) -> None:
+        if row.get("error") is not None:
+            self.errors += 1
+            return
+        self.recipes += 1
+        self.completion_tokens += (row.get("usage") or {}).get("completion_tokens", 0)
+
+    def summary(self) -> dict[str, Any]:
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            "recipes": self.recipes,
+            "errors": self.errors,
+            "elapsed_s": round(elapsed, 3),
+            "recipes_per_s": round(self.recipes / elapsed, 2) if elapsed else 0.0,
+            "tokens_per_s": round(self.completion_tokens / elapsed, 2) if elapsed else 0.0,
+        }
+
+
+def result_row(dish: Dish, response: dict[str, Any] | None, error: str | None = None) -> dict[str, Any]:
+    if response is None:
+        return {"custom_id": dish.custom_id, "dish": dish.name, "recipe": None, "usage": None, "error": error}
+    return {
+        "custom_id": dish.custom_id,
+        "dish": dish.name,
+        "recipe": response["choices"][0]["message"]["content"],
+        "usage": response.get("usage"),
+        "error": None,
+    }
+
+
+def run_pool(
+    dishes: Iterable[Dish],
+    output_path: Path,
+    complete: CompleteFn = openai_complete,
+    concurrency: int = 8,
+) -> dict[str, Any]:
+    """上限付きのワーカープールで生成し、終わったものから出力に追記する"""
+    report = ThroughputReport()
+    dishes = iter(dishes)
+
+    def generate(dish: Dish) -> dict[str, Any]:
+        try:
+            return result_row(dish, complete(recipe_request(dish.name)))
+        except Exception as e:
+            return result_row(dish, None, error=str(e))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, output_path.open("a", encoding="utf-8") as out:
+        in_flight: set[Future] = set()
+        exhausted = False
+        while in_flight or not exhausted:
+            # 入力は読みながら投入し、未完了のタスク数を上限で抑える
+            while not exhausted and len(in_flight) < concurrency * 2:
+                dish = next(dishes, None)
+                if dish is None:
+                    exhausted = True
+                    break
+                in_flight.add(executor.submit(generate, dish))
+
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                row = future.result()
+                out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                report.add(row)
+            out.flush()
+
+    return report.summary()
+
+
+class BatchBackend(ABC):
+    """プロバイダのバッチ API のインターフェース"""
+    @abstractmethod
+    def submit(self, input_path: Path) -> str:
+        pass
+
+    @abstractmethod
+    def status(self, batch_id: str) -> str:
+        pass
+
+    @abstractmethod
+    def results(self, batch_id: str) -> Iterator[dict[str, Any]]:
+        pass
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """OpenAI の Batch API 実装"""
+    def __init__(self) -> None:
+        self.client = get_openai_client()
+
+    def submit(self, input_path: Path) -> str:
+        with input_path.open("rb") as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=CHAT_COMPLETIONS_URL,
+            completion_window="24h",
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id: str) -> Iterator[dict[str, Any]]:
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if line:
+                    yield json.loads(line)
+
+
+class LocalBatchBackend(BatchBackend):
+    """テスト用のバッチエンドポイント。Batch API と同じ形式のファイルを読み書きする"""
+    def __init__(self, workdir: Path, complete: CompleteFn = fake_complete):
+        self.workdir = workdir
+        self.complete = complete
+        self.workdir.mkdir(parents=True, exist_ok=True)
+
+    def submit(self, input_path: Path) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        with input_path.open(encoding="utf-8") as src, (self.workdir / f"{batch_id}.jsonl").open("w", encoding="utf-8") as dst:
+            for line in src:
+                request = json.loads(line)
+                response = self.complete(request["body"])
+                dst.write(json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": response},
+                    "error": None,
+                }, ensure_ascii=False) + "\n")
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        return "completed" if (self.workdir / f"{batch_id}.jsonl").exists() else "failed"
+
+    def results(self, batch_id: str) -> Iterator[dict[str, Any]]:
+        path = self.workdir / f"{batch_id}.jsonl"
+        if not path.exists():
+            # 失敗したバッチには出力ファイルがない（Batch API の output_file_id が None の場合と同じ）
+            return
+        with path.open(encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def run_batch(
+    dishes: Iterable[Dish],
+    output_path: Path,
+    backend: BatchBackend,
+    poll_interval: float = 30.0,
+) -> dict[str, Any]:
+    """バッチジョブとして投入し、完了後に結果を出力に追記する
+
+    投入したバッチ ID は <output>.batch に保存し、再起動時は再投入せずに同じバッチを待つ。
+    バッチが終わったら（failed / expired / cancelled でも）<output>.batch を消すので、
+    次の実行では出力に成功行のない料理だけを新しいバッチとして投入し直す。
+    """
+    report = ThroughputReport()
+    state_path = output_path.with_suffix(output_path.suffix + ".batch")
+    by_id = {dish.custom_id: dish for dish in dishes}
+
+    if state_path.exists():
+        batch_id = state_path.read_text().strip()
+    else:
+        if not by_id:
+            return report.summary()
+        input_path = output_path.with_suffix(output_path.suffix + ".requests")
+        with input_path.open("w", encoding="utf-8") as f:
+            for dish in by_id.values():
+                f.write(json.dumps({
+                    "custom_id": dish.custom_id,
+                    "method": "POST",
+                    "url": CHAT_COMPLETIONS_URL,
+                    "body": recipe_request(dish.name),
+                }, ensure_ascii=False) + "\n")
+        batch_id = backend.submit(input_path)
+        state_path.write_text(batch_id)
+
+    while (status := backend.status(batch_id)) not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+
+    with output_path.open("a", encoding="utf-8") as out:
+        for line in backend.results(batch_id):
+            dish = by_id.get(line["custom_id"])
+            if dish is None:
+                continue
+            response = line.get("response") or {}
+            if line.get("error") or response.get("status_code") != 200:
+                row = result_row(dish, None, error=json.dumps(line.get("error") or response.get("body")))
+            else:
+                row = result_row(dish, response["body"])
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            report.add(row)
+
+    state_path.unlink()
+    return report.summary()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="JSONL の料理名からレシピをまとめて生成する")
+    parser.add_argument("input", type=Path)
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--mode", choices=["pool", "batch"], default="pool")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--poll-interval", type=float, default=30.0)
+    parser.add_argument("--local", action="store_true", help="API を呼ばずにローカルのスタブで実行する")
+    args = parser.parse_args()
+
+    done = completed_ids(args.output)
+    dishes = (dish for dish in read_dishes(args.input) if dish.custom_id not in done)
+    complete = fake_complete if args.local else openai_complete
+
+    if args.mode == "pool":
+        summary = run_pool(dishes, args.output, complete=complete, concurrency=args.concurrency)
+    else:
+        backend = (
+            LocalBatchBackend(args.output.parent / "local_batches", complete)
+            if args.local
+            else OpenAIBatchBackend()
+        )
+        summary = run_batch(dishes, args.output, backend, poll_interval=args.poll_interval)
+
+    print(json.dumps({"skipped": len(done), **summary}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
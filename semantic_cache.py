@@ -0,0 +1,270 @@
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from vector_store import MmapVectorStore
+
+_NAMESPACE_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+_NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+
+def numbers(text: str) -> List[str]:
+    """テキスト中の数値を出てきた順に返す（全角数字は半角にそろえる）"""
+    return _NUMBER_PATTERN.findall(unicodedata.normalize("NFKC", text))
+
+
+def input_text(value: Any) -> str:
+    """チェーンの入力を埋め込み用のテキストにする（dict はキー順に「キー: 値」を並べる）"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return "\n".join(f"{k}: {value[k]}" for k in sorted(value))
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+
+
+def _encode(output: Any) -> Optional[str]:
+    """キャッシュに保存できる形（JSON）に変換する。変換できなければ None"""
+    if isinstance(output, BaseMessage):
+        return json.dumps({"message": message_to_dict(output)}, ensure_ascii=False)
+    try:
+        return json.dumps({"value": output}, ensure_ascii=False)
+    except TypeError:
+        return None
+
+
+def _decode(payload: str) -> Any:
+    data = json.loads(payload)
+    if "message" in data:
+        return messages_from_dict([data["message"]])[0]
+    return data["value"]
+
+
+@dataclass
+class SemanticCacheStats:
+    """名前空間ごとのヒット状況"""
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    # 類似度は threshold 以上だったが、数値が違うのでヒットにしなかった数
+    number_mismatches: int = 0
+    # 出力を JSON にできず保存しなかった数
+    skipped: int = 0
+    # ヒットしたときの類似度の合計（平均を出すため）
+    hit_similarity: float = 0.0
+    lookup_seconds: float = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            **asdict(self),
+            "hit_rate": round(self.hit_rate, 4),
+            "mean_hit_similarity": round(self.hit_similarity / self.hits, 4) if self.hits else 0.0,
+            "lookup_ms": round(self.lookup_seconds / lookups * 1000, 3) if lookups else 0.0,
+        }
+
+
+class SemanticCache:
+    """入力の埋め込みが近い過去の呼び出しの出力を返すキャッシュ
+
+    名前空間（チェーン）ごとに path/<名前空間> の MmapVectorStore に入力のベクトルを置き、出力と最終アクセス時刻は
+    path/entries.sqlite3 に保存する。類似度が threshold 以上の最近傍があればその出力を返す。
+    各名前空間は max_entries 件までで、超えたら最後に使われたのが古いものから消す。ttl 秒を過ぎた出力は返さない。
+    数値だけが違う質問（"10 + 2 * 3" と "10 + 2 * 4"）も類似度は高くなるので、exact_numbers=True（既定）では
+    類似度に加えて入力中の数値が順番まで一致したときだけヒットにする。threshold は実際の質問で調整すること。
+    """
+    def __init__(
+        self,
+        path: str,
+        embedding: Embeddings,
+        threshold: float = 0.95,
+        max_entries: int = 10_000,
+        ttl: Optional[float] = None,
+        exact_numbers: bool = True,
+    ):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.embedding = embedding
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.exact_numbers = exact_numbers
+        self.stats: Dict[str, SemanticCacheStats] = {}
+        self._stores: Dict[str, MmapVectorStore] = {}
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self.path / "entries.sqlite3", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " id TEXT PRIMARY KEY, namespace TEXT NOT NULL, input TEXT NOT NULL, output TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_namespace_accessed ON entries (namespace, accessed_at)")
+        self._db.commit()
+
+    def _store(self, namespace: str) -> MmapVectorStore:
+        store = self._stores.get(namespace)
+        if store is None:
+            if not _NAMESPACE_PATTERN.match(namespace):
+                raise ValueError(f"Invalid namespace: {namespace!r}")
+            store = self._stores[namespace] = MmapVectorStore(str(self.path / namespace), self.embedding)
+        return store
+
+    def _stats(self, namespace: str) -> SemanticCacheStats:
+        return self.stats.setdefault(namespace, SemanticCacheStats())
+
+    def _delete(self, namespace: str, ids: list) -> None:
+        if ids:
+            self._store(namespace).delete(ids)
+            self._db.executemany("DELETE FROM entries WHERE id = ?", [(id_,) for id_ in ids])
+            self._db.commit()
+
+    def lookup_vector(self, namespace: str, vector: np.ndarray, text: Optional[str] = None) -> Optional[Tuple[Any, float]]:
+        """ヒットすれば (出力, 類似度)、しなければ None を返す
+
+        text（埋め込んだ入力）を渡すと、exact_numbers のときに登録済みの入力と数値が一致するかも確かめる。
+        """
+        start = time.perf_counter()
+        with self._lock:
+            stats = self._stats(namespace)
+            results = self._store(namespace).similarity_search_by_vector_with_score(vector.tolist(), k=1)
+            hit = None
+            if results and results[0][1] >= self.threshold:
+                doc, similarity = results[0]
+                row = self._db.execute("SELECT output, created_at, input FROM entries WHERE id = ?", (doc.id,)).fetchone()
+                now = time.time()
+                if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                    self._delete(namespace, [doc.id])
+                    stats.expirations += 1
+                elif row is not None and self.exact_numbers and text is not None and numbers(text) != numbers(row[2]):
+                    stats.number_mismatches += 1
+                elif row is not None:
+                    self._db.execute("UPDATE entries SET accessed_at = ?, hits = hits + 1 WHERE id = ?", (now, doc.id))
+                    self._db.commit()
+                    hit = (_decode(row[0]), similarity)
+
+            if hit is None:
+                stats.misses += 1
+            else:
+                stats.hits += 1
+                stats.hit_similarity += hit[1]
+            stats.lookup_seconds += time.perf_counter() - start
+        return hit
+
+    def put_vector(self, namespace: str, vector: np.ndarray, text: str, output: Any) -> None:
+        payload = _encode(output)
+        with self._lock:
+            stats = self._stats(namespace)
+            if payload is None:
+                stats.skipped += 1
+                return
+            id_ = str(uuid.uuid4())
+            now = time.time()
+            self._store(namespace).add_vectors(np.atleast_2d(vector), [text], ids=[id_])
+            self._db.execute(
+                "INSERT INTO entries (id, namespace, input, output, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (id_, namespace, text, payload, now, now),
+            )
+            self._db.commit()
+            stats.stores += 1
+
+            (count,) = self._db.execute("SELECT COUNT(*) FROM entries WHERE namespace = ?", (namespace,)).fetchone()
+            if count > self.max_entries:
+                evicted = [row[0] for row in self._db.execute(
+                    "SELECT id FROM entries WHERE namespace = ? ORDER BY accessed_at LIMIT ?",
+                    (namespace, count - self.max_entries),
+                )]
+                self._delete(namespace, evicted)
+                stats.evictions += len(evicted)
+
+    def lookup(self, namespace: str, text: str) -> Optional[Tuple[Any, float]]:
+        return self.lookup_vector(namespace, np.asarray(self.embedding.embed_query(text), dtype=np.float32), text)
+
+    def put(self, namespace: str, text: str, output: Any) -> None:
+        self.put_vector(namespace, np.asarray(self.embedding.embed_query(text), dtype=np.float32), text, output)
+
+    def clear(self, namespace: str) -> None:
+        with self._lock:
+            ids = [row[0] for row in self._db.execute("SELECT id FROM entries WHERE namespace = ?", (namespace,))]
+            self._delete(namespace, ids)
+
+    def wrap(self, chain: Runnable, namespace: str, key: Callable[[Any], str] = input_text) -> Runnable:
+        """chain の前にキャッシュ検索を挟んだ Runnable を返す
+
+        入力は1回だけ埋め込み、ミスしたときはそのベクトルで出力を登録する。
+        """
+        def invoke(value: Any, config: RunnableConfig) -> Any:
+            text = key(value)
+            vector = np.asarray(self.embedding.embed_query(text), dtype=np.float32)
+            hit = self.lookup_vector(namespace, vector, text)
+            if hit is not None:
+                return hit[0]
+            output = chain.invoke(value, config)
+            self.put_vector(namespace, vector, text, output)
+            return output
+
+        async def ainvoke(value: Any, config: RunnableConfig) -> Any:
+            text = key(value)
+            vector = np.asarray(await self.embedding.aembed_query(text), dtype=np.float32)
+            hit = await asyncio.to_thread(self.lookup_vector, namespace, vector, text)
+            if hit is not None:
+                return hit[0]
+            output = await chain.ainvoke(value, config)
+            await asyncio.to_thread(self.put_vector, namespace, vector, text, output)
+            return output
+
+        return RunnableLambda(invoke, afunc=ainvoke, name=f"semantic_cache[{namespace}]")
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from langchain_core.embeddings import Embeddings as _Embeddings
+
+    from text_index import CharNgramVectorizer
+
+    class NgramEmbeddings(_Embeddings):
+        """動作確認用に、文字 n-gram の TF-IDF を埋め込みとして使う"""
+        def __init__(self) -> None:
+            self.vectorizer = CharNgramVectorizer(n_features=4096).fit(["10 + 2 * 3", "カレーの作り方"])
+
+        def embed_documents(self, texts):
+            return self.vectorizer.transform(texts).tolist()
+
+        def embed_query(self, text):
+            return self.embed_documents([text])[0]
+
+    calls = []
+
+    def slow_chain(value: dict) -> str:
+        calls.append(value["question"])
+        time.sleep(0.5)
+        return f"answer to {value['question']}"
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = SemanticCache(directory, NgramEmbeddings(), threshold=0.8, max_entries=100)
+        chain = cache.wrap(RunnableLambda(slow_chain), "lcel.multi_chain")
+        for question in ["10 + 2 * 3", "10+2*3", "10 + 2 * 4", "カレーの作り方", "カレーの作り方は？"]:
+            start = time.perf_counter()
+            output = chain.invoke({"question": question})
+            print(f"{question!r}: {output!r} ({(time.perf_counter() - start) * 1000:.1f}ms)")
+        print(f"chain calls: {len(calls)}")
+        print(cache.stats["lcel.multi_chain"].to_dict())
@@ -0,0 +1,473 @@
+import asyncio
+import copy
+import threading
+import time
+from contextlib import aclosing
+from dataclasses import asdict, dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from langchain_core.messages import convert_to_messages, message_to_dict
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from response_cache import request_key
+from sample_gpt import AIClient, AsyncAIClient
+
+
+@dataclass
+class SingleFlightStats:
+    """上流への呼び出しをどれだけまとめられたか"""
+    calls: int = 0
+    # 実際に上流へ送った数
+    upstream: int = 0
+    # 実行中の同じリクエストに相乗りして、上流への呼び出しを省けた数
+    coalesced: int = 0
+    errors: int = 0
+
+    @property
+    def saved_rate(self) -> float:
+        return self.coalesced / self.calls if self.calls else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**asdict(self), "saved_rate": round(self.saved_rate, 4)}
+
+
+def _copy(value: Any) -> Any:
+    # 相乗りした呼び出し元が結果を書き換えても、他の呼び出し元に影響しないようにする
+    return value if isinstance(value, (str, bytes, int, float, bool)) else copy.deepcopy(value)
+
+
+class _Call:
+    """実行中の同期呼び出し1件"""
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        # 相乗りした呼び出し元の数。いれば先頭の呼び出し元にもコピーを返す
+        self.followers = 0
+
+
+class _AsyncCall:
+    """実行中の非同期呼び出し1件"""
+    def __init__(self, task: asyncio.Future) -> None:
+        self.task = task
+        self.waiters = 0
+        # これまでに待った呼び出し元の数（途中で抜けたものも含む）
+        self.joined = 0
+
+
+class _Stream:
+    """実行中の同期ストリーム1件。読み手のうち先頭にいるものが上流から次のチャンクを取ってくる"""
+    def __init__(self, open_stream: Callable[[], Any]) -> None:
+        self.open_stream = open_stream
+        self.upstream: Optional[Iterator[Any]] = None
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.pulling = False
+        self.readers = 0
+        self.cond = threading.Condition()
+
+    def _pull(self) -> None:
+        try:
+            if self.upstream is None:
+                self.upstream = iter(self.open_stream())
+            chunk = next(self.upstream)
+        except StopIteration:
+            with self.cond:
+                self.done, self.pulling = True, False
+                self.cond.notify_all()
+        except BaseException as e:
+            with self.cond:
+                self.done, self.error, self.pulling = True, e, False
+                self.cond.notify_all()
+        else:
+            with self.cond:
+                self.chunks.append(chunk)
+                self.pulling = False
+                self.cond.notify_all()
+
+    def read(self) -> Iterator[Any]:
+        i = 0
+        try:
+            while True:
+                with self.cond:
+                    while i >= len(self.chunks) and not self.done and self.pulling:
+                        self.cond.wait()
+                    pull = i >= len(self.chunks)
+                    if pull:
+                        if self.done:
+                            if self.error is not None:
+                                raise self.error
+                            return
+                        self.pulling = True
+                if pull:
+                    self._pull()
+                    continue
+                i += 1
+                yield self.chunks[i - 1]
+        finally:
+            with self.cond:
+                self.readers -= 1
+                abandoned = self.readers == 0 and not self.done
+                if abandoned:
+                    # 最後の読み手が途中でやめたら上流のストリームも閉じる
+                    self.done = True
+            if abandoned and self.upstream is not None and hasattr(self.upstream, "close"):
+                self.upstream.close()
+
+
+class _AsyncStream:
+    """実行中の非同期ストリーム1件。上流はタスクが読み、読み手はバッファを順に追いかける"""
+    def __init__(self) -> None:
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.readers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def pump(self, upstream: AsyncIterator[Any]) -> None:
+        try:
+            async for chunk in upstream:
+                self.chunks.append(chunk)
+                self._notify()
+        except BaseException as e:
+            self.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            self.done = True
+            self._notify()
+            if hasattr(upstream, "aclose"):
+                await upstream.aclose()
+
+    async def read(self) -> AsyncIterator[Any]:
+        i = 0
+        try:
+            while True:
+                while i < len(self.chunks):
+                    i += 1
+                    yield self.chunks[i - 1]
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0 and self.task is not None and not self.task.done():
+                self.task.cancel()
+
+
+class SingleFlight:
+    """同じキーのリクエストが実行中なら、後から来た呼び出しを最初の呼び出しの結果に相乗りさせる
+
+    キャッシュと違って結果は完了した時点で手放すので、temperature が高いリクエストでも同時に来たものだけがまとまる。
+    例外も相乗りした全員に伝わる。ストリームは途中から相乗りした場合も最初のチャンクから受け取る。
+    """
+    def __init__(self) -> None:
+        self.stats = SingleFlightStats()
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _Stream] = {}
+        self._async_calls: Dict[str, _AsyncCall] = {}
+        self._async_streams: Dict[str, _AsyncStream] = {}
+
+    def _count(self, leader: bool) -> None:
+        # self._lock を取得した状態で呼ぶこと
+        self.stats.calls += 1
+        if leader:
+            self.stats.upstream += 1
+        else:
+            self.stats.coalesced += 1
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+            self._count(leader)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return _copy(call.result)
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.stats.errors += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                # _calls から外したので、これ以上相乗りは増えない
+                followers = call.followers
+            call.done.set()
+        # 相乗りがいれば、相乗り側がコピーしている最中の call.result を先頭の呼び出し元に書き換えさせない
+        return _copy(call.result) if followers else call.result
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """do の非同期版。呼び出し元が全員キャンセルされたら上流の呼び出しもキャンセルする"""
+        with self._lock:
+            call = self._async_calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._async_calls[key] = _AsyncCall(asyncio.ensure_future(fn()))
+                call.task.add_done_callback(lambda t: self._finish_async_call(key, call))
+            call.waiters += 1
+            call.joined += 1
+            self._count(leader)
+
+        try:
+            result = await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+        # 先頭の呼び出し元が先に再開して結果を書き換えることもあるので、相乗りがいれば全員コピーを受け取る
+        return result if leader and call.joined == 1 else _copy(result)
+
+    def _finish_async_call(self, key: str, call: _AsyncCall) -> None:
+        task = call.task
+        with self._lock:
+            if self._async_calls.get(key) is call:
+                del self._async_calls[key]
+            if not task.cancelled() and task.exception() is not None:
+                self.stats.errors += 1
+
+    def stream(self, key: str, open_stream: Callable[[], Any]) -> Iterator[Any]:
+        """同期ストリームを共有する。チャンクは全員に同じオブジェクトを渡すので書き換えないこと"""
+        with self._lock:
+            flight = self._streams.get(key)
+            # 読み終わった（途中で捨てられた）ストリームには相乗りしない
+            leader = flight is None or flight.done
+            if leader:
+                flight = self._streams[key] = _Stream(open_stream)
+            flight.readers += 1
+            self._count(leader)
+        try:
+            yield from flight.read()
+        finally:
+            with self._lock:
+                if self._streams.get(key) is flight and flight.done:
+                    del self._streams[key]
+                    if flight.error is not None:
+                        self.stats.errors += 1
+
+    async def astream(self, key: str, open_stream: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """stream の非同期版。読み手が全員いなくなったら上流のストリームを閉じる"""
+        with self._lock:
+            flight = self._async_streams.get(key)
+            # 読み手が全員いなくなったストリームは閉じている途中なので相乗りしない
+            leader = flight is None or flight.readers == 0
+            if leader:
+                flight = self._async_streams[key] = _AsyncStream()
+                flight.task = asyncio.ensure_future(flight.pump(open_stream()))
+                flight.task.add_done_callback(lambda t: self._finish_async_stream(key, flight))
+            flight.readers += 1
+            self._count(leader)
+
+        async with aclosing(flight.read()) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    def _finish_async_stream(self, key: str, flight: _AsyncStream) -> None:
+        with self._lock:
+            if self._async_streams.get(key) is flight:
+                del self._async_streams[key]
+            if flight.error is not None and not isinstance(flight.error, asyncio.CancelledError):
+                self.stats.errors += 1
+
+
+class CoalescingAIClient(AIClient):
+    """実行中の同じリクエスト（response_cache.request_key が一致するもの）を1回の呼び出しにまとめるデコレータ"""
+    def __init__(self, ai_client: AIClient, flight: Optional[SingleFlight] = None):
+        self.ai_client = ai_client
+        self.flight = flight or SingleFlight()
+
+    @property
+    def stats(self) -> SingleFlightStats:
+        return self.flight.stats
+
+    def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        key = request_key(messages, **kwargs)
+        call = lambda: self.ai_client.chat_completion(messages=messages, **kwargs)  # noqa: E731
+        if kwargs.get("stream"):
+            return self.flight.stream(key, call)
+        return self.flight.do(key, call)
+
+
+class AsyncCoalescingAIClient(AsyncAIClient):
+    """CoalescingAIClient の非同期版"""
+    def __init__(self, ai_client: AsyncAIClient, flight: Optional[SingleFlight] = None):
+        self.ai_client = ai_client
+        self.flight = flight or SingleFlight()
+
+    @property
+    def stats(self) -> SingleFlightStats:
+        return self.flight.stats
+
+    async def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+        key = request_key(messages, **kwargs)
+        if kwargs.get("stream"):
+            async def open_stream() -> AsyncIterator[Any]:
+                async for chunk in await self.ai_client.chat_completion(messages=messages, **kwargs):
+                    yield chunk
+            return self.flight.astream(key, open_stream)
+        return await self.flight.ado(key, lambda: self.ai_client.chat_completion(messages=messages, **kwargs))
+
+
+# LangGraph などが実行ごとに入れる値。キーに含めると同じリクエストでもまとまらなくなる
+_RUN_SCOPED_CONFIGURABLE = ("thread_id", "run_id")
+
+
+def _request_configurable(config: Optional[RunnableConfig]) -> Dict[str, Any]:
+    """config の configurable のうち、リクエストの中身を変えうる値（max_tokens など）だけを返す"""
+    return {
+        key: value for key, value in (config or {}).get("configurable", {}).items()
+        if not key.startswith(("__", "checkpoint_")) and key not in _RUN_SCOPED_CONFIGURABLE
+    }
+
+
+class CoalescedRunnable(Runnable):
+    """チャットモデルへの同じ入力が実行中なら、その結果（ストリームならチャンク）を共有する Runnable
+
+    キーは入力のメッセージ列、ラップしたモデル、呼び出し時の kwargs（stop など）と config の configurable
+    （max_tokens など）から決める。configurable のうち thread_id や checkpoint_ns のような実行ごとの値は使わない。
+    相乗りした呼び出しのそれ以外の config（コールバックなど）は上流に渡らない。
+    """
+    def __init__(self, runnable: Runnable, flight: Optional[SingleFlight] = None):
+        self.runnable = runnable
+        self.flight = flight or SingleFlight()
+
+    @property
+    def stats(self) -> SingleFlightStats:
+        return self.flight.stats
+
+    def _key(self, input: Any, config: Optional[RunnableConfig], kwargs: Dict[str, Any]) -> str:
+        messages = input.to_messages() if isinstance(input, PromptValue) else convert_to_messages(
+            [input] if isinstance(input, str) else input
+        )
+        # 実行中のリクエストだけをまとめるので、同じプロセス内で同じモデルを指せば十分
+        return request_key(
+            [message_to_dict(m) for m in messages],
+            runnable=id(self.runnable),
+            kwargs=kwargs,
+            configurable=_request_configurable(config),
+        )
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        key = self._key(input, config, kwargs)
+        return self.flight.do(key, lambda: self.runnable.invoke(input, config, **kwargs))
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        key = self._key(input, config, kwargs)
+        return await self.flight.ado(key, lambda: self.runnable.ainvoke(input, config, **kwargs))
+
+    def stream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        key = self._key(input, config, kwargs)
+        yield from self.flight.stream(key, lambda: self.runnable.stream(input, config, **kwargs))
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[Any]:
+        key = self._key(input, config, kwargs)
+        async for chunk in self.flight.astream(key, lambda: self.runnable.astream(input, config, **kwargs)):
+            yield chunk
+
+
+def coalesced(runnable: Runnable, flight: Optional[SingleFlight] = None) -> CoalescedRunnable:
+    """チャットモデル（を含む Runnable）に single-flight を挟む"""
+    return CoalescedRunnable(runnable, flight)
+
+
+if __name__ == "__main__":
+    from concurrent.futures import ThreadPoolExecutor
+
+    from langchain_core.language_models import GenericFakeChatModel
+    from langchain_core.messages import AIMessage
+
+    class SlowAIClient(AIClient):
+        """動作確認用に、0.3秒かかる AIClient"""
+        def __init__(self) -> None:
+            self.calls = 0
+
+        def chat_completion(self, messages: List[Dict[str, Any]], **kwargs) -> Any:
+            self.calls += 1
+            time.sleep(0.3)
+            if kwargs.get("stream"):
+                return iter(f"answer to {messages[-1]['content']}".split())
+            return {"content": f"answer to {messages[-1]['content']}"}
+
+    # 5種類の質問が50件同時に届いた場合
+    upstream = SlowAIClient()
+    client = CoalescingAIClient(upstream)
+    queries = [f"{city}の天気は？" for city in ["Tokyo", "Paris", "San Francisco", "Osaka", "Kyoto"]] * 10
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        results = list(executor.map(
+            lambda q: client.chat_completion([{"role": "user", "content": q}], model="gpt-4o", temperature=1),
+            queries,
+        ))
+    print(f"sync: {len(results)} calls, upstream={upstream.calls} ({time.perf_counter() - start:.2f}s)")
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        streams = list(executor.map(
+            lambda q: " ".join(client.chat_completion([{"role": "user", "content": q}], model="gpt-4o", stream=True)),
+            queries,
+        ))
+    assert streams[0] == streams[5]
+    print(f"sync stream: {streams[0]!r}, upstream={upstream.calls}")
+    print(client.stats.to_dict())
+
+    async def amain() -> None:
+        model = GenericFakeChatModel(messages=iter([AIMessage(content="カレー の 作り方 は ...")] * 100))
+        chain = coalesced(model)
+        start = time.perf_counter()
+        answers = await asyncio.gather(*(chain.ainvoke("カレーの作り方") for _ in range(20)))
+        print(f"async: {len(answers)} calls ({time.perf_counter() - start:.3f}s) {answers[0].content!r}")
+
+        async def collect() -> str:
+            return "".join([chunk.content async for chunk in chain.astream("カレーの作り方")])
+        streamed = await asyncio.gather(*(collect() for _ in range(20)))
+        assert len(set(streamed)) == 1
+        print(f"async stream: {streamed[0]!r}")
+        print(chain.stats.to_dict())
+
+        # LangGraph のノードの中から呼んでも（configurable に実行ごとの値が入っていても）まとまる
+        from langgraph.graph import END, START, StateGraph
+        from typing_extensions import TypedDict
+
+        class State(TypedDict):
+            question: str
+            answer: str
+
+        from langchain_core.prompts import ChatPromptTemplate
+
+        coalesced_model = coalesced(model)
+        graph_chain = ChatPromptTemplate.from_messages([("human", "{question}")]) | coalesced_model
+
+        async def answer(state: State, config: RunnableConfig) -> Dict[str, str]:
+            return {"answer": (await graph_chain.ainvoke(state, config)).content}
+
+        graph = StateGraph(State)
+        graph.add_node("answer", answer)
+        graph.add_edge(START, "answer")
+        graph.add_edge("answer", END)
+        app = graph.compile()
+        await asyncio.gather(*(
+            app.ainvoke({"question": "カレーの作り方"}, {"configurable": {"thread_id": str(i)}}) for i in range(10)
+        ))
+        assert coalesced_model.stats.upstream == 1, coalesced_model.stats
+        print(f"graph: {coalesced_model.stats.to_dict()}")
+
+    asyncio.run(amain())
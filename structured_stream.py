@@ -0,0 +1,280 @@
+import json
+import re
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Type, Union, get_origin
+
+from langchain_core.messages import BaseMessage
+from langchain_core.output_parsers import BaseTransformOutputParser
+from langchain_core.output_parsers.json import parse_partial_json
+from pydantic import BaseModel
+
+Path = Tuple[Union[str, int], ...]
+
+_STRING_SPECIAL = re.compile(r'["\\]')
+_NUMBER_CHARS = frozenset("0123456789+-.eE")
+_LITERALS = {"true": True, "false": False, "null": None}
+_UNSET = object()
+
+
+class IncrementalJSONParser:
+    """JSON テキストを少しずつ受け取り、値が完成するたびに (パス, 値) を返すパーサ
+
+    各文字は一度しか読まないので、チャンクをいくつに分けて渡しても処理時間は出力の長さに比例する。
+    オブジェクトや配列は開いた時点で親に追加されるため、root からは途中までの値が常に参照できる。
+    JSON の前の説明文や ```json は読み飛ばし、最初の { か [ から読み始める。説明文中の括弧（"Here is [note] {...}"）
+    だった場合は、値が1つも完成しないうちに JSON として読めなくなるので、その括弧の次から読み直す。
+    """
+    def __init__(self) -> None:
+        self._reset()
+
+    def _reset(self) -> None:
+        self.root: Any = _UNSET
+        # [コンテナ, 次のキー（dict のとき）, キー待ちかどうか]
+        self._stack: List[List[Any]] = []
+        self._token: Optional[str] = None  # "string" / "number" / "literal"
+        self._buffer: List[str] = []
+        self._escape = False
+        # 読み直しに備えて、開始の括弧から後のテキストを値が完成するまで取っておく
+        self._replay: Optional[List[str]] = None
+        self.done = False
+
+    def _path(self) -> Path:
+        path: List[Union[str, int]] = []
+        for container, key, _ in self._stack:
+            path.append(key if isinstance(container, dict) else len(container) - 1)
+        return tuple(path)
+
+    def _attach(self, value: Any) -> Path:
+        """値を親コンテナに追加し、その値のパスを返す"""
+        if not self._stack:
+            self.root = value
+            return ()
+        container, key, _ = self._stack[-1]
+        if isinstance(container, dict):
+            container[key] = value
+        else:
+            container.append(value)
+        return self._path()
+
+    def _complete_scalar(self, value: Any, events: List[Tuple[Path, Any]]) -> None:
+        if self._stack and isinstance(self._stack[-1][0], dict) and self._stack[-1][2]:
+            # オブジェクトのキーが読み終わった
+            self._stack[-1][1] = value
+            self._stack[-1][2] = False
+            return
+        events.append((self._attach(value), value))
+        if not self._stack:
+            self.done = True
+
+    def _finish_token(self, events: List[Tuple[Path, Any]]) -> None:
+        raw = "".join(self._buffer)
+        kind = self._token
+        self._token, self._buffer = None, []
+        if kind == "number":
+            value = json.loads(raw)
+        else:
+            if raw not in _LITERALS:
+                raise ValueError(f"Invalid JSON literal: {raw!r}")
+            value = _LITERALS[raw]
+        self._complete_scalar(value, events)
+
+    def feed(self, text: str) -> List[Tuple[Path, Any]]:
+        """テキストの続きを読み、この呼び出しで完成した値の一覧を返す"""
+        while True:
+            if self._replay is not None:
+                self._replay.append(text)
+            events: List[Tuple[Path, Any]] = []
+            try:
+                self._feed(text, events)
+            except ValueError:
+                if self._replay is None:
+                    raise
+                # 説明文中の括弧だったので、その次の文字から JSON の開始を探し直す
+                text = "".join(self._replay)[1:]
+                self._reset()
+                continue
+            if events:
+                # 値を返したら読み直さない（返した値と食い違うため）
+                self._replay = None
+            return events
+
+    def _feed(self, text: str, events: List[Tuple[Path, Any]]) -> None:
+        i, n = 0, len(text)
+        while i < n and not self.done:
+            if self._token == "string":
+                if self._escape:
+                    self._buffer.append(text[i])
+                    self._escape = False
+                    i += 1
+                    continue
+                match = _STRING_SPECIAL.search(text, i)
+                if match is None:
+                    self._buffer.append(text[i:])
+                    break
+                j = match.start()
+                self._buffer.append(text[i:j])
+                if text[j] == "\\":
+                    self._buffer.append("\\")
+                    self._escape = True
+                    i = j + 1
+                    continue
+                raw = "".join(self._buffer)
+                self._token, self._buffer = None, []
+                self._complete_scalar(json.loads(f'"{raw}"'), events)
+                i = j + 1
+                continue
+
+            c = text[i]
+            if self._token == "number":
+                if c in _NUMBER_CHARS:
+                    self._buffer.append(c)
+                    i += 1
+                    continue
+                self._finish_token(events)
+                continue
+            if self._token == "literal":
+                if c.isalpha():
+                    self._buffer.append(c)
+                    i += 1
+                    continue
+                self._finish_token(events)
+                continue
+
+            i += 1
+            if self.root is _UNSET:
+                if c not in "{[":
+                    # 前置きは読み飛ばす
+                    continue
+                self._replay = [text[i - 1:]]
+            if c in " \t\r\n:":
+                continue
+            if c == '"':
+                self._token = "string"
+            elif c in "{[":
+                container: Any = {} if c == "{" else []
+                self._attach(container)
+                self._stack.append([container, None, c == "{"])
+            elif c in "}]":
+                container = self._stack.pop()[0]
+                events.append((self._path(), container))
+                if not self._stack:
+                    self.done = True
+            elif c == ",":
+                if isinstance(self._stack[-1][0], dict):
+                    self._stack[-1][2] = True
+            elif c == "-" or c.isdigit():
+                self._token, self._buffer = "number", [c]
+            elif c.isalpha():
+                self._token, self._buffer = "literal", [c]
+            else:
+                raise ValueError(f"Unexpected character in JSON: {c!r}")
+
+    def close(self) -> List[Tuple[Path, Any]]:
+        """入力の終わり。末尾の数値・リテラルを確定させる"""
+        events: List[Tuple[Path, Any]] = []
+        if self._token in ("number", "literal"):
+            self._finish_token(events)
+        return events
+
+
+def _empty_value(annotation: Any) -> Any:
+    return [] if get_origin(annotation) is list or annotation is list else None
+
+
+def json_schema_format(model: Type[BaseModel]) -> Dict[str, Any]:
+    """OpenAI の response_format に渡す strict な JSON Schema を作る"""
+    schema = model.model_json_schema()
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": model.__name__, "schema": {**schema, "additionalProperties": False}, "strict": True},
+    }
+
+
+class PartialModelParser(BaseTransformOutputParser[BaseModel]):
+    """モデルの出力ストリームから、途中まで埋まった pydantic オブジェクトを順に返すパーサ
+
+    トップレベルのフィールドやリストの要素が完成するたびに model_construct したオブジェクトを返し、
+    最後に検証済みのオブジェクトを返す。invoke した場合は検証済みのオブジェクトだけを返す。
+    """
+    pydantic_object: Type[BaseModel]
+
+    @property
+    def _type(self) -> str:
+        return "partial_model"
+
+    def _snapshot(self, root: Dict[str, Any]) -> BaseModel:
+        fields = {name: _empty_value(info.annotation) for name, info in self.pydantic_object.model_fields.items()}
+        fields.update({k: list(v) if isinstance(v, list) else v for k, v in root.items()})
+        return self.pydantic_object.model_construct(**fields)
+
+    def _emit(self, parser: IncrementalJSONParser, events: List[Tuple[Path, Any]]) -> Iterator[BaseModel]:
+        if not isinstance(parser.root, dict):
+            return
+        if any(path == () for path, _ in events):
+            yield self.pydantic_object.model_validate(parser.root)
+        elif any(len(path) == 2 or (len(path) == 1 and not isinstance(value, list)) for path, value in events):
+            # リストの要素か、リスト以外のフィールドが完成したとき（リストが閉じただけでは中身は変わらない）
+            yield self._snapshot(parser.root)
+
+    @staticmethod
+    def _text(chunk: Union[str, BaseMessage]) -> str:
+        if isinstance(chunk, BaseMessage):
+            return chunk.content if isinstance(chunk.content, str) else ""
+        return chunk
+
+    def _transform(self, input: Iterator[Union[str, BaseMessage]]) -> Iterator[BaseModel]:
+        parser = IncrementalJSONParser()
+        for chunk in input:
+            yield from self._emit(parser, parser.feed(self._text(chunk)))
+        yield from self._emit(parser, parser.close())
+
+    async def _atransform(self, input: AsyncIterator[Union[str, BaseMessage]]) -> AsyncIterator[BaseModel]:
+        parser = IncrementalJSONParser()
+        async for chunk in input:
+            for item in self._emit(parser, parser.feed(self._text(chunk))):
+                yield item
+        for item in self._emit(parser, parser.close()):
+            yield item
+
+    def parse(self, text: str) -> BaseModel:
+        parser = IncrementalJSONParser()
+        parser.feed(text)
+        parser.close()
+        if parser.root is _UNSET:
+            raise ValueError("No JSON object found in model output")
+        return self.pydantic_object.model_validate(parser.root)
+
+
+if __name__ == "__main__":
+    # 出力を小さなチャンクで流したとき、累積バッファを毎回パースし直す方式と比べる
+    document = json.dumps({
+        "ingredients": [f"材料 {i}: 玉ねぎ {i} 個" for i in range(200)],
+        "steps": [f"手順 {i}: 鍋で {i} 分ほど \"よく\" 煮込む" for i in range(200)],
+    }, ensure_ascii=False)
+    chunks = [document[i:i + 4] for i in range(0, len(document), 4)]
+
+    start = time.perf_counter()
+    parser = IncrementalJSONParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    incremental = time.perf_counter() - start
+    assert parser.root == json.loads(document)
+
+    start = time.perf_counter()
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        parse_partial_json(buffer)
+    reparse = time.perf_counter() - start
+
+    print(f"{len(document)} chars / {len(chunks)} chunks: incremental={incremental * 1000:.1f}ms reparse={reparse * 1000:.1f}ms")
+
+    # 説明文と同じ行に続く JSON や、説明文中の括弧があっても読める
+    class _Recipe(BaseModel):
+        ingredients: List[str]
+        steps: List[str]
+
+    recipe_parser = PartialModelParser(pydantic_object=_Recipe)
+    for text in ['Sure: {"ingredients": ["a"], "steps": []}', 'Here is [note] {"ingredients": ["a"], "steps": []}']:
+        assert recipe_parser.parse(text) == _Recipe(ingredients=["a"], steps=[])
+        assert list(recipe_parser.transform(iter(text)))[-1] == _Recipe(ingredients=["a"], steps=[])
@@ -0,0 +1,74 @@
+import zlib
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_FEATURES = 2 ** 15
+
+
+def char_ngrams(text: str, ngram_range: Tuple[int, int] = (1, 3)) -> List[str]:
+    """空白を正規化した文字 n-gram を返す（日本語のように単語区切りのない文でも使える）"""
+    text = f" {' '.join(text.lower().split())} "
+    lo, hi = ngram_range
+    return [text[i:i + n] for n in range(lo, hi + 1) for i in range(len(text) - n + 1)]
+
+
+class CharNgramVectorizer:
+    """文字 n-gram の TF-IDF ベクトル化（特徴量はハッシュで固定次元に落とす）
+
+    ハッシュには crc32 を使うので、プロセスをまたいでも同じ文字列は同じ次元に対応する。
+    """
+    def __init__(self, n_features: int = DEFAULT_FEATURES, ngram_range: Tuple[int, int] = (1, 3)):
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.idf: Optional[np.ndarray] = None
+
+    def _counts(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        buckets = np.fromiter(
+            (zlib.crc32(gram.encode("utf-8")) % self.n_features for gram in char_ngrams(text, self.ngram_range)),
+            dtype=np.int64,
+        )
+        return np.unique(buckets, return_counts=True)
+
+    def fit(self, texts: Iterable[str]) -> "CharNgramVectorizer":
+        df = np.zeros(self.n_features, dtype=np.float32)
+        n = 0
+        for text in texts:
+            buckets, _ = self._counts(text)
+            df[buckets] += 1
+            n += 1
+        self.idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+        return self
+
+    def transform_sparse(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """1件分の (次元, 値) を返す。行列を作らずに内積を取りたいときに使う"""
+        if self.idf is None:
+            raise ValueError("CharNgramVectorizer is not fitted")
+        buckets, counts = self._counts(text)
+        weights = (1 + np.log(counts)) * self.idf[buckets]
+        norm = np.linalg.norm(weights)
+        return buckets, weights / norm if norm else weights
+
+    def transform(self, texts: Sequence[str]) -> np.ndarray:
+        """L2 正規化した (len(texts), n_features) の行列を返す"""
+        if self.idf is None:
+            raise ValueError("CharNgramVectorizer is not fitted")
+        matrix = np.zeros((len(texts), self.n_features), dtype=np.float32)
+        for row, text in enumerate(texts):
+            buckets, counts = self._counts(text)
+            matrix[row, buckets] = (1 + np.log(counts)) * self.idf[buckets]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def fit_transform(self, texts: Sequence[str]) -> np.ndarray:
+        return self.fit(texts).transform(texts)
+
+    def state(self) -> dict:
+        return {"n_features": self.n_features, "ngram_range": list(self.ngram_range), "idf": self.idf}
+
+    @classmethod
+    def from_state(cls, state: dict) -> "CharNgramVectorizer":
+        vectorizer = cls(int(state["n_features"]), tuple(int(n) for n in state["ngram_range"]))
+        vectorizer.idf = np.asarray(state["idf"], dtype=np.float32)
+        return vectorizer
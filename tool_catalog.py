@@ -0,0 +1,182 @@
+import collections.abc
+import inspect
+import threading
+import types
+import typing
+from typing import Any, Callable, Dict, List, Literal, Optional, Sequence, Tuple, Union, get_args, get_origin
+
+import numpy as np
+from langchain.agents.middleware import AgentMiddleware, ModelRequest, ModelResponse
+from langchain_core.messages import HumanMessage
+
+from text_index import CharNgramVectorizer
+
+_JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", dict: "object", list: "array"}
+# get_origin は typing.Sequence[int] でも collections.abc.Sequence を返す
+_ARRAY_ORIGINS = (list, tuple, set, frozenset, collections.abc.Sequence, collections.abc.Iterable, collections.abc.Set)
+_OBJECT_ORIGINS = (dict, collections.abc.Mapping)
+
+
+def _json_schema(annotation: Any) -> Dict[str, Any]:
+    """型注釈を JSON Schema に変換する（Annotated の文字列は description に、Literal は enum にする）
+
+    対応していない型は type を付けずに返す（何でも受け付ける）。
+    """
+    origin = get_origin(annotation)
+    if origin is typing.Annotated:
+        base, *extras = get_args(annotation)
+        schema = _json_schema(base)
+        descriptions = [extra for extra in extras if isinstance(extra, str)]
+        return {**schema, "description": descriptions[0]} if descriptions else schema
+    if origin is Union or origin is types.UnionType:
+        # Optional[T] は T として扱う（省略可能かどうかは required で表す）
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        return _json_schema(args[0]) if len(args) == 1 else {"anyOf": [_json_schema(arg) for arg in args]}
+    if origin is Literal:
+        values = list(get_args(annotation))
+        return {"type": _JSON_TYPES.get(type(values[0]), "string"), "enum": values}
+    if origin in _ARRAY_ORIGINS:
+        args = get_args(annotation)
+        return {"type": "array", "items": _json_schema(args[0])} if args else {"type": "array"}
+    if origin in _OBJECT_ORIGINS:
+        return {"type": "object"}
+    json_type = _JSON_TYPES.get(annotation)
+    return {"type": json_type} if json_type is not None else {}
+
+
+def function_schema(func: Callable, name: Optional[str] = None, description: Optional[str] = None) -> Dict[str, Any]:
+    """関数のシグネチャと docstring から OpenAI のツール定義を作る
+
+    引数の説明は Annotated[str, "説明"] で書く。docstring は最初の段落だけを description に使う。
+    """
+    hints = typing.get_type_hints(func, include_extras=True)
+    properties: Dict[str, Any] = {}
+    required: List[str] = []
+    for param in inspect.signature(func).parameters.values():
+        if param.name == "self" or param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+            continue
+        properties[param.name] = _json_schema(hints.get(param.name, str))
+        if param.default is inspect.Parameter.empty:
+            required.append(param.name)
+
+    doc = inspect.getdoc(func) or ""
+    return {
+        "type": "function",
+        "function": {
+            "name": name or func.__name__,
+            "description": description or doc.split("\n\n")[0].replace("\n", " "),
+            "parameters": {"type": "object", "properties": properties, "required": required},
+        },
+    }
+
+
+def _index_texts(schema: Dict[str, Any], keywords: str = "") -> List[str]:
+    """ツール1件分の検索対象（名前と説明、keywords、引数ごとの説明）を別々の文書として返す"""
+    function = schema["function"]
+    parameters = function.get("parameters", {}).get("properties", {})
+    texts = [f"{function['name'].replace('_', ' ')}\n{function.get('description', '')}", keywords]
+    texts += [f"{name.replace('_', ' ')} {spec.get('description', '')}" for name, spec in parameters.items()]
+    return [text for text in texts if text.strip()]
+
+
+class ToolIndex:
+    """ツールの名前・説明・引数の説明に対する文字 n-gram の検索インデックス
+
+    keywords にはクエリに出てきそうな言い回し（日本語の別名など）を渡す。説明が英語でも日本語のクエリで引けるようになる。
+    フィールドごとに別の文書としてベクトル化し、ツールのスコアは一番近いフィールドの類似度にする
+    （長い英語の説明に短い keywords が埋もれないようにするため）。
+    """
+    def __init__(
+        self,
+        schemas: Sequence[Dict[str, Any]],
+        keywords: Optional[Sequence[str]] = None,
+        n_features: int = 4096,
+    ):
+        self.schemas = list(schemas)
+        texts: List[str] = []
+        owners: List[int] = []
+        for i, (schema, kw) in enumerate(zip(self.schemas, keywords or [""] * len(self.schemas))):
+            fields = _index_texts(schema, kw)
+            texts += fields
+            owners += [i] * len(fields)
+        self.owners = np.asarray(owners, dtype=np.int64)
+        self.vectorizer = CharNgramVectorizer(n_features=n_features)
+        self.matrix = self.vectorizer.fit_transform(texts)
+
+    def search(self, query: str, k: int) -> List[Tuple[Dict[str, Any], float]]:
+        """類似度の高い順に (ツール定義, 類似度) を k 件返す"""
+        buckets, weights = self.vectorizer.transform_sparse(query)
+        scores = np.zeros(len(self.schemas), dtype=np.float32)
+        np.maximum.at(scores, self.owners, self.matrix[:, buckets] @ weights)
+        k = min(k, len(self.schemas))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.schemas[i], float(scores[i])) for i in top]
+
+
+class ToolRetrievalMiddleware(AgentMiddleware):
+    """create_agent の各ターンで、直近のユーザーの発言に近いツールだけをモデルに渡すミドルウェア
+
+    ツールが k 個以下なら何もしない。インデックスはツールの組み合わせごとに一度だけ作る。
+    """
+    def __init__(self, k: int = 8, keywords: Optional[Dict[str, str]] = None):
+        super().__init__()
+        self.k = k
+        self.keywords = keywords or {}
+        self._indexes: Dict[Tuple[str, ...], Tuple[ToolIndex, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _tool_name(tool: Any) -> str:
+        return tool["function"]["name"] if isinstance(tool, dict) else tool.name
+
+    def _index(self, tools: Sequence[Any]) -> Tuple[ToolIndex, Dict[str, Any]]:
+        names = tuple(self._tool_name(tool) for tool in tools)
+        with self._lock:
+            cached = self._indexes.get(names)
+            if cached is None:
+                schemas = [
+                    tool if isinstance(tool, dict) else
+                    {"type": "function", "function": {"name": tool.name, "description": tool.description}}
+                    for tool in tools
+                ]
+                index = ToolIndex(schemas, [self.keywords.get(name, "") for name in names])
+                cached = self._indexes[names] = (index, dict(zip(names, tools)))
+            return cached
+
+    def _select(self, request: ModelRequest) -> ModelRequest:
+        if len(request.tools) <= self.k:
+            return request
+        query = next((m.text for m in reversed(request.messages) if isinstance(m, HumanMessage)), "")
+        if not query:
+            return request
+        index, by_name = self._index(request.tools)
+        selected = [by_name[schema["function"]["name"]] for schema, _ in index.search(query, self.k)]
+        return request.override(tools=selected)
+
+    def wrap_model_call(self, request: ModelRequest, handler: Callable[[ModelRequest], ModelResponse]) -> ModelResponse:
+        return handler(self._select(request))
+
+    async def awrap_model_call(self, request: ModelRequest, handler: Callable[[ModelRequest], Any]) -> ModelResponse:
+        return await handler(self._select(request))
+
+
+if __name__ == "__main__":
+    from typing import Annotated
+
+    def get_current_weather(
+        location: Annotated[str, "The city and state, e.g. San Francisco, CA"],
+        unit: Optional[Literal["celsius", "fahrenheit"]] = "fahrenheit",
+    ) -> str:
+        """Get the current weather in a given location"""
+        return ""
+
+    def send_email(to: Annotated[str, "Recipient address"], subject: str, body: str, cc: Optional[List[str]] = None) -> str:
+        """Send an email to the given address."""
+        return ""
+
+    schemas = [function_schema(get_current_weather), function_schema(send_email)]
+    print(schemas[0])
+    index = ToolIndex(schemas, ["天気 気温 予報", "メール 送信"])
+    for query in ["Tokyoの天気はどうですか？", "会議の議事録をメールで送って"]:
+        print(query, [(schema["function"]["name"], round(score, 3)) for schema, score in index.search(query, 1)])
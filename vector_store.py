@@ -0,0 +1,378 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from rag import ChunkIndex
+
+# 内積を一度に計算する行数（クエリ数 × この行数の行列がメモリに乗る）
+SEARCH_BLOCK_ROWS = 65_536
+INITIAL_CAPACITY = 1024
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """行ごとに上位 k 件の (スコア, 列番号) を降順で返す"""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), np.float32), np.empty((scores.shape[0], 0), np.int64)
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+class MmapVectorStore(VectorStore, ChunkIndex):
+    """ベクトルをメモリマップトファイルに置くローカルのベクトルストア
+
+    mode="exact" は全件の内積を行列積で計算する厳密検索、mode="ivf" は k-means で作ったリストのうち
+    nprobe 個だけを int8 量子化したベクトルで粗く検索し、上位候補を float32 で再スコアリングする近似検索。
+    ベクトルファイルはプロセス間でページを共有でき、起動時にすべてを読み込む必要がない。
+    """
+    def __init__(self, path: str, embedding: Embeddings, mode: str = "exact", nprobe: int = 8, rerank_factor: int = 4):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.embedding = embedding
+        self.mode = mode
+        self.nprobe = nprobe
+        self.rerank_factor = rerank_factor
+        self._lock = threading.RLock()
+
+        self._header_path = self.path / "header.json"
+        header = json.loads(self._header_path.read_text()) if self._header_path.exists() else {}
+        self.dim: Optional[int] = header.get("dim")
+        self.capacity: int = header.get("capacity", 0)
+        self.count: int = header.get("count", 0)
+
+        self._db = sqlite3.connect(self.path / "docs.sqlite3", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS docs (slot INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, text TEXT, metadata TEXT)"
+        )
+        self._db.commit()
+
+        self._vectors: Optional[np.memmap] = None
+        self._codes: Optional[np.memmap] = None
+        self._scales: Optional[np.memmap] = None
+        self._lists: Optional[np.memmap] = None
+        self.centroids: Optional[np.ndarray] = None
+        self._inverted: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self.alive = np.zeros(self.capacity, dtype=bool)
+        if self.dim is not None:
+            self._open_files()
+            slots = [row[0] for row in self._db.execute("SELECT slot FROM docs")]
+            self.alive[slots] = True
+        if (self.path / "centroids.npy").exists():
+            self.centroids = np.load(self.path / "centroids.npy", mmap_mode="r")
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    # --- ファイル管理 ---
+
+    def _open_files(self) -> None:
+        def open_array(name: str, dtype: Any, shape: Tuple[int, ...]) -> np.memmap:
+            file_path = self.path / name
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            with open(file_path, "ab") as f:
+                if f.tell() < size:
+                    f.truncate(size)
+            return np.memmap(file_path, dtype=dtype, mode="r+", shape=shape)
+
+        self._vectors = open_array("vectors.f32", np.float32, (self.capacity, self.dim))
+        self._codes = open_array("codes.i8", np.int8, (self.capacity, self.dim))
+        self._scales = open_array("scales.f32", np.float32, (self.capacity,))
+        self._lists = open_array("lists.i32", np.int32, (self.capacity,))
+
+    def _ensure_capacity(self, needed: int) -> None:
+        if needed <= self.capacity:
+            return
+        capacity = max(self.capacity, INITIAL_CAPACITY)
+        while capacity < needed:
+            capacity *= 2
+        for array in (self._vectors, self._codes, self._scales, self._lists):
+            if array is not None:
+                array.flush()
+        self.capacity = capacity
+        self._open_files()
+        alive = np.zeros(capacity, dtype=bool)
+        alive[: len(self.alive)] = self.alive
+        self.alive = alive
+
+    def _save_header(self) -> None:
+        self._header_path.write_text(json.dumps({"dim": self.dim, "capacity": self.capacity, "count": self.count}))
+
+    def flush(self) -> None:
+        with self._lock:
+            for array in (self._vectors, self._codes, self._scales, self._lists):
+                if array is not None:
+                    array.flush()
+            self._save_header()
+            self._db.commit()
+
+    # --- 追加・削除 ---
+
+    def _quantize(self, slots: np.ndarray, vectors: np.ndarray) -> None:
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        self._codes[slots] = np.round(vectors / scales[:, None]).astype(np.int8)
+        self._scales[slots] = scales
+        if self.centroids is not None:
+            self._lists[slots] = np.argmax(vectors @ self.centroids.T, axis=1)
+            self._inverted = None
+
+    def add_vectors(
+        self,
+        vectors: np.ndarray,
+        texts: Sequence[str],
+        metadatas: Optional[Sequence[dict]] = None,
+        ids: Optional[Sequence[Optional[str]]] = None,
+    ) -> List[str]:
+        """埋め込み済みのベクトルを登録する。既存の ID は上書きする"""
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        ids = [id_ or str(uuid.uuid4()) for id_ in (ids or [None] * len(texts))]
+        metadatas = metadatas or [{}] * len(texts)
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            self.delete(ids)
+
+            # 削除で空いたスロットを先に再利用する
+            free = np.flatnonzero(~self.alive[: self.count])[: len(ids)]
+            extra = len(ids) - len(free)
+            self._ensure_capacity(self.count + extra)
+            slots = np.concatenate([free, np.arange(self.count, self.count + extra)]).astype(np.int64)
+            self.count += extra
+
+            self._vectors[slots] = vectors
+            self._quantize(slots, vectors)
+            self.alive[slots] = True
+            self._db.executemany(
+                "INSERT INTO docs (slot, id, text, metadata) VALUES (?, ?, ?, ?)",
+                [(int(s), i, t, json.dumps(m, ensure_ascii=False)) for s, i, t, m in zip(slots, ids, texts, metadatas)],
+            )
+            self.flush()
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, *, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        vectors = np.asarray(self.embedding.embed_documents(texts), dtype=np.float32)
+        return self.add_vectors(vectors, texts, metadatas, ids)
+
+    def add_documents(self, documents: List[Document], **kwargs: Any) -> List[str]:
+        return self.add_texts(
+            [doc.page_content for doc in documents],
+            [doc.metadata for doc in documents],
+            ids=kwargs.get("ids") or [doc.id for doc in documents],
+        )
+
+    def upsert(self, chunks: List[Document]) -> None:
+        self.add_documents(chunks)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        with self._lock:
+            placeholders = ",".join("?" * len(ids))
+            slots = [row[0] for row in self._db.execute(f"SELECT slot FROM docs WHERE id IN ({placeholders})", list(ids))]
+            if not slots:
+                return False
+            self.alive[slots] = False
+            self._inverted = None
+            self._db.execute(f"DELETE FROM docs WHERE id IN ({placeholders})", list(ids))
+            self._db.commit()
+        return True
+
+    # --- IVF ---
+
+    def build_ivf(self, nlist: Optional[int] = None, iterations: int = 10, sample_size: int = 50_000, seed: int = 0) -> None:
+        """k-means でリストを作り、全ベクトルをいずれかのリストに割り当てる"""
+        with self._lock:
+            live = np.flatnonzero(self.alive[: self.count])
+            if len(live) == 0:
+                return
+            nlist = nlist or max(int(np.sqrt(len(live))), 1)
+            rng = np.random.default_rng(seed)
+            sample = self._vectors[rng.choice(live, size=min(sample_size, len(live)), replace=False)]
+            centroids = sample[rng.choice(len(sample), size=min(nlist, len(sample)), replace=False)].copy()
+            for _ in range(iterations):
+                assign = np.argmax(sample @ centroids.T, axis=1)
+                for c in range(len(centroids)):
+                    members = sample[assign == c]
+                    if len(members):
+                        centroids[c] = members.mean(axis=0)
+                centroids = _normalize(centroids)
+
+            np.save(self.path / "centroids.npy", centroids)
+            self.centroids = centroids
+            for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+                block = slice(start, min(start + SEARCH_BLOCK_ROWS, self.count))
+                self._lists[block] = np.argmax(self._vectors[block] @ centroids.T, axis=1)
+            self._inverted = None
+            self.flush()
+
+    def _inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        """リスト番号順に並べた有効スロットと、各リストの開始位置を返す（更新があるまで使い回す）"""
+        if self._inverted is None:
+            live = np.flatnonzero(self.alive[: self.count])
+            lists = self._lists[live]
+            order = np.argsort(lists, kind="stable")
+            offsets = np.searchsorted(lists[order], np.arange(len(self.centroids) + 1))
+            self._inverted = (live[order], offsets)
+        return self._inverted
+
+    # --- 検索 ---
+
+    def search_vectors(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """複数のクエリベクトルをまとめて検索し、(スコア, スロット) を返す"""
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if self.count == 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.float32), empty.astype(np.int64)
+        if self.mode == "ivf" and self.centroids is not None:
+            return self._search_ivf(queries, k)
+        return self._search_exact(queries, k)
+
+    def _search_exact(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_slots = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, self.count)
+            scores = queries @ self._vectors[start:stop].T
+            scores[:, ~self.alive[start:stop]] = -np.inf
+            top_scores, top_idx = _top_k(scores, k)
+            merged_scores = np.concatenate([best_scores, top_scores], axis=1)
+            merged_slots = np.concatenate([best_slots, top_idx + start], axis=1)
+            best_scores, order = _top_k(merged_scores, k)
+            best_slots = np.take_along_axis(merged_slots, order, axis=1)
+        return best_scores, best_slots
+
+    def _search_ivf(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        nprobe = min(self.nprobe, len(self.centroids))
+        _, probes = _top_k(queries @ self.centroids.T, nprobe)
+        members, offsets = self._inverted_lists()
+        all_scores, all_slots = [], []
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([members[offsets[c]:offsets[c + 1]] for c in probe])
+            # int8 で粗くスコアを付け、上位だけ float32 で再計算する
+            coarse = (self._codes[candidates] @ query) * self._scales[candidates]
+            _, keep = _top_k(coarse[None, :], k * self.rerank_factor)
+            candidates = candidates[keep[0]]
+            scores, idx = _top_k((self._vectors[candidates] @ query)[None, :], k)
+            all_scores.append(scores[0])
+            all_slots.append(candidates[idx[0]])
+
+        width = max((len(s) for s in all_scores), default=0)
+        scores = np.full((len(queries), width), -np.inf, dtype=np.float32)
+        slots = np.full((len(queries), width), -1, dtype=np.int64)
+        for i, (s, sl) in enumerate(zip(all_scores, all_slots)):
+            scores[i, : len(s)] = s
+            slots[i, : len(sl)] = sl
+        return scores, slots
+
+    def _documents(self, slots: Sequence[int]) -> dict:
+        slots = [int(s) for s in slots if s >= 0]
+        if not slots:
+            return {}
+        placeholders = ",".join("?" * len(slots))
+        rows = self._db.execute(f"SELECT slot, id, text, metadata FROM docs WHERE slot IN ({placeholders})", slots)
+        return {slot: Document(id=id_, page_content=text, metadata=json.loads(meta)) for slot, id_, text, meta in rows}
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4) -> List[Tuple[Document, float]]:
+        scores, slots = self.search_vectors(np.asarray([embedding]), k)
+        docs = self._documents(slots[0])
+        return [(docs[int(s)], float(score)) for s, score in zip(slots[0], scores[0]) if int(s) in docs and np.isfinite(score)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def _select_relevance_score_fn(self):
+        # コサイン類似度 [-1, 1] を [0, 1] に変換する
+        return lambda score: (score + 1.0) / 2.0
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        if not ids:
+            return []
+        placeholders = ",".join("?" * len(ids))
+        rows = self._db.execute(f"SELECT id, text, metadata FROM docs WHERE id IN ({placeholders})", list(ids))
+        return [Document(id=id_, page_content=text, metadata=json.loads(meta)) for id_, text, meta in rows]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, *, ids: Optional[List[str]] = None, path: str = "vector_store", **kwargs: Any) -> "MmapVectorStore":
+        store = cls(path, embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+
+def benchmark(n: int, dim: int, queries: int, k: int, nlist: int, nprobe: int, path: str) -> None:
+    """ランダムなクラスタ状のベクトルで、厳密検索と IVF の QPS・recall@k を比較する"""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(max(nlist, 1), dim)).astype(np.float32)
+    data = centers[rng.integers(len(centers), size=n)] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+    query_vectors = centers[rng.integers(len(centers), size=queries)] + 0.5 * rng.normal(size=(queries, dim)).astype(np.float32)
+
+    store = MmapVectorStore(path, embedding=None, nprobe=nprobe)
+    if store.count == 0:
+        for start in range(0, n, 10_000):
+            block = data[start:start + 10_000]
+            store.add_vectors(block, [""] * len(block), ids=[str(i) for i in range(start, start + len(block))])
+    start = time.perf_counter()
+    store.build_ivf(nlist=nlist)
+    build_s = time.perf_counter() - start
+
+    store.mode = "exact"
+    start = time.perf_counter()
+    _, exact = store.search_vectors(query_vectors, k)
+    exact_s = time.perf_counter() - start
+
+    store.mode = "ivf"
+    start = time.perf_counter()
+    _, approx = store.search_vectors(query_vectors, k)
+    ivf_s = time.perf_counter() - start
+
+    recall = np.mean([len(set(a) & set(e)) / k for a, e in zip(approx, exact)])
+    print(json.dumps({
+        "vectors": store.count,
+        "dim": dim,
+        "ivf_build_s": round(build_s, 3),
+        "exact_qps": round(queries / exact_s, 1),
+        "ivf_qps": round(queries / ivf_s, 1),
+        f"ivf_recall@{k}": round(float(recall), 4),
+    }))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MmapVectorStore のベンチマーク")
+    parser.add_argument("--n", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--path", default=os.path.join("/tmp", "vector_store_bench"))
+    args = parser.parse_args()
+    benchmark(args.n, args.dim, args.queries, args.k, args.nlist, args.nprobe, args.path)